@@ -1,3 +1,11 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import PredictionJob
+
+
+@admin.register(PredictionJob)
+class PredictionJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'status', 'attempts', 'created_at', 'finished_at')
+    list_filter = ('status',)
+    exclude = ('bud_image', 'stem_image')
+    readonly_fields = ('result', 'error', 'worker', 'attempts', 'started_at', 'finished_at', 'webhook_delivered')
@@ -1,6 +1,44 @@
+import gc
+import os
+import sys
+
 from django.apps import AppConfig
+from django.conf import settings
+
+# Scripts that run management commands; any other entry point is a WSGI/ASGI server
+MANAGEMENT_SCRIPTS = ('manage.py', 'django-admin', '__main__.py')
+
+
+def serves_requests():
+    """
+    Whether this process serves requests: a WSGI/ASGI server, or runserver's serving
+    process (not its autoreloader). Other management commands, tests included, start no
+    background workers.
+    """
+    if os.path.basename(sys.argv[0]) not in MANAGEMENT_SCRIPTS:
+        return True
+    if sys.argv[1:2] != ['runserver']:
+        return False
+    return os.environ.get('RUN_MAIN') == 'true' or '--noreload' in sys.argv
 
 
 class MlIntegrationConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'ml_integration'
+
+    def ready(self):
+        from .profiles import PROFILE, profile_models  # Checks ML_PROFILE at startup
+
+        # Optionally load and warm up the profile's models at startup instead of on first request
+        if getattr(settings, 'ML_WARMUP_ON_STARTUP', False):
+            from .registry import registry
+            registry.warm_up(profile_models(PROFILE))
+            # Under a preloading server (gunicorn --preload) this runs before the workers fork:
+            # keep the collector away from the loaded models so the workers go on sharing their pages
+            gc.freeze()
+
+        # Run queued jobs, and recover those a restart interrupted, without waiting for a jobs request
+        if PROFILE == 'full' and serves_requests():
+            from .jobs import JOBS_CONFIG, job_worker
+            if JOBS_CONFIG['AUTOSTART']:
+                job_worker.start()
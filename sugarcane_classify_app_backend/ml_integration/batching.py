@@ -0,0 +1,156 @@
+"""
+Dynamic micro-batching for YOLO detection across concurrent requests.
+
+Each detector gets a background thread that collects detection jobs for up
+to WINDOW_MS after the first job arrives (or until MAX_BATCH jobs are
+waiting), runs one batched detector call, and resolves every caller's future with
+the boxes for its own image. Larger windows give bigger batches and better
+throughput at the cost of added queue wait; the collected stats show both.
+"""
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+
+from django.conf import settings
+
+from .registry import registry
+
+DEFAULT_BATCHING_CONFIG = {
+    'ENABLED': False,
+    'MAX_BATCH': 16,
+    'WINDOW_MS': 10,
+}
+
+BATCHING_CONFIG = {**DEFAULT_BATCHING_CONFIG, **getattr(settings, 'ML_DETECTION_BATCHING', {})}
+
+# Upper bounds (ms) of the queue wait histogram buckets
+QUEUE_WAIT_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 250, 500, 1000)
+
+
+class DetectionJob:
+    __slots__ = ('image', 'future', 'enqueued_at')
+
+    def __init__(self, image):
+        self.image = image
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class DetectionBatcher:
+    """
+    Collects detection jobs for one detector and runs them as batched YOLO calls.
+    """
+
+    def __init__(self, detector_name, max_batch, window_ms):
+        self.detector_name = detector_name
+        self.max_batch = max_batch
+        self.window = window_ms / 1000.0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.batch_sizes = Counter()
+        self.queue_wait_buckets = Counter()
+        self.queue_wait_count = 0
+        self.queue_wait_sum = 0.0
+        self.queue_wait_max = 0.0
+        self.inference_seconds = 0.0
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run, name=f'detection-batcher-{self.detector_name}', daemon=True
+                    )
+                    self._thread.start()
+
+    def submit(self, image):
+        """
+        Queues one BGR image and returns a Future resolving to (boxes, confidences).
+        """
+        self._ensure_started()
+        job = DetectionJob(image)
+        self._queue.put(job)
+        return job.future
+
+    def detect(self, image):
+        return self.submit(image).result()
+
+    def _collect(self):
+        jobs = [self._queue.get()]
+        deadline = jobs[0].enqueued_at + self.window
+        while len(jobs) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                jobs.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return jobs
+
+    def _run(self):
+        while True:
+            jobs = self._collect()
+            started_at = time.perf_counter()
+            try:
+                outputs = registry.get(self.detector_name).detect([job.image for job in jobs])
+            except Exception as e:
+                for job in jobs:
+                    job.future.set_exception(e)
+            else:
+                outputs = list(outputs)
+                for job, output in zip(jobs, outputs):
+                    job.future.set_result(output)
+                # A backend with a fixed batch dimension may return fewer outputs than images;
+                # fail the rest rather than leave their callers waiting forever
+                if len(outputs) < len(jobs):
+                    error = RuntimeError(
+                        f"Detector '{self.detector_name}' returned {len(outputs)} outputs for {len(jobs)} images")
+                    for job in jobs[len(outputs):]:
+                        job.future.set_exception(error)
+            self._record(jobs, started_at, time.perf_counter())
+
+    def _record(self, jobs, started_at, finished_at):
+        with self._stats_lock:
+            self.batch_sizes[len(jobs)] += 1
+            self.inference_seconds += finished_at - started_at
+            for job in jobs:
+                wait = started_at - job.enqueued_at
+                self.queue_wait_count += 1
+                self.queue_wait_sum += wait
+                self.queue_wait_max = max(self.queue_wait_max, wait)
+                wait_ms = wait * 1000.0
+                bucket = next((b for b in QUEUE_WAIT_BUCKETS_MS if wait_ms <= b), '+Inf')
+                self.queue_wait_buckets[bucket] += 1
+
+    def stats(self):
+        with self._stats_lock:
+            batches = sum(self.batch_sizes.values())
+            return {
+                'max_batch': self.max_batch,
+                'window_ms': self.window * 1000.0,
+                'batches': batches,
+                'jobs': self.queue_wait_count,
+                'mean_batch_size': self.queue_wait_count / batches if batches else None,
+                'batch_sizes': {str(size): count for size, count in sorted(self.batch_sizes.items())},
+                'queue_wait_ms': {
+                    'mean': self.queue_wait_sum / self.queue_wait_count * 1000.0 if self.queue_wait_count else None,
+                    'max': self.queue_wait_max * 1000.0,
+                    'buckets': {str(bucket): self.queue_wait_buckets[bucket] for bucket in QUEUE_WAIT_BUCKETS_MS + ('+Inf',)},
+                },
+                'inference_seconds': self.inference_seconds,
+                'queued': self._queue.qsize(),
+            }
+
+
+detection_batchers = {
+    name: DetectionBatcher(name, BATCHING_CONFIG['MAX_BATCH'], BATCHING_CONFIG['WINDOW_MS'])
+    for name in ('bud_detector', 'stem_detector')
+} if BATCHING_CONFIG['ENABLED'] else {}
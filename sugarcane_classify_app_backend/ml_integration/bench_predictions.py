@@ -0,0 +1,66 @@
+"""
+pytest-benchmark entry points for the prediction endpoints.
+
+Not collected by `manage.py test`; run explicitly from the backend directory:
+
+    pytest ml_integration/bench_predictions.py --benchmark-json=bench.json
+
+Each benchmark replays the tmp/ corpus through the Django test client with
+the prediction cache bypassed, and stores the mean per-stage timings in the
+benchmark's extra_info.
+"""
+import os
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'sugarcane_classify_app_backend.settings')
+django.setup()
+
+import itertools  # noqa: E402
+
+import pytest  # noqa: E402
+from django.conf import settings  # noqa: E402
+from django.test import Client  # noqa: E402
+from django.test.utils import override_settings  # noqa: E402
+
+from ml_integration.benchmark import Replay, load_corpus  # noqa: E402
+from ml_integration.cache import bypass_prediction_cache  # noqa: E402
+
+pytest.importorskip('pytest_benchmark')
+
+
+@pytest.fixture(scope='module')
+def corpus():
+    images = load_corpus()
+    if not images:
+        pytest.skip("No images in the benchmark corpus")
+    return images
+
+
+@pytest.fixture
+def client(tmp_path):
+    with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'], MEDIA_ROOT=str(tmp_path)), \
+            bypass_prediction_cache():
+        yield Client(raise_request_exception=False)
+
+
+@pytest.mark.parametrize('endpoint', [
+    'predict', 'predict-async', 'predict-sugar-production', 'predict-sugar-production-async',
+])
+def test_endpoint(benchmark, corpus, client, endpoint):
+    replay = Replay(endpoint, corpus)
+    status, _, _ = replay.send(client, 0)
+    if status != 200:
+        pytest.skip(f"{endpoint} answered {status}; are its models available?")
+
+    counter = itertools.count(1)
+    stage_totals = {}
+
+    def send():
+        _, _, stages = replay.send(client, next(counter))
+        for name, seconds in stages.items():
+            stage_totals[name] = stage_totals.get(name, 0.0) + seconds
+
+    benchmark(send)
+    calls = next(counter) - 1
+    benchmark.extra_info['stages_ms'] = {name: total / calls * 1000.0 for name, total in stage_totals.items()}
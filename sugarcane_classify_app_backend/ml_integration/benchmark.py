@@ -0,0 +1,263 @@
+"""
+Reproducible end-to-end benchmark for the prediction endpoints.
+
+Replays a corpus of images (by default the JPEGs in tmp/) through the
+Django test client and reports latency percentiles, throughput at a given
+concurrency and the per-stage breakdown collected by ml_integration.timing.
+Sync endpoints are driven from a pool of client threads; async endpoints
+from one event loop with AsyncClient, as an ASGI server would run them.
+The prediction cache is bypassed unless asked for, so every request does
+the full work. Used by `manage.py benchmark_predictions` and by the
+pytest-benchmark module bench_predictions.py.
+"""
+import asyncio
+import contextlib
+import contextvars
+import datetime
+import glob
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import AsyncClient, Client
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from .cache import bypass_prediction_cache
+from .sugar_grid import FEATURES, GRID_CONFIG
+from .timing import STAGES, collect_stages
+
+DEFAULT_CORPUS_DIR = os.path.join(settings.BASE_DIR, 'tmp')
+IMAGE_PATTERNS = ('*.jpg', '*.jpeg', '*.png')
+
+# Endpoint name -> (url name, payload kind, is async)
+ENDPOINTS = {
+    'predict': ('predict_variety', 'variety', False),
+    'predict-async': ('predict_variety_async', 'variety', True),
+    'predict-sugar-production': ('predict_sugar_production', 'sugar', False),
+    'predict-sugar-production-async': ('predict_sugar_production_async', 'sugar', True),
+}
+
+
+def load_corpus(directory=DEFAULT_CORPUS_DIR, limit=None):
+    """
+    Returns [(file_name, bytes), ...] for the images in directory, in a stable order.
+    """
+    paths = sorted(path for pattern in IMAGE_PATTERNS for path in glob.glob(os.path.join(directory, pattern)))
+    corpus = []
+    for path in paths[:limit]:
+        with open(path, 'rb') as f:
+            corpus.append((os.path.basename(path), f.read()))
+    return corpus
+
+
+class Replay:
+    """
+    Builds the i-th request of a replay. Request i pairs corpus image i (bud) with
+    image i + 1 (stem); sugar production inputs come from a seeded generator, uniform
+    over the sugar grid's axes (the input ranges the model is served for).
+    """
+
+    def __init__(self, endpoint, corpus, seed=0):
+        if endpoint not in ENDPOINTS:
+            raise ValueError(f"Unknown endpoint: {endpoint}")
+        url_name, self.kind, self.is_async = ENDPOINTS[endpoint]
+        if self.kind == 'variety' and not corpus:
+            raise ValueError("The variety endpoints need a non-empty image corpus")
+        self.endpoint = endpoint
+        self.path = reverse(url_name)
+        self.corpus = corpus
+        rng = np.random.default_rng(seed)
+        self.sugar_inputs = np.column_stack([
+            rng.uniform(GRID_CONFIG['AXES'][name][0], GRID_CONFIG['AXES'][name][1], 256) for name in FEATURES
+        ])
+
+    def request_kwargs(self, i):
+        if self.kind == 'variety':
+            bud_name, bud_bytes = self.corpus[i % len(self.corpus)]
+            stem_name, stem_bytes = self.corpus[(i + 1) % len(self.corpus)]
+            return {'data': {
+                'bud_image': SimpleUploadedFile(bud_name, bud_bytes, content_type='image/jpeg'),
+                'stem_image': SimpleUploadedFile(stem_name, stem_bytes, content_type='image/jpeg'),
+            }}
+        sunshine, soil_temp, temp_max = self.sugar_inputs[i % len(self.sugar_inputs)]
+        return {
+            'data': json.dumps({'sunshine': sunshine, 'soil_temp': soil_temp, 'temp_max': temp_max}),
+            'content_type': 'application/json',
+        }
+
+    def send(self, client, i):
+        """
+        Sends request i with a sync Client; returns (status, seconds, stage_seconds).
+        """
+        kwargs = self.request_kwargs(i)
+        with collect_stages() as timings:
+            start = time.perf_counter()
+            response = client.post(self.path, **kwargs)
+            elapsed = time.perf_counter() - start
+        return response.status_code, elapsed, timings.seconds
+
+    async def send_async(self, client, i):
+        kwargs = self.request_kwargs(i)
+        with collect_stages() as timings:
+            start = time.perf_counter()
+            response = await client.post(self.path, **kwargs)
+            elapsed = time.perf_counter() - start
+        return response.status_code, elapsed, timings.seconds
+
+
+def _run_threads(replay, indices, concurrency):
+    local = threading.local()
+    # Client threads run in copies of this context, so bypass_prediction_cache() applies to them
+    context = contextvars.copy_context()
+
+    def send(i):
+        if not hasattr(local, 'client'):
+            local.client = Client(raise_request_exception=False)
+        return context.copy().run(replay.send, local.client, i)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(send, indices))
+
+
+async def _run_event_loop(replay, indices, concurrency):
+    client = AsyncClient(raise_request_exception=False)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(i):
+        async with semaphore:
+            return await replay.send_async(client, i)
+
+    return await asyncio.gather(*(send(i) for i in indices))
+
+
+def percentiles_ms(seconds):
+    """
+    Returns mean / p50 / p95 / p99 / max of a list of durations, in milliseconds.
+    """
+    if not len(seconds):
+        return None
+    values = np.asarray(seconds, dtype=float) * 1000.0
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'mean': float(values.mean()), 'p50': float(p50), 'p95': float(p95),
+            'p99': float(p99), 'max': float(values.max())}
+
+
+def summarize(endpoint, concurrency, results, wall_seconds):
+    statuses = {}
+    for status, _, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    stage_names = list(STAGES) + sorted({name for _, _, stages in results for name in stages} - set(STAGES))
+    return {
+        'endpoint': endpoint,
+        'concurrency': concurrency,
+        'requests': len(results),
+        'statuses': statuses,
+        'wall_seconds': wall_seconds,
+        'throughput_rps': len(results) / wall_seconds if wall_seconds else None,
+        'latency_ms': percentiles_ms([elapsed for _, elapsed, _ in results]),
+        # Summed per request; a stage a request never reached counts as zero
+        'stages_ms': {
+            name: percentiles_ms([stages.get(name, 0.0) for _, _, stages in results])
+            for name in stage_names
+            if any(name in stages for _, _, stages in results)
+        },
+    }
+
+
+def run_benchmark(endpoint, corpus, requests=100, concurrency=1, warmup=5, use_cache=False, seed=0):
+    """
+    Replays `requests` requests against one endpoint at the given concurrency and
+    returns the summary. The first `warmup` requests run sequentially and are not measured.
+    """
+    if requests < 1 or concurrency < 1:
+        raise ValueError("requests and concurrency must be at least 1")
+    # Crops saved by the views go to a scratch MEDIA_ROOT instead of the working tree
+    with tempfile.TemporaryDirectory() as media_root, \
+            override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'], MEDIA_ROOT=media_root):
+        replay = Replay(endpoint, corpus, seed=seed)
+        with contextlib.nullcontext() if use_cache else bypass_prediction_cache():
+            warmup_client = Client(raise_request_exception=False)
+            for i in range(warmup):
+                replay.send(warmup_client, i)
+
+            indices = range(warmup, warmup + requests)
+            start = time.perf_counter()
+            if replay.is_async:
+                results = asyncio.run(_run_event_loop(replay, indices, concurrency))
+            else:
+                results = _run_threads(replay, indices, concurrency)
+            wall_seconds = time.perf_counter() - start
+    return summarize(endpoint, concurrency, results, wall_seconds)
+
+
+# ============================
+# Run Metadata and Comparison
+# ============================
+
+def git_revision():
+    """
+    Returns (commit, dirty) for the working tree, or (None, None) outside a git checkout.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=settings.BASE_DIR,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def run_metadata(corpus_dir=None, corpus=None):
+    commit, dirty = git_revision()
+    meta = {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'git_commit': commit,
+        'git_dirty': dirty,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'settings': {
+            name: getattr(settings, name, None)
+            for name in ('ML_DETECTOR_BACKEND', 'ML_DETECTOR_INT8', 'ML_USE_COMPILED_CLASSIFIERS',
+                         'ML_INFERENCE_POOL', 'ML_DETECTION_BATCHING')
+        },
+    }
+    if corpus is not None:
+        meta['corpus'] = {'directory': str(corpus_dir), 'images': len(corpus)}
+    return meta
+
+
+def compare_runs(baseline, current):
+    """
+    Returns one line per (endpoint, concurrency) present in both reports, with
+    relative changes in p50 / p95 / p99 latency and throughput. Runs without
+    latencies (no measured requests) are skipped.
+    """
+    previous = {(run['endpoint'], run['concurrency']): run for run in baseline['runs']}
+    lines = []
+    for run in current['runs']:
+        before = previous.get((run['endpoint'], run['concurrency']))
+        if before is None or not before.get('latency_ms') or not run.get('latency_ms'):
+            continue
+        changes = [
+            f"{key} {before['latency_ms'][key]:.1f} -> {run['latency_ms'][key]:.1f} ms "
+            f"({(run['latency_ms'][key] / before['latency_ms'][key] - 1) * 100:+.1f}%)"
+            for key in ('p50', 'p95', 'p99')
+        ]
+        if before['throughput_rps'] and run['throughput_rps']:
+            changes.append(
+                f"throughput {before['throughput_rps']:.1f} -> {run['throughput_rps']:.1f} rps "
+                f"({(run['throughput_rps'] / before['throughput_rps'] - 1) * 100:+.1f}%)"
+            )
+        lines.append(f"{run['endpoint']} @ {run['concurrency']}: " + ', '.join(changes))
+    return lines
@@ -0,0 +1,301 @@
+"""
+Bulk sugar production forecasting: chunked readers and streaming writers.
+
+A bulk request body is read as a stream of (N, 3) float64 chunks of
+(sunshine, soil_temp, temp_max) rows, each chunk is validated and scored
+with one model call, and the results are written back chunk by chunk, so
+memory stays proportional to CHUNK_ROWS for CSV and Arrow bodies whatever
+the input size. JSON bodies have to be parsed whole before the first chunk.
+
+Rows with a missing, non-numeric or non-finite value are not scored; they
+get a null prediction in the output and are counted in invalid_rows.
+
+Input formats (by Content-Type):
+    application/json                     [{"sunshine": .., "soil_temp": .., "temp_max": ..}, ...],
+                                         [[sunshine, soil_temp, temp_max], ...] or
+                                         {"sunshine": [..], "soil_temp": [..], "temp_max": [..]}
+    text/csv                             header row naming the three columns, in any order
+    application/vnd.apache.arrow.stream  Arrow IPC stream with the three columns (needs pyarrow)
+"""
+import csv
+import io
+import itertools
+import json
+import math
+
+import numpy as np
+from django.conf import settings
+
+from .forecast import predict_sugar_production_batch
+
+FEATURES = ('sunshine', 'soil_temp', 'temp_max')
+
+CHUNK_ROWS = getattr(settings, 'ML_SUGAR_BULK_CHUNK_ROWS', 65536)
+
+ARROW_CONTENT_TYPE = 'application/vnd.apache.arrow.stream'
+CONTENT_TYPES = {
+    'application/json': 'json',
+    'text/csv': 'csv',
+    ARROW_CONTENT_TYPE: 'arrow',
+}
+OUTPUT_CONTENT_TYPES = {
+    'json': 'application/json',
+    'csv': 'text/csv; charset=utf-8',
+    'arrow': ARROW_CONTENT_TYPE,
+}
+
+
+class BulkInputError(ValueError):
+    """
+    Raised before streaming starts when a bulk request body cannot be read.
+    """
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc  # noqa: F401
+    except ImportError:
+        raise BulkInputError("Arrow bodies require pyarrow to be installed")
+    return pyarrow
+
+
+def to_float_matrix(columns):
+    """
+    Converts three equal-length sequences (numbers or strings) into an (N, 3) float64 array.
+    Values that are missing or not numeric become NaN.
+    """
+    matrix = np.empty((len(columns[0]), len(columns)), dtype=np.float64)
+    for j, column in enumerate(columns):
+        try:
+            matrix[:, j] = np.asarray(column, dtype=np.float64)
+        except (TypeError, ValueError):
+            # Slow path for a chunk with at least one bad value
+            matrix[:, j] = [_to_float(value) for value in column]
+    return matrix
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+# ============================
+# Readers
+# ============================
+
+def iter_json_chunks(stream, chunk_rows=CHUNK_ROWS):
+    try:
+        data = json.load(stream)
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise BulkInputError(f"Invalid JSON body: {str(e)}")
+
+    if isinstance(data, dict):
+        missing = [name for name in FEATURES if name not in data]
+        if missing:
+            raise BulkInputError(f"Missing columns: {', '.join(missing)}")
+        columns = [data[name] for name in FEATURES]
+        if not all(isinstance(column, list) for column in columns) or len({len(c) for c in columns}) != 1:
+            raise BulkInputError("Columns must be arrays of equal length")
+        for start in range(0, len(columns[0]), chunk_rows):
+            yield to_float_matrix([column[start:start + chunk_rows] for column in columns])
+        return
+
+    if not isinstance(data, list):
+        raise BulkInputError("Expected a JSON array of rows or an object of columns")
+    for start in range(0, len(data), chunk_rows):
+        rows = data[start:start + chunk_rows]
+        columns = [[], [], []]
+        for row in rows:
+            if isinstance(row, dict):
+                values = [row.get(name) for name in FEATURES]
+            elif isinstance(row, list) and len(row) == len(FEATURES):
+                values = row
+            else:
+                values = (None, None, None)
+            for column, value in zip(columns, values):
+                column.append(value)
+        yield to_float_matrix(columns)
+
+
+def _decoded_lines(stream):
+    # The request stream yields raw lines; decode them one at a time so the body is never held whole.
+    # Rows are decoded leniently: the response is already streaming when they are read, and a row
+    # with invalid UTF-8 fails validation (a null prediction) like any other bad row
+    for number, line in enumerate(stream):
+        yield line.decode('utf-8-sig') if number == 0 else line.decode('utf-8', errors='replace')
+
+
+def _parse_csv_lines(lines, indices):
+    try:
+        # Fast path: NumPy's C parser, for plain unquoted numeric rows
+        return np.loadtxt(lines, dtype=np.float64, delimiter=',', usecols=indices, comments=None, ndmin=2)
+    except ValueError:
+        pass
+    width = max(indices) + 1
+    columns = [[], [], []]
+    for row in csv.reader(lines):
+        if not row:
+            continue
+        if len(row) < width:
+            row = row + [''] * (width - len(row))
+        for column, index in zip(columns, indices):
+            column.append(row[index])
+    return to_float_matrix(columns)
+
+
+def iter_csv_chunks(stream, chunk_rows=CHUNK_ROWS):
+    lines = _decoded_lines(stream)
+    try:
+        header = [name.strip() for name in next(csv.reader([next(lines)]))]
+    except StopIteration:
+        return
+    except UnicodeDecodeError as e:
+        raise BulkInputError(f"CSV body is not valid UTF-8: {str(e)}")
+    missing = [name for name in FEATURES if name not in header]
+    if missing:
+        raise BulkInputError(f"Missing CSV columns: {', '.join(missing)}")
+    indices = [header.index(name) for name in FEATURES]
+
+    while True:
+        chunk = list(itertools.islice(lines, chunk_rows))
+        if not chunk:
+            return
+        matrix = _parse_csv_lines(chunk, indices)
+        if len(matrix):
+            yield matrix
+
+
+def iter_arrow_chunks(stream, chunk_rows=CHUNK_ROWS):
+    pa = _import_pyarrow()
+    try:
+        reader = pa.ipc.open_stream(stream)
+    except pa.ArrowInvalid as e:
+        raise BulkInputError(f"Invalid Arrow IPC stream: {str(e)}")
+    missing = [name for name in FEATURES if reader.schema.get_field_index(name) < 0]
+    if missing:
+        raise BulkInputError(f"Missing Arrow columns: {', '.join(missing)}")
+    for batch in reader:
+        for start in range(0, batch.num_rows, chunk_rows):
+            part = batch.slice(start, chunk_rows)
+            matrix = np.empty((part.num_rows, len(FEATURES)), dtype=np.float64)
+            for j, name in enumerate(FEATURES):
+                # Nulls become NaN, so they fail validation like any other missing value
+                column = part.column(name).cast(pa.float64()).fill_null(np.nan)
+                matrix[:, j] = column.to_numpy(zero_copy_only=False)
+            yield matrix
+
+
+READERS = {
+    'json': iter_json_chunks,
+    'csv': iter_csv_chunks,
+    'arrow': iter_arrow_chunks,
+}
+
+
+def predict_chunk(X):
+    """
+    Scores the valid rows of an (N, 3) chunk in one model call.
+    Returns (predictions, valid) where predictions is NaN for invalid rows.
+    """
+    valid = np.isfinite(X).all(axis=1)
+    predictions = np.full(len(X), np.nan)
+    if valid.any():
+        predictions[valid] = predict_sugar_production_batch(X[valid])
+    return predictions, valid
+
+
+# ============================
+# Writers
+# ============================
+
+def write_json(scored_chunks):
+    rows = invalid = 0
+    yield '{"unit": "tons", "predictions": ['
+    for _, predictions, valid in scored_chunks:
+        values = np.round(predictions, 2).astype(object)
+        values[~valid] = None
+        body = json.dumps(values.tolist())[1:-1]
+        if body:
+            yield (', ' if rows else '') + body
+        rows += len(predictions)
+        invalid += int((~valid).sum())
+    yield f'], "rows": {rows}, "invalid_rows": {invalid}}}'
+
+
+def _csv_value(value):
+    return '' if math.isnan(value) else repr(value)
+
+
+def write_csv(scored_chunks):
+    yield ','.join(FEATURES + ('predicted_sugar_production',)) + '\r\n'
+    for X, predictions, valid in scored_chunks:
+        lines = [
+            f'{sunshine!r},{soil_temp!r},{temp_max!r},{prediction:.2f}\r\n'
+            for sunshine, soil_temp, temp_max, prediction in zip(*X.T.tolist(), predictions.tolist())
+        ]
+        for i in np.flatnonzero(~valid).tolist():
+            lines[i] = ','.join(_csv_value(value) for value in X[i].tolist()) + ',\r\n'
+        yield ''.join(lines)
+
+
+class _ChunkSink(io.RawIOBase):
+    """
+    Write-only file object collecting the Arrow writer's output between yields.
+    """
+
+    def __init__(self):
+        self.parts = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data, self.parts = b''.join(self.parts), []
+        return data
+
+
+def write_arrow(scored_chunks):
+    pa = _import_pyarrow()
+    schema = pa.schema([(name, pa.float64()) for name in FEATURES] + [('predicted_sugar_production', pa.float64())])
+    sink = _ChunkSink()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        for X, predictions, valid in scored_chunks:
+            arrays = [pa.array(X[:, j]) for j in range(len(FEATURES))]
+            arrays.append(pa.array(np.round(predictions, 2), mask=~valid))
+            writer.write_batch(pa.record_batch(arrays, schema=schema))
+            yield sink.drain()
+    yield sink.drain()
+
+
+WRITERS = {
+    'json': write_json,
+    'csv': write_csv,
+    'arrow': write_arrow,
+}
+
+
+def bulk_predictions(stream, input_format, output_format, chunk_rows=CHUNK_ROWS):
+    """
+    Returns an iterator over the encoded response body for a bulk request.
+    The first chunk is read eagerly, so malformed bodies raise BulkInputError
+    before any of the response has been sent.
+    """
+    if output_format == 'arrow' or input_format == 'arrow':
+        _import_pyarrow()
+    chunks = READERS[input_format](stream, chunk_rows)
+    first = next(chunks, None)
+
+    def scored():
+        for X in ([first] if first is not None else []):
+            yield (X,) + predict_chunk(X)
+        for X in chunks:
+            yield (X,) + predict_chunk(X)
+
+    return WRITERS[output_format](scored())
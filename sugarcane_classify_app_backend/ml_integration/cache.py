@@ -0,0 +1,164 @@
+"""
+Content-hash cache for variety predictions.
+
+Entries are keyed by a hash of the raw bud and stem upload bytes plus a
+fingerprint of the model files, so a retried upload of the same photos is
+answered without running detection, feature extraction or classification,
+and replacing a model file invalidates every cached prediction.
+"""
+import contextlib
+import contextvars
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .registry import registry
+from .uploads import upload_buffer
+
+DEFAULT_CACHE_CONFIG = {
+    'ENABLED': True,
+    'BACKEND': 'locmem',  # 'locmem' (in-process) or 'django' (Django cache framework)
+    'ALIAS': 'default',   # Django cache alias used by the 'django' backend
+    'MAX_ENTRIES': 256,
+    'TTL': 3600,          # Seconds
+}
+
+CACHE_CONFIG = {**DEFAULT_CACHE_CONFIG, **getattr(settings, 'ML_PREDICTION_CACHE', {})}
+
+# Models whose files affect a variety prediction
+VARIETY_MODELS = ['bud_detector', 'bud_classifier', 'stem_detector', 'stem_classifier']
+
+
+def hash_uploads(*uploaded_files, fingerprint=''):
+    """
+    Returns a hex digest over the raw bytes of the uploaded files and a model fingerprint.
+    """
+    h = hashlib.blake2b(digest_size=20)
+    for uploaded_file in uploaded_files:
+        # Length-prefix each part so (a, bc) and (ab, c) never collide
+        h.update(uploaded_file.size.to_bytes(8, 'little'))
+        if hasattr(uploaded_file, 'temporary_file_path'):
+            for chunk in uploaded_file.chunks():
+                h.update(chunk)
+        else:
+            h.update(upload_buffer(uploaded_file))
+    h.update(fingerprint.encode('utf-8'))
+    return h.hexdigest()
+
+
+class LocMemPredictionCache:
+    """
+    In-process LRU cache with per-entry TTL.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DjangoPredictionCache:
+    """
+    Stores entries in a Django cache (e.g. file-based locally, Redis/Memcached in production).
+    Eviction follows the configured cache backend; entries expire after TTL seconds.
+
+    The alias may be shared with other users of the cache, so entries are namespaced by
+    a generation number kept in the cache itself: clear() moves to the next generation,
+    leaving the old entries unreachable until they expire, and never touches other keys.
+    """
+
+    GENERATION_KEY = 'prediction:generation'
+
+    def __init__(self, alias, ttl):
+        self.alias = alias
+        self.ttl = ttl
+
+    @property
+    def _cache(self):
+        from django.core.cache import caches
+        return caches[self.alias]
+
+    def _key(self, key):
+        generation = self._cache.get_or_set(self.GENERATION_KEY, 1, timeout=None)
+        return f'prediction:{generation}:{key}'
+
+    def get(self, key):
+        return self._cache.get(self._key(key))
+
+    def set(self, key, value):
+        self._cache.set(self._key(key), value, timeout=self.ttl)
+
+    def clear(self):
+        try:
+            self._cache.incr(self.GENERATION_KEY)
+        except ValueError:  # No generation stored yet (or it was evicted)
+            self._cache.set(self.GENERATION_KEY, 2, timeout=None)
+
+
+def _build_cache():
+    if not CACHE_CONFIG['ENABLED']:
+        return None
+    if CACHE_CONFIG['BACKEND'] == 'django':
+        return DjangoPredictionCache(CACHE_CONFIG['ALIAS'], CACHE_CONFIG['TTL'])
+    if CACHE_CONFIG['BACKEND'] == 'locmem':
+        return LocMemPredictionCache(CACHE_CONFIG['MAX_ENTRIES'], CACHE_CONFIG['TTL'])
+    raise ValueError(f"Unknown prediction cache backend: {CACHE_CONFIG['BACKEND']}")
+
+
+prediction_cache = _build_cache()
+
+_bypassed = contextvars.ContextVar('prediction_cache_bypassed', default=False)
+
+
+@contextlib.contextmanager
+def bypass_prediction_cache():
+    """
+    Makes every request handled inside the block (in this context, and in threads and tasks
+    given a copy of it) miss the cache and skip storing, e.g. while benchmarking. Concurrent
+    requests in other contexts keep using the cache.
+    """
+    token = _bypassed.set(True)
+    try:
+        yield
+    finally:
+        _bypassed.reset(token)
+
+
+def variety_cache_key(bud_image_file, stem_image_file, variant=''):
+    """
+    Returns the cache key for a bud/stem upload pair, or None when caching is disabled.
+    variant separates entries holding different response bodies (e.g. 'lean').
+    """
+    if prediction_cache is None or _bypassed.get():
+        return None
+    fingerprint = registry.fingerprint(VARIETY_MODELS)
+    if variant:
+        fingerprint += f"|response:{variant}"
+    return hash_uploads(bud_image_file, stem_image_file, fingerprint=fingerprint)
@@ -0,0 +1,125 @@
+"""
+Buffered writing of record chunks as .npy files, for the feature store and
+the shadow comparison records.
+
+Rows are buffered per stream (e.g. per organ) and handed to a background
+writer thread as one chunk once chunk_rows have accumulated, or
+flush_interval seconds after the stream's first buffered row, whether or not
+more rows arrive. Requests therefore never wait for np.save, and a quiet
+process does not hold rows in memory until its next request. Each chunk is
+named <time>-<pid>-<n>, so every process writes its own, and each file is
+written under a .tmp.npy name and renamed into place, so readers never see a
+partial file. Buffered rows are flushed when the process exits normally.
+"""
+import atexit
+import logging
+import multiprocessing.util
+import os
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def save_npy(directory, name, array):
+    """
+    Writes array to <directory>/<name>.npy through a temporary file renamed into place.
+    """
+    temporary = os.path.join(directory, name + '.tmp.npy')
+    np.save(temporary, array)
+    os.replace(temporary, os.path.join(directory, name + '.npy'))
+
+
+class ChunkWriter:
+    """
+    Buffers parts (whatever write accepts) per stream and calls write(stream, parts, name)
+    once per chunk, from a writer thread or from flush().
+    """
+
+    def __init__(self, write, chunk_rows, flush_interval, name='chunk-writer'):
+        self.write = write
+        self.chunk_rows = chunk_rows
+        self.flush_interval = flush_interval
+        self.name = name
+        self._pending = {}
+        self._pending_rows = {}
+        self._pending_since = {}
+        self._ready = []
+        self._condition = threading.Condition()
+        self._write_lock = threading.Lock()  # Held while writing, so flush() also waits for a chunk in flight
+        self._chunks_written = 0
+        self._pid = None
+
+    def add(self, stream, part, rows):
+        """
+        Buffers a part of rows rows for a stream.
+        """
+        self._start()
+        with self._condition:
+            self._pending.setdefault(stream, []).append(part)
+            self._pending_rows[stream] = self._pending_rows.get(stream, 0) + rows
+            self._pending_since.setdefault(stream, time.monotonic())
+            if self._pending_rows[stream] >= self.chunk_rows:
+                self._ready.append((stream, self._take(stream)))
+            self._condition.notify()
+
+    def flush(self):
+        """
+        Writes every buffered row in the calling thread, after any chunk being written.
+        """
+        with self._write_lock:
+            with self._condition:
+                chunks = self._ready + [(stream, self._take(stream)) for stream in list(self._pending)]
+                self._ready = []
+            self._write_chunks(chunks)
+
+    def _take(self, stream):
+        self._pending_rows.pop(stream, None)
+        self._pending_since.pop(stream, None)
+        return self._pending.pop(stream, [])
+
+    def _start(self):
+        # Once per process: a forked process inherits neither the thread nor the exit hooks
+        if self._pid == os.getpid():
+            return
+        with self._condition:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name=self.name, daemon=True).start()
+            # atexit covers server processes; inference pool workers exit through multiprocessing's finalizers instead
+            atexit.register(self.flush)
+            multiprocessing.util.Finalize(self, self.flush, exitpriority=10)
+
+    def _wait_for_chunks(self):
+        with self._condition:
+            while not self._ready:
+                now = time.monotonic()
+                for stream, since in list(self._pending_since.items()):
+                    if now - since >= self.flush_interval:
+                        self._ready.append((stream, self._take(stream)))
+                if self._ready:
+                    break
+                deadlines = [since + self.flush_interval - now for since in self._pending_since.values()]
+                self._condition.wait(min(deadlines) if deadlines else None)
+
+    def _run(self):
+        while True:
+            self._wait_for_chunks()
+            with self._write_lock:
+                with self._condition:
+                    chunks, self._ready = self._ready, []  # Empty if flush() took them meanwhile
+                self._write_chunks(chunks)
+
+    def _write_chunks(self, chunks):
+        for stream, parts in chunks:
+            if not parts:
+                continue
+            self._chunks_written += 1
+            name = f"{time.time_ns():020d}-{os.getpid()}-{self._chunks_written}"
+            try:
+                self.write(stream, parts, name)
+            except Exception:
+                logger.exception("Failed to write chunk %s of %s", name, self.name)
@@ -0,0 +1,260 @@
+"""
+Compiled, array-backed inference for the bud RF and stem XGBoost classifiers.
+
+compile_classifier() flattens every tree of a fitted sklearn
+RandomForestClassifier or multi-class XGBClassifier into a handful of
+contiguous NumPy arrays (split feature, threshold, children, leaf values).
+CompiledForest.predict_proba() then walks all trees for all samples at once,
+one vectorised step per tree level, and needs neither sklearn nor xgboost at
+runtime. Compiled models are saved as .npz files next to the pickles by
+`manage.py compile_classifiers` and picked up by the model registry when
+ML_USE_COMPILED_CLASSIFIERS is enabled.
+"""
+import json
+
+import numpy as np
+
+SKLEARN_FOREST = 'sklearn_forest'
+XGBOOST_SOFTPROB = 'xgboost_softprob'
+
+
+class CompiledForest:
+    """
+    Flattened tree ensemble with a predict_proba / predict interface matching the source model.
+
+    Nodes of all trees live in shared arrays; children holds each node's
+    (left, right) pair and leaves point back at themselves, so every sample can
+    take max_depth steps without masking. For sklearn forests, leaf_values holds
+    each leaf's normalised class distribution and samples go left when
+    x <= threshold. For XGBoost, leaf_values holds the leaf weight, tree_classes
+    the class each tree contributes to, samples go left when x < threshold, and
+    missing values (NaN) follow default_left.
+    """
+
+    def __init__(self, kind, feature, threshold, children, default_left, leaf_values, roots,
+                 max_depth, classes, tree_classes=None, base_margin=None):
+        self.kind = kind
+        self.feature = feature
+        self.threshold = threshold
+        self.children = children
+        self.default_left = default_left
+        self.leaf_values = leaf_values
+        self.roots = roots
+        self.max_depth = int(max_depth)
+        self.classes_ = classes
+        self.tree_classes = tree_classes
+        self.base_margin = base_margin
+        if tree_classes is not None:
+            # One-hot (n_trees, n_classes), so summing leaf weights per class is one matmul
+            self._class_matrix = np.eye(len(classes))[tree_classes]
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    @property
+    def n_nodes(self):
+        return len(self.feature)
+
+    def apply(self, X):
+        """
+        Returns the leaf index reached by every sample in every tree, shape (n_samples, n_trees).
+        """
+        # Both libraries compare float32 features against their thresholds
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        n_samples, n_features = X.shape
+        flat = X.ravel()
+        row_offsets = (np.arange(n_samples, dtype=np.intp) * n_features)[:, None]
+        nodes = np.broadcast_to(self.roots, (n_samples, self.n_trees)).astype(np.intp)
+        for _ in range(self.max_depth):
+            values = flat[row_offsets + self.feature[nodes]]
+            if self.kind == SKLEARN_FOREST:
+                go_right = ~(values <= self.threshold[nodes])
+            else:
+                go_right = ~(values < self.threshold[nodes])
+                missing = np.isnan(values)
+                if missing.any():
+                    go_right[missing] = ~self.default_left[nodes[missing]]
+            nodes = self.children[2 * nodes + go_right]
+        return nodes
+
+    def predict_proba(self, X):
+        leaves = self.apply(X)
+        if self.kind == SKLEARN_FOREST:
+            return self.leaf_values[leaves].sum(axis=1) / self.n_trees
+        margin = self.leaf_values[leaves] @ self._class_matrix + self.base_margin
+        margin -= margin.max(axis=1, keepdims=True)
+        exp = np.exp(margin)
+        return exp / exp.sum(axis=1, keepdims=True)
+
+    def predict(self, X):
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
+
+    def save(self, path):
+        arrays = {
+            'kind': np.array(self.kind),
+            'feature': self.feature,
+            'threshold': self.threshold,
+            'children': self.children,
+            'default_left': self.default_left,
+            'leaf_values': self.leaf_values,
+            'roots': self.roots,
+            'max_depth': np.array(self.max_depth),
+            'classes': self.classes_,
+        }
+        if self.tree_classes is not None:
+            arrays.update(tree_classes=self.tree_classes, base_margin=self.base_margin)
+        # Write through a file object so numpy does not append another .npz suffix
+        with open(path, 'wb') as f:
+            np.savez(f, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(
+                str(data['kind']),
+                data['feature'].astype(np.intp),
+                data['threshold'],
+                data['children'].astype(np.intp),
+                data['default_left'],
+                data['leaf_values'],
+                data['roots'].astype(np.intp),
+                data['max_depth'],
+                data['classes'],
+                data['tree_classes'] if 'tree_classes' in data else None,
+                data['base_margin'] if 'base_margin' in data else None,
+            )
+
+
+def _flatten_children(left, right, offset):
+    """
+    Returns (feature_mask, interleaved children) for one tree, with leaves pointing at themselves.
+    """
+    is_leaf = left < 0
+    nodes = np.arange(len(left)) + offset
+    children = np.stack((np.where(is_leaf, nodes, left + offset), np.where(is_leaf, nodes, right + offset)), axis=1)
+    return is_leaf, children.ravel()
+
+
+def _tree_depth(left, right, root):
+    depth, frontier = 0, [root]
+    while frontier:
+        frontier = [child for node in frontier for child in (left[node], right[node]) if child >= 0]
+        if frontier:
+            depth += 1
+    return depth
+
+
+def compile_sklearn_forest(model):
+    """
+    Compiles a fitted sklearn RandomForestClassifier (or ExtraTreesClassifier).
+    """
+    n_classes = len(model.classes_)
+    features, thresholds, children, values, roots = [], [], [], [], []
+    offset, max_depth = 0, 0
+    for estimator in model.estimators_:
+        tree = estimator.tree_
+        is_leaf, tree_children = _flatten_children(tree.children_left, tree.children_right, offset)
+        roots.append(offset)
+        features.append(np.where(is_leaf, 0, tree.feature))
+        thresholds.append(tree.threshold)
+        children.append(tree_children)
+        # Same normalisation as DecisionTreeClassifier.predict_proba
+        value = tree.value[:, 0, :n_classes].astype(np.float64)
+        normalizer = value.sum(axis=1, keepdims=True)
+        normalizer[normalizer == 0.0] = 1.0
+        values.append(np.where(is_leaf[:, None], value / normalizer, 0.0))
+        max_depth = max(max_depth, tree.max_depth)
+        offset += tree.node_count
+    return CompiledForest(
+        SKLEARN_FOREST,
+        np.concatenate(features).astype(np.intp),
+        np.concatenate(thresholds).astype(np.float64),
+        np.concatenate(children).astype(np.intp),
+        np.zeros(offset, dtype=bool),
+        np.concatenate(values),
+        np.array(roots, dtype=np.intp),
+        max_depth,
+        np.asarray(model.classes_),
+    )
+
+
+def _parse_base_score(value, n_classes):
+    values = [float(v) for v in value.strip('[]').split(',') if v]
+    return np.array(values * n_classes if len(values) == 1 else values, dtype=np.float64)
+
+
+def compile_xgboost(model):
+    """
+    Compiles a fitted multi-class XGBClassifier (multi:softprob / multi:softmax).
+    """
+    booster = model.get_booster()
+    learner = json.loads(booster.save_raw('json').decode('utf-8'))['learner']
+    objective = learner['objective']['name']
+    if objective not in ('multi:softprob', 'multi:softmax'):
+        raise ValueError(f"Unsupported XGBoost objective for compilation: {objective}")
+    n_classes = int(learner['learner_model_param']['num_class'])
+    gbtree = learner['gradient_booster']
+    if gbtree.get('name') != 'gbtree':
+        raise ValueError(f"Unsupported XGBoost booster for compilation: {gbtree.get('name')}")
+    trees_json = gbtree['model']['trees']
+    tree_info = gbtree['model']['tree_info']
+
+    # Same tree range XGBClassifier.predict_proba uses (early stopping keeps trees past the best round)
+    begin, end = model._get_iteration_range(None)
+    if end > begin:
+        indptr = gbtree['model']['iteration_indptr']
+        tree_range = range(indptr[begin], indptr[end])
+    else:
+        tree_range = range(len(trees_json))
+
+    features, thresholds, children, defaults, values, roots, tree_classes = [], [], [], [], [], [], []
+    offset, max_depth = 0, 0
+    for tree_index in tree_range:
+        tree = trees_json[tree_index]
+        if any(tree['split_type']):
+            raise ValueError("Categorical splits are not supported for compilation")
+        left = np.asarray(tree['left_children'], dtype=np.int64)
+        right = np.asarray(tree['right_children'], dtype=np.int64)
+        is_leaf, tree_children = _flatten_children(left, right, offset)
+        # Leaf weights are stored in split_conditions
+        conditions = np.asarray(tree['split_conditions'], dtype=np.float32)
+        roots.append(offset)
+        features.append(np.where(is_leaf, 0, np.asarray(tree['split_indices'], dtype=np.int64)))
+        thresholds.append(conditions)
+        children.append(tree_children)
+        defaults.append(np.asarray(tree['default_left'], dtype=bool))
+        values.append(np.where(is_leaf, conditions, 0.0).astype(np.float64))
+        tree_classes.append(tree_info[tree_index])
+        max_depth = max(max_depth, _tree_depth(left, right, 0))
+        offset += len(left)
+
+    base_margin = _parse_base_score(learner['learner_model_param']['base_score'], n_classes)
+    return CompiledForest(
+        XGBOOST_SOFTPROB,
+        np.concatenate(features).astype(np.intp),
+        np.concatenate(thresholds).astype(np.float32),
+        np.concatenate(children).astype(np.intp),
+        np.concatenate(defaults),
+        np.concatenate(values),
+        np.array(roots, dtype=np.intp),
+        max_depth,
+        np.asarray(model.classes_),
+        np.array(tree_classes, dtype=np.intp),
+        base_margin,
+    )
+
+
+def compile_classifier(model):
+    """
+    Compiles a fitted sklearn forest or XGBoost classifier into a CompiledForest.
+    """
+    if hasattr(model, 'get_booster'):
+        return compile_xgboost(model)
+    if hasattr(model, 'estimators_') and hasattr(model.estimators_[0], 'tree_'):
+        return compile_sklearn_forest(model)
+    raise ValueError(f"Unsupported classifier for compilation: {type(model).__name__}")
+
+
+def compiled_path(model_path):
+    return model_path + '.compiled.npz'
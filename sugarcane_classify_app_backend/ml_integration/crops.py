@@ -0,0 +1,156 @@
+"""
+Content-addressed store for the crop thumbnails referenced by lean responses.
+
+In the lean response mode the variety endpoints return a crop id and box for
+each organ instead of a base64 JPEG. The crop is downscaled to MAX_SIZE,
+encoded once as FORMAT and written under DIR, and /api/crops/<id> serves it.
+The id is a hash of the crop pixels and the encoding settings, so the same
+crop is only ever encoded once and a served file never changes: responses
+carry the id as a strong ETag and are cacheable for MAX_AGE seconds.
+
+The store is bounded by purge_crops() (the purge_crops command, e.g. run
+from cron): crops last referenced by a response (their mtime, refreshed
+whenever a stored crop is stored again) more than RETENTION seconds ago are
+deleted, then the least recently referenced ones until the store holds at
+most MAX_BYTES. A purged crop's URL answers 404; clients are expected to
+fetch crops soon after the response that referenced them. RETENTION should
+stay well above the prediction cache TTL, since cache hits reference crops
+without storing them again.
+"""
+import hashlib
+import os
+import re
+import time
+
+import cv2
+from django.conf import settings
+from django.urls import reverse
+
+from .timing import stage
+
+DEFAULT_CROPS_CONFIG = {
+    'DIR': os.path.join(settings.BASE_DIR, 'cache', 'crops'),
+    'FORMAT': 'webp',             # 'webp' or 'jpeg'
+    'QUALITY': 80,
+    'MAX_SIZE': 320,              # Longest side in pixels; smaller crops are not upscaled
+    'MAX_AGE': 365 * 24 * 3600,   # Cache-Control max-age for served crops
+    'RETENTION': 7 * 24 * 3600,   # Seconds a crop is kept after it was last referenced (None: no age limit)
+    'MAX_BYTES': 1024 ** 3,       # Total size the store is purged down to (None: no size limit)
+}
+
+CROPS_CONFIG = {**DEFAULT_CROPS_CONFIG, **getattr(settings, 'ML_CROPS', {})}
+
+FORMATS = {
+    'webp': ('.webp', 'image/webp', cv2.IMWRITE_WEBP_QUALITY),
+    'jpeg': ('.jpg', 'image/jpeg', cv2.IMWRITE_JPEG_QUALITY),
+}
+
+CROP_ID_PATTERN = re.compile(r'^[0-9a-f]{40}$')
+
+
+def crop_id(crop):
+    """
+    Returns the content id for a crop under the current encoding settings.
+    """
+    h = hashlib.blake2b(digest_size=20)
+    h.update(f"{crop.shape}:{crop.dtype}:{CROPS_CONFIG['FORMAT']}:{CROPS_CONFIG['QUALITY']}:{CROPS_CONFIG['MAX_SIZE']}".encode())
+    h.update(crop.tobytes() if crop.flags.c_contiguous else crop.copy().tobytes())
+    return h.hexdigest()
+
+
+def _path(identifier, extension):
+    return os.path.join(CROPS_CONFIG['DIR'], identifier[:2], identifier + extension)
+
+
+def downscale(crop, max_size):
+    height, width = crop.shape[:2]
+    scale = max_size / max(height, width)
+    if scale >= 1:
+        return crop
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return cv2.resize(crop, size, interpolation=cv2.INTER_AREA)
+
+
+def store_crop(crop):
+    """
+    Encodes and stores a crop thumbnail unless an identical one is already stored. Returns its id.
+    """
+    identifier = crop_id(crop)
+    extension, _, quality_flag = FORMATS[CROPS_CONFIG['FORMAT']]
+    path = _path(identifier, extension)
+    try:
+        os.utime(path)  # Already stored: retention counts from the latest response referencing it
+        return identifier
+    except FileNotFoundError:
+        pass
+
+    with stage('encode'):
+        ok, buffer = cv2.imencode(extension, downscale(crop, CROPS_CONFIG['MAX_SIZE']), [quality_flag, CROPS_CONFIG['QUALITY']])
+    if not ok:
+        raise ValueError(f"Could not encode crop as {CROPS_CONFIG['FORMAT']}")
+    with stage('save'):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so a concurrent request never serves a partial file
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, 'wb') as f:
+            f.write(buffer.tobytes())
+        os.replace(temporary, path)
+    return identifier
+
+
+def find_crop(identifier):
+    """
+    Returns (path, content_type) for a stored crop, or None.
+    """
+    if not CROP_ID_PATTERN.match(identifier):
+        return None
+    for extension, content_type, _ in FORMATS.values():
+        path = _path(identifier, extension)
+        if os.path.exists(path):
+            return path, content_type
+    return None
+
+
+def crop_reference(crop, box):
+    """
+    Stores a crop and returns its lean response entry: id, URL and bounding box.
+    """
+    identifier = store_crop(crop)
+    return {'id': identifier, 'url': reverse('crop', args=[identifier]), 'box': [int(v) for v in box]}
+
+
+def purge_crops(retention=None, max_bytes=None):
+    """
+    Deletes crops last referenced more than retention seconds ago, then the least recently
+    referenced ones until the store holds at most max_bytes. Either limit may be None.
+    Returns (files deleted, bytes deleted).
+    """
+    entries = []
+    for root, _, names in os.walk(CROPS_CONFIG['DIR']):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:  # Purged or renamed concurrently
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+
+    cutoff = time.time() - retention if retention is not None else None
+    remaining = sum(size for _, size, _ in entries)
+    deleted = deleted_bytes = 0
+    for mtime, size, path in entries:
+        expired = cutoff is not None and mtime < cutoff
+        oversized = max_bytes is not None and remaining > max_bytes
+        if not (expired or oversized):
+            break  # Oldest first: no later crop is expired and the store is small enough
+        if not expired and path.endswith('.tmp'):
+            continue  # A crop being written
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        remaining -= size
+        deleted += 1
+        deleted_bytes += size
+    return deleted, deleted_bytes
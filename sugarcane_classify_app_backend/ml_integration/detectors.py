@@ -0,0 +1,251 @@
+"""
+Detector backends for the bud and stem YOLO models.
+
+Every backend exposes detect(images) -> [(boxes, confidences), ...] with one
+entry per BGR image: boxes are float32 (K, 4) xyxy arrays in the image's own
+pixel coordinates, sorted by descending confidence.
+
+    torch     - ultralytics + PyTorch on the original .pt weights
+    openvino  - ultralytics on an OpenVINO export (<name>_openvino_model/)
+    onnx      - onnxruntime on an ONNX export (<name>.onnx, or <name>.int8.onnx),
+                with ultralytics-compatible letterboxing and NMS in NumPy, so
+                it needs neither torch nor ultralytics at runtime
+
+Letterboxing: for .pt weights, ultralytics pads a batch of same-sized images
+only up to the next multiple of the stride (a minimal rectangle), and a
+batch of mixed sizes to the full square. The ONNX export has dynamic axes,
+so the onnx backend does the same and gives the same boxes. The OpenVINO
+export has a fixed square input, so ultralytics pads every image to the full
+square there; boxes can then differ from the .pt model's by a pixel or so.
+
+ML_DETECTOR_BACKEND selects the backend; `manage.py export_detectors`
+produces the ONNX / OpenVINO files.
+"""
+import ast
+import os
+
+import numpy as np
+from django.conf import settings
+
+DETECTOR_BACKEND = getattr(settings, 'ML_DETECTOR_BACKEND', 'torch')
+DETECTOR_INT8 = getattr(settings, 'ML_DETECTOR_INT8', False)
+
+# Same defaults as ultralytics predict()
+CONF_THRESHOLD = getattr(settings, 'ML_DETECTOR_CONF', 0.25)
+IOU_THRESHOLD = getattr(settings, 'ML_DETECTOR_IOU', 0.7)
+MAX_DETECTIONS = 300
+LETTERBOX_COLOR = (114, 114, 114)
+
+
+def empty_detections():
+    return np.empty((0, 4), dtype=np.float32), np.empty(0, dtype=np.float32)
+
+
+def result_boxes(result):
+    """
+    Returns the xyxy boxes and confidences of one ultralytics result as float32 NumPy arrays.
+    """
+    boxes = getattr(result, 'boxes', None)
+    if boxes is None or not hasattr(boxes, 'xyxy'):
+        return empty_detections()
+    xyxy, conf = boxes.xyxy, getattr(boxes, 'conf', None)
+    if hasattr(xyxy, 'cpu'):
+        xyxy = xyxy.cpu().numpy()
+    if conf is None:
+        conf = np.ones(len(xyxy), dtype=np.float32)
+    elif hasattr(conf, 'cpu'):
+        conf = conf.cpu().numpy()
+    return np.asarray(xyxy, dtype=np.float32).reshape(-1, 4), np.asarray(conf, dtype=np.float32)
+
+
+def exported_path(weights_path, backend, int8=False):
+    """
+    Returns where export_detectors writes the given backend's export of a .pt file.
+    """
+    root, _ = os.path.splitext(weights_path)
+    if backend == 'onnx':
+        return root + ('.int8.onnx' if int8 else '.onnx')
+    if backend == 'openvino':
+        return root + ('_int8_openvino_model' if int8 else '_openvino_model')
+    return weights_path
+
+
+# ============================
+# Ultralytics Backend (torch / openvino)
+# ============================
+
+class UltralyticsDetector:
+    def __init__(self, path):
+        from ultralytics import YOLO  # Deferred: importing ultralytics pulls in torch
+        self.model = YOLO(path, task='detect')
+
+    def detect(self, images):
+        results = self.model(list(images), conf=CONF_THRESHOLD, iou=IOU_THRESHOLD, verbose=False)
+        return [result_boxes(result) for result in results]
+
+
+# ============================
+# ONNX Runtime Backend
+# ============================
+
+def letterbox(image, size, auto=False, stride=32):
+    """
+    Resizes keeping aspect ratio to fit size x size and pads, centred, as ultralytics
+    LetterBox does: to the full square, or with auto only up to the next multiple of stride.
+    Returns (padded_image, gain, (pad_x, pad_y)).
+    """
+    import cv2  # Deferred: the registry imports this module, also in the 'forecast' profile
+
+    h, w = image.shape[:2]
+    gain = min(size / h, size / w)
+    new_w, new_h = int(round(w * gain)), int(round(h * gain))
+    pad_w, pad_h = size - new_w, size - new_h
+    if auto:
+        pad_w, pad_h = pad_w % stride, pad_h % stride
+    pad_x, pad_y = pad_w / 2, pad_h / 2
+    if (new_w, new_h) != (w, h):
+        image = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    top, bottom = int(round(pad_y - 0.1)), int(round(pad_y + 0.1))
+    left, right = int(round(pad_x - 0.1)), int(round(pad_x + 0.1))
+    image = cv2.copyMakeBorder(image, top, bottom, left, right, cv2.BORDER_CONSTANT, value=LETTERBOX_COLOR)
+    return image, gain, (left, top)
+
+
+def preprocess(images, size, auto=False, stride=32):
+    """
+    Letterboxes BGR images into an (N, 3, H, W) float32 RGB tensor in [0, 1]. H and W are
+    size, or with auto (for models with dynamic input sizes) the stride-padded rectangle
+    when all images share a shape, as ultralytics' predictor does for .pt models.
+    """
+    auto = auto and len({image.shape[:2] for image in images}) == 1
+    letterboxed = [letterbox(image, size, auto, stride) for image in images]
+    height, width = letterboxed[0][0].shape[:2]
+    batch = np.empty((len(images), 3, height, width), dtype=np.float32)
+    transforms = []
+    for i, (image, (padded, gain, pad)) in enumerate(zip(images, letterboxed)):
+        batch[i] = padded[:, :, ::-1].transpose(2, 0, 1)
+        transforms.append((gain, pad, image.shape[:2]))
+    batch /= 255.0
+    return batch, transforms
+
+
+def nms(boxes, scores, iou_threshold):
+    """
+    Greedy non-maximum suppression; returns kept indices in descending score order.
+    """
+    order = np.argsort(-scores, kind='stable')
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    keep = []
+    while order.size:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        xx1 = np.maximum(boxes[i, 0], boxes[rest, 0])
+        yy1 = np.maximum(boxes[i, 1], boxes[rest, 1])
+        xx2 = np.minimum(boxes[i, 2], boxes[rest, 2])
+        yy2 = np.minimum(boxes[i, 3], boxes[rest, 3])
+        inter = np.clip(xx2 - xx1, 0, None) * np.clip(yy2 - yy1, 0, None)
+        iou = inter / (areas[i] + areas[rest] - inter + 1e-7)
+        order = rest[iou <= iou_threshold]
+    return np.array(keep, dtype=np.int64)
+
+
+def postprocess(prediction, transform, conf_threshold=CONF_THRESHOLD, iou_threshold=IOU_THRESHOLD):
+    """
+    Turns one image's raw YOLOv8-style output (4 + num_classes, anchors) into boxes in
+    original image coordinates, applying the confidence threshold and per-class NMS.
+    """
+    prediction = prediction.T  # (anchors, 4 + num_classes)
+    class_scores = prediction[:, 4:]
+    classes = class_scores.argmax(axis=1)
+    scores = class_scores[np.arange(len(classes)), classes]
+    mask = scores > conf_threshold
+    if not mask.any():
+        return empty_detections()
+    cx, cy, w, h = prediction[mask, :4].T
+    boxes = np.stack((cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2), axis=1)
+    scores, classes = scores[mask], classes[mask]
+
+    # Offset boxes by class so NMS never suppresses across classes
+    offsets = classes[:, None].astype(np.float32) * 7680.0
+    keep = nms(boxes + offsets, scores, iou_threshold)[:MAX_DETECTIONS]
+    boxes, scores = boxes[keep], scores[keep]
+
+    gain, (pad_x, pad_y), (height, width) = transform
+    boxes[:, [0, 2]] = ((boxes[:, [0, 2]] - pad_x) / gain).clip(0, width)
+    boxes[:, [1, 3]] = ((boxes[:, [1, 3]] - pad_y) / gain).clip(0, height)
+    return boxes.astype(np.float32), scores.astype(np.float32)
+
+
+def export_metadata(metadata):
+    """
+    Returns (imgsz, stride) from the metadata ultralytics writes into its ONNX exports, or None for
+    values it does not have.
+    """
+    try:
+        imgsz = ast.literal_eval(metadata['imgsz'])
+        imgsz = max(imgsz) if isinstance(imgsz, (list, tuple)) else int(imgsz)
+    except (KeyError, ValueError, SyntaxError):
+        imgsz = None
+    try:
+        stride = int(ast.literal_eval(metadata['stride']))
+    except (KeyError, ValueError, SyntaxError):
+        stride = None
+    return imgsz, stride
+
+
+class OnnxDetector:
+    def __init__(self, path):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(path, sess_options=options, providers=['CPUExecutionProvider'])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        imgsz, stride = export_metadata(self.session.get_modelmeta().custom_metadata_map)
+        # Dynamic height and width: pad same-sized batches to a stride-multiple rectangle, like .pt models
+        self.dynamic = not all(isinstance(dim, int) for dim in model_input.shape[2:4])
+        self.imgsz = model_input.shape[2] if isinstance(model_input.shape[2], int) else imgsz or 640
+        self.stride = stride or 32
+        # Exports with a fixed batch dimension have to be fed one image at a time
+        self.max_batch = model_input.shape[0] if isinstance(model_input.shape[0], int) else None
+
+    def detect(self, images):
+        images = list(images)
+        if not images:
+            return []
+        batch, transforms = preprocess(images, self.imgsz, self.dynamic, self.stride)
+        step = self.max_batch or len(images)
+        outputs = []
+        for start in range(0, len(images), step):
+            predictions = self.session.run(None, {self.input_name: batch[start:start + step]})[0]
+            outputs.extend(
+                postprocess(prediction, transform)
+                for prediction, transform in zip(predictions, transforms[start:start + step])
+            )
+        return outputs
+
+
+BACKENDS = {
+    'torch': UltralyticsDetector,
+    'openvino': UltralyticsDetector,
+    'onnx': OnnxDetector,
+}
+
+
+def detector_path(weights_path):
+    """
+    Returns the file the configured backend loads for the given .pt weights.
+    """
+    return exported_path(weights_path, DETECTOR_BACKEND, DETECTOR_INT8)
+
+
+def load_detector(path):
+    return BACKENDS[DETECTOR_BACKEND](path)
+
+
+def warm_up_detector(detector):
+    """
+    Runs a dummy forward pass so the first real request does not pay for lazy init.
+    """
+    detector.detect([np.zeros((640, 640, 3), dtype=np.uint8)])
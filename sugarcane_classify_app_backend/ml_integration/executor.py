@@ -0,0 +1,108 @@
+"""
+Bounded worker pool for running CPU-bound inference stages off the event loop.
+
+The async views submit detection, feature extraction and classification here
+so the ASGI event loop keeps accepting connections. Each request is admitted
+before it submits any work; when MAX_PENDING requests are already in flight,
+admission fails fast with Overloaded and the view answers 503 with a
+Retry-After header instead of queueing without bound. Admitted requests are
+never rejected halfway through their pipeline.
+"""
+import asyncio
+import atexit
+import contextlib
+import contextvars
+import functools
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from django.conf import settings
+
+DEFAULT_POOL_CONFIG = {
+    'KIND': 'thread',     # 'thread' or 'process'
+    'WORKERS': 4,
+    'MAX_PENDING': 32,    # Requests in flight before new ones are rejected
+    'RETRY_AFTER': 2,     # Seconds, sent with 503 responses
+}
+
+POOL_CONFIG = {**DEFAULT_POOL_CONFIG, **getattr(settings, 'ML_INFERENCE_POOL', {})}
+
+
+class Overloaded(Exception):
+    """
+    Raised when the inference pool already has MAX_PENDING requests in flight.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__('Inference pool is overloaded')
+        self.retry_after = retry_after
+
+
+def _init_process_worker(settings_module):
+    # Worker processes started with 'spawn' need Django configured before models load
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
+    import django
+    django.setup()
+
+
+class InferencePool:
+    def __init__(self, kind, workers, max_pending, retry_after):
+        self.kind = kind
+        self.workers = workers
+        self.max_pending = max_pending
+        self.retry_after = retry_after
+        self.pending = 0
+        self._executor = None
+
+    @property
+    def is_process_pool(self):
+        return self.kind == 'process'
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.is_process_pool:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    initializer=_init_process_worker,
+                    initargs=(os.environ.get('DJANGO_SETTINGS_MODULE', ''),),
+                )
+            elif self.kind == 'thread':
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='inference')
+            else:
+                raise ValueError(f"Unknown inference pool kind: {self.kind}")
+            atexit.register(self._executor.shutdown, wait=False)
+        return self._executor
+
+    @contextlib.contextmanager
+    def admit(self):
+        """
+        Admits one request for the duration of the block.
+        Raises Overloaded immediately if MAX_PENDING requests are already in flight.
+        """
+        # Only the event loop thread touches self.pending, so no lock is needed
+        if self.pending >= self.max_pending:
+            raise Overloaded(self.retry_after)
+        self.pending += 1
+        try:
+            yield
+        finally:
+            self.pending -= 1
+
+    async def run(self, fn, *args, **kwargs):
+        """
+        Runs fn(*args, **kwargs) in the pool and awaits its result.
+        """
+        loop = asyncio.get_running_loop()
+        call = functools.partial(fn, *args, **kwargs)
+        if not self.is_process_pool:
+            # Carry the request's context (e.g. its stage timings) into the worker thread
+            call = functools.partial(contextvars.copy_context().run, call)
+        return await loop.run_in_executor(self._get_executor(), call)
+
+
+inference_pool = InferencePool(
+    POOL_CONFIG['KIND'],
+    POOL_CONFIG['WORKERS'],
+    POOL_CONFIG['MAX_PENDING'],
+    POOL_CONFIG['RETRY_AFTER'],
+)
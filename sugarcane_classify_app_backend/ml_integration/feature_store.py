@@ -0,0 +1,263 @@
+"""
+On-disk store of the bud and stem feature vectors behind every variety prediction.
+
+With ML_FEATURE_STORE enabled, every crop the variety pipelines classify is
+recorded with the key of the upload it was cut from (a hash of the raw image
+bytes), the key of the image it was paired with, its detection box and
+confidence, and its feature vector. After retraining a classifier,
+`manage.py rescore_features` scores the whole corpus again from the store,
+without decoding an image or running YOLO or feature extraction.
+
+Rows are buffered per organ and written by a background thread once
+CHUNK_ROWS have accumulated or FLUSH_INTERVAL seconds after the first
+buffered row (see chunks.py), as two files per chunk:
+
+    <DIR>/<organ>/<chunk>.npy         float32 features, one row per crop
+    <DIR>/<organ>/<chunk>.index.npy   INDEX_DTYPE records, in the same order
+
+Both are memory-mapped when read. Storing float32 loses nothing the models
+see: the RF, XGBoost and compiled classifiers all compare float32 features.
+Every process writes its own chunks, named by time and pid, so server
+processes, pool workers and the job worker can record at the same time.
+Buffered rows are flushed when the process exits normally.
+"""
+import glob
+import hashlib
+import logging
+import os
+import time
+
+import numpy as np
+from django.conf import settings
+
+from .chunks import ChunkWriter, save_npy
+from .uploads import upload_buffer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FEATURE_STORE_CONFIG = {
+    'ENABLED': False,
+    'DIR': os.path.join(settings.BASE_DIR, 'cache', 'features'),
+    'CHUNK_ROWS': 4096,
+    'FLUSH_INTERVAL': 60.0,   # Seconds a buffered row may wait for its chunk to fill
+}
+
+FEATURE_STORE_CONFIG = {**DEFAULT_FEATURE_STORE_CONFIG, **getattr(settings, 'ML_FEATURE_STORE', {})}
+
+ORGANS = ('bud', 'stem')
+
+INDEX_DTYPE = np.dtype([
+    ('image', 'S20'),        # Key of the uploaded image
+    ('pair', 'S20'),         # Key of the other image of its bud/stem pair
+    ('detection', '<u2'),    # Rank of the detection in its image; 0 is the most confident
+    ('box', '<i4', (4,)),
+    ('confidence', '<f4'),
+    ('recorded_at', '<f8'),  # Shared by all rows of one recording
+])
+
+
+def image_key(buffer):
+    """
+    Returns the store key (a 20-byte digest) for the raw bytes of an uploaded image.
+    """
+    return hashlib.blake2b(buffer, digest_size=20).digest()
+
+
+def upload_key(uploaded_file):
+    return image_key(upload_buffer(uploaded_file))
+
+
+def key_hex(keys):
+    """
+    Returns hex strings for an array of keys. Indexing an 'S20' array drops trailing
+    NUL bytes, so the keys are read back through their raw bytes.
+    """
+    keys = np.ascontiguousarray(keys, dtype='S20')
+    return [row.tobytes().hex() for row in keys.view(np.uint8).reshape(-1, 20)]
+
+
+# ============================
+# Store
+# ============================
+
+class FeatureStore:
+    def __init__(self, directory, chunk_rows, flush_interval):
+        self.directory = directory
+        self.chunk_rows = chunk_rows
+        self.flush_interval = flush_interval
+        self._writer = ChunkWriter(self._write, chunk_rows, flush_interval, name='feature-store-writer')
+
+    def record(self, organ, X, images, pairs, box_groups, confidence_groups):
+        """
+        Buffers the feature rows X of one or more images' crops. images, pairs, box_groups
+        and confidence_groups have one entry per image; X holds their crops back to back.
+        """
+        sizes = [len(group) for group in confidence_groups]
+        index = np.zeros(sum(sizes), dtype=INDEX_DTYPE)
+        if not len(index):
+            return
+        index['image'] = np.repeat(np.array(images, dtype='S20'), sizes)
+        index['pair'] = np.repeat(np.array(pairs, dtype='S20'), sizes)
+        index['detection'] = np.concatenate([np.arange(size) for size in sizes])
+        index['box'] = np.concatenate([np.asarray(boxes, dtype=np.int32).reshape(-1, 4) for boxes in box_groups])
+        index['confidence'] = np.concatenate([np.asarray(group, dtype=np.float32) for group in confidence_groups])
+        index['recorded_at'] = time.time()
+        self._writer.add(organ, (index, np.asarray(X, dtype=np.float32)), len(index))
+
+    def flush(self):
+        """
+        Writes every buffered row.
+        """
+        self._writer.flush()
+
+    def _write(self, organ, parts, name):
+        index = np.concatenate([part[0] for part in parts])
+        X = np.concatenate([part[1] for part in parts])
+        directory = os.path.join(self.directory, organ)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            # The index is renamed into place last, so readers never see a chunk without its features
+            save_npy(directory, name, X)
+            save_npy(directory, name + '.index', index)
+        except OSError as e:
+            logger.warning("Failed to write %d %s feature rows: %s", len(index), organ, e)
+            return
+        logger.debug("Wrote %d %s feature rows to %s", len(index), organ, name)
+
+    def chunk_names(self, organ):
+        paths = glob.glob(os.path.join(self.directory, organ, '*.index.npy'))
+        return sorted(os.path.basename(path)[:-len('.index.npy')] for path in paths if '.tmp.' not in path)
+
+    def iter_chunks(self, organ, names=None):
+        """
+        Yields (index, features) for each stored chunk of an organ (or the named ones), oldest first,
+        both memory-mapped.
+        """
+        directory = os.path.join(self.directory, organ)
+        for name in (self.chunk_names(organ) if names is None else names):
+            index = np.load(os.path.join(directory, name + '.index.npy'), mmap_mode='r')
+            X = np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+            yield index, X
+
+    def index(self, organ, names=None):
+        """
+        Returns the index records of every stored row of an organ (or of the named chunks), in chunk order.
+        """
+        indexes = [np.asarray(index) for index, _ in self.iter_chunks(organ, names)]
+        return np.concatenate(indexes) if indexes else np.zeros(0, dtype=INDEX_DTYPE)
+
+
+feature_store = FeatureStore(
+    FEATURE_STORE_CONFIG['DIR'],
+    FEATURE_STORE_CONFIG['CHUNK_ROWS'],
+    FEATURE_STORE_CONFIG['FLUSH_INTERVAL'],
+)
+
+
+def _key(upload):
+    if isinstance(upload, (bytes, bytearray, memoryview)):
+        return image_key(upload)
+    return upload_key(upload)
+
+
+def pair_keys(bud_uploads, stem_uploads):
+    """
+    Returns {organ: {'images': keys, 'pairs': partner keys}} for bud/stem pairs (uploaded
+    files or raw bytes), or None when the feature store is disabled. Completed with
+    organ_record, for pipelines that classify one organ before detecting the other.
+    """
+    if not FEATURE_STORE_CONFIG['ENABLED']:
+        return None
+    bud_keys = [_key(upload) for upload in bud_uploads]
+    stem_keys = [_key(upload) for upload in stem_uploads]
+    return {'bud': {'images': bud_keys, 'pairs': stem_keys}, 'stem': {'images': stem_keys, 'pairs': bud_keys}}
+
+
+def organ_record(organ_keys, box_groups, confidence_groups, rows=None):
+    """
+    Returns the record argument of classify_detections from an organ's entry of pair_keys
+    (None when disabled) and its detections, keeping only the given pair rows.
+    """
+    if organ_keys is None:
+        return None
+    images, pairs = organ_keys['images'], organ_keys['pairs']
+    if rows is not None:
+        images, pairs = [images[i] for i in rows], [pairs[i] for i in rows]
+    return {'images': images, 'pairs': pairs, 'box_groups': box_groups, 'confidence_groups': confidence_groups}
+
+
+def pair_records(bud_uploads, stem_uploads, bud_box_groups, bud_confidence_groups, stem_box_groups, stem_confidence_groups):
+    """
+    Returns the (bud, stem) record arguments of classify_detections for bud/stem pairs
+    (uploaded files or raw bytes), or (None, None) when the feature store is disabled.
+    """
+    keys = pair_keys(bud_uploads, stem_uploads)
+    if keys is None:
+        return None, None
+    return (organ_record(keys['bud'], bud_box_groups, bud_confidence_groups),
+            organ_record(keys['stem'], stem_box_groups, stem_confidence_groups))
+
+
+# ============================
+# Re-scoring
+# ============================
+
+def latest_rows(index):
+    """
+    Returns a mask keeping only the most recent recording of each image, so an image
+    predicted more than once is scored once.
+    """
+    if not len(index):
+        return np.zeros(0, dtype=bool)
+    order = np.lexsort((index['recorded_at'], index['image']))
+    images = index['image'][order]
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = images[1:] != images[:-1]
+    latest = np.empty(len(order))
+    # Every row of an image gets the time of its last recording
+    group_ends = np.flatnonzero(last)
+    group_sizes = np.diff(np.concatenate(([-1], group_ends)))
+    latest[order] = np.repeat(index['recorded_at'][order][group_ends], group_sizes)
+    return index['recorded_at'] == latest
+
+
+def rescore(store, organ, classifier, chunk_rows=None):
+    """
+    Scores every stored image of an organ with a classifier, without touching the images.
+
+    Returns (images, pairs, probabilities): the image and pair keys and one
+    confidence-weighted class probability row per image, sorted by image key.
+    Each chunk's kept rows go through predict_proba in slices of chunk_rows.
+    """
+    chunk_rows = chunk_rows or store.chunk_rows
+    # Chunks written while re-scoring are left for the next run
+    names = store.chunk_names(organ)
+    index = store.index(organ, names)
+    keep = latest_rows(index)
+    expected_features = getattr(classifier, 'n_features_in_', None)
+
+    probabilities = []
+    offset = 0
+    for chunk_index, X in store.iter_chunks(organ, names):
+        chunk_keep = keep[offset:offset + len(chunk_index)]
+        offset += len(chunk_index)
+        if expected_features is not None and X.shape[1] != expected_features:
+            raise ValueError(
+                f"Stored {organ} features have {X.shape[1]} columns but the classifier expects {expected_features}"
+            )
+        rows = np.flatnonzero(chunk_keep)
+        for start in range(0, len(rows), chunk_rows):
+            probabilities.append(classifier.predict_proba(X[rows[start:start + chunk_rows]]))
+
+    kept = index[keep]
+    if not len(kept):
+        return np.zeros(0, dtype='S20'), np.zeros(0, dtype='S20'), np.zeros((0, 0))
+    probabilities = np.concatenate(probabilities)
+
+    from .pipeline import aggregate_probabilities  # Deferred: the pipeline records into this store
+
+    order = np.argsort(kept['image'], kind='stable')
+    kept, probabilities = kept[order], probabilities[order]
+    starts = np.flatnonzero(np.concatenate(([True], kept['image'][1:] != kept['image'][:-1])))
+    confidence_groups = np.split(kept['confidence'], starts[1:])
+    return kept['image'][starts], kept['pair'][starts], aggregate_probabilities(probabilities, confidence_groups)
@@ -0,0 +1,201 @@
+"""
+Batch feature extraction for bud and stem crops.
+
+Every function takes a uint8 BGR batch of shape (N, 128, 128, 3), as produced
+by resize_batch(), and returns one feature row per image. The features match
+what the bud RF and stem XGBoost classifiers were trained on:
+
+    bud:  RGB histograms (3 x 256 bins) + HOG of the grayscale image
+    stem: BGR and HSV histograms (6 x 32 bins) + BGR and HSV mean/std
+          + GLCM texture properties (contrast, dissimilarity, homogeneity,
+          energy, correlation)
+
+Histograms are computed with one np.bincount over the whole batch instead of
+per-channel cv2.calcHist calls, the channel mean/std are derived exactly from
+those histograms, colour conversions are done once per batch, and the GLCM
+properties are computed from the horizontal pixel pairs instead of building
+and scanning a 256 x 256 co-occurrence matrix per property. HOG still runs
+through skimage, one image at a time.
+"""
+import cv2
+import numpy as np
+from skimage.feature import hog
+
+IMG_SIZE = (128, 128)
+
+GLCM_LEVELS = 256
+
+
+def resize_batch(images, size=IMG_SIZE):
+    """
+    Resizes a list of BGR images to size and stacks them into an (N, H, W, 3) uint8 batch.
+    """
+    batch = np.empty((len(images), size[1], size[0], 3), dtype=np.uint8)
+    for i, image in enumerate(images):
+        batch[i] = cv2.resize(image, size)
+    return batch
+
+
+def _convert_batch(batch, code):
+    """
+    Applies one cv2.cvtColor over a whole batch by viewing it as a single tall image.
+    """
+    n, h, w = batch.shape[:3]
+    converted = cv2.cvtColor(np.ascontiguousarray(batch).reshape(n * h, w, batch.shape[3]), code)
+    return converted.reshape((n, h, w) + converted.shape[2:])
+
+
+def to_hsv(batch):
+    return _convert_batch(batch, cv2.COLOR_BGR2HSV)
+
+
+def to_gray(batch):
+    return _convert_batch(batch, cv2.COLOR_BGR2GRAY)
+
+
+def channel_histograms(batch, bins=256):
+    """
+    Per-channel histograms over [0, 256) for a uint8 batch; returns (N, C, bins) int64 counts.
+    Equivalent to cv2.calcHist([img], [c], None, [bins], [0, 256]) for each channel c.
+    """
+    n, channels = batch.shape[0], batch.shape[-1]
+    offsets = (np.arange(n, dtype=np.int32)[:, None] * channels + np.arange(channels, dtype=np.int32)) * 256
+    codes = batch.reshape(n, -1, channels) + offsets[:, None, :]
+    counts = np.bincount(codes.ravel(), minlength=n * channels * 256).reshape(n, channels, 256)
+    return rebin(counts, bins)
+
+
+def rebin(histograms, bins):
+    """
+    Merges (N, C, 256) histograms into (N, C, bins) uniform bins over [0, 256).
+    """
+    if bins == 256:
+        return histograms
+    n, channels = histograms.shape[:2]
+    return histograms.reshape(n, channels, bins, 256 // bins).sum(axis=3)
+
+
+def histogram_stats(histograms):
+    """
+    Per-channel mean and standard deviation from (N, C, 256) histograms, interleaved
+    as (mean_0, std_0, mean_1, ...). Sums are exact integers, so the means match
+    np.mean on each channel bit for bit and the deviations agree to rounding.
+    """
+    n, channels = histograms.shape[:2]
+    levels = np.arange(256, dtype=np.int64)
+    count = histograms.sum(axis=2)
+    total = histograms @ levels
+    total_sq = histograms @ (levels * levels)
+    stats = np.empty((n, channels * 2))
+    stats[:, 0::2] = total / count
+    stats[:, 1::2] = np.sqrt((count * total_sq - total * total) / (count * count))
+    return stats
+
+
+def extract_color_histogram(batch, bins=32, hsv=None):
+    """
+    BGR then HSV channel histograms for a stem batch.
+    """
+    if hsv is None:
+        hsv = to_hsv(batch)
+    histograms = np.concatenate((channel_histograms(batch, bins), channel_histograms(hsv, bins)), axis=1)
+    return histograms.reshape(len(batch), -1).astype(np.float32)
+
+
+def extract_color_stats(batch, hsv=None):
+    """
+    BGR then HSV channel mean/std for a stem batch.
+    """
+    if hsv is None:
+        hsv = to_hsv(batch)
+    return np.concatenate((histogram_stats(channel_histograms(batch)), histogram_stats(channel_histograms(hsv))), axis=1)
+
+
+def extract_texture_features(batch):
+    """
+    GLCM texture properties at distance 1, angle 0, 256 levels, symmetric and normalised.
+    Matches skimage graycomatrix + graycoprops for contrast, dissimilarity,
+    homogeneity, energy and correlation without building the 256 x 256 matrix.
+    """
+    gray = to_gray(batch)
+    n = gray.shape[0]
+    left = gray[:, :, :-1].reshape(n, -1).astype(np.int32)
+    right = gray[:, :, 1:].reshape(n, -1).astype(np.int32)
+    pairs = left.shape[1]
+    total = 2 * pairs  # The symmetric GLCM counts every pair in both directions
+    image_offsets = np.arange(n, dtype=np.int32)[:, None]
+
+    # Contrast, dissimilarity and homogeneity depend only on |i - j|, so they are
+    # weighted sums over a per-image histogram of absolute pair differences
+    diff = np.abs(left - right)
+    diff_counts = np.bincount((diff + image_offsets * GLCM_LEVELS).ravel(), minlength=n * GLCM_LEVELS)
+    diff_probs = diff_counts.reshape(n, GLCM_LEVELS) / pairs
+    d = np.arange(GLCM_LEVELS, dtype=np.float64)
+    contrast = diff_probs @ (d * d)
+    dissimilarity = diff_probs @ d
+    homogeneity = diff_probs @ (1.0 / (1.0 + d * d))
+
+    # Energy: with U counting unordered pairs (min, max), the symmetric matrix has
+    # S_ij = U_ij off the diagonal (twice) and S_ii = 2 * U_ii, so
+    # sum(S^2) = 2 * sum(U^2) + 2 * sum(diag(U)^2). U is counted per image with np.unique
+    # over the image's pairs, which stays small, rather than over all 256 x 256 cells
+    codes = np.minimum(left, right) * GLCM_LEVELS + np.maximum(left, right)
+    sum_sq = np.empty(n, dtype=np.int64)
+    for k in range(n):
+        values, counts = np.unique(codes[k], return_counts=True)
+        counts = counts.astype(np.int64)
+        diagonal = counts[values // GLCM_LEVELS == values % GLCM_LEVELS]
+        sum_sq[k] = 2 * (counts * counts).sum() + 2 * (diagonal * diagonal).sum()
+    energy = np.sqrt(sum_sq) / total
+
+    # Correlation: row and column marginals of a symmetric GLCM are equal, so
+    # std_i == std_j and correlation = cov / var, computed from exact integer sums
+    level_sum = left.sum(axis=1, dtype=np.int64) + right.sum(axis=1, dtype=np.int64)
+    level_sq_sum = (left * left).sum(axis=1, dtype=np.int64) + (right * right).sum(axis=1, dtype=np.int64)
+    cross_sum = (left * right).sum(axis=1, dtype=np.int64)
+    covariance = 2 * total * cross_sum - level_sum * level_sum
+    variance = total * level_sq_sum - level_sum * level_sum
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correlation = np.where(variance == 0, 1.0, covariance / variance)
+
+    return np.stack((contrast, dissimilarity, homogeneity, energy, correlation), axis=1)
+
+
+def extract_hog_features(batch):
+    """
+    HOG of the grayscale image (9 orientations, 8x8 cells, 2x2 blocks, L2-Hys).
+    """
+    gray = to_gray(batch)
+    return np.stack([
+        hog(
+            image,
+            orientations=9,
+            pixels_per_cell=(8, 8),
+            cells_per_block=(2, 2),
+            block_norm='L2-Hys',
+            feature_vector=True
+        )
+        for image in gray
+    ])
+
+
+def extract_bud_features(batch):
+    """
+    Bud features (RGB histograms + HOG) for an (N, 128, 128, 3) BGR batch.
+    """
+    rgb_hist = channel_histograms(batch)[:, ::-1].reshape(len(batch), -1).astype(np.float32)
+    return np.concatenate((rgb_hist, extract_hog_features(batch)), axis=1)
+
+
+def extract_stem_features(batch):
+    """
+    Stem features (colour histograms, colour stats, texture) for an (N, 128, 128, 3) BGR batch.
+    """
+    # One set of full-resolution BGR + HSV histograms feeds both the 32-bin
+    # histogram features and the channel statistics
+    histograms = np.concatenate((channel_histograms(batch), channel_histograms(to_hsv(batch))), axis=1)
+    return np.concatenate((
+        rebin(histograms, 32).reshape(len(batch), -1).astype(np.float32),
+        histogram_stats(histograms),
+        extract_texture_features(batch),
+    ), axis=1)
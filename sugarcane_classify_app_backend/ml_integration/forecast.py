@@ -0,0 +1,45 @@
+"""
+Sugar production forecasting stages.
+
+Kept apart from pipeline.py so that the forecasting views, and the
+'forecast' deployment profile (ML_PROFILE) that serves only them, load
+NumPy and the regression model but not OpenCV, scikit-image or the detectors.
+"""
+import numpy as np
+
+from . import sugar_grid
+from .metrics import SUGAR_GRID_LOOKUPS
+from .registry import registry
+from .timing import stage
+
+SUGAR_GRID_ENABLED = sugar_grid.GRID_CONFIG['ENABLED']
+
+# Models are loaded lazily through the registry:
+#   sugar_production                 - sugar production regression model
+#   sugar_grid                       - precomputed sugar production grid (ML_SUGAR_GRID)
+FORECAST_MODELS = ['sugar_production'] + (['sugar_grid'] if SUGAR_GRID_ENABLED else [])
+
+
+def predict_sugar_production_value(sunshine, soil_temp, temp_max):
+    """
+    Predicts sugar production (tons) from yearly sunshine hours, soil temperature and max temperature.
+    """
+    return float(predict_sugar_production_batch(np.array([[sunshine, soil_temp, temp_max]]))[0])
+
+
+def predict_sugar_production_batch(input_data):
+    """
+    Predicts sugar production for an (N, 3) array of (sunshine, soil_temp, temp_max) rows in one model call.
+    With ML_SUGAR_GRID enabled, rows inside the precomputed grid are looked up and only the rest reach the model.
+    """
+    with stage('regress'):
+        if not SUGAR_GRID_ENABLED:
+            return registry.get('sugar_production').predict(input_data)
+        predictions, served = sugar_grid.lookup(input_data)
+        served_count = int(served.sum())
+        if served_count:
+            SUGAR_GRID_LOOKUPS.inc('grid', amount=served_count)
+        if served_count < len(input_data):
+            SUGAR_GRID_LOOKUPS.inc('model', amount=len(input_data) - served_count)
+            predictions[~served] = registry.get('sugar_production').predict(input_data[~served])
+        return predictions
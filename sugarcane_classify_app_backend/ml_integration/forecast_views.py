@@ -0,0 +1,174 @@
+"""
+Views that do not need the vision stack: sugar production forecasting,
+model status and metrics.
+
+Importing this module loads NumPy and the model registry but not OpenCV,
+scikit-image or the detectors, so a worker started with ML_PROFILE =
+'forecast' (which routes only these views, see urls.py) stays small and
+starts fast. views.py re-exports them for the full profile.
+"""
+import json
+import logging
+
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+
+from . import bulk
+from .batching import detection_batchers
+from .executor import Overloaded, inference_pool
+from .forecast import predict_sugar_production_value
+from .metrics import metrics, track_requests
+from .registry import registry
+
+logger = logging.getLogger(__name__)
+
+def async_csrf_exempt(view_func):
+    """
+    Marks a coroutine view as CSRF exempt. django's csrf_exempt only preserves
+    coroutine views from Django 5.0 on.
+    """
+    view_func.csrf_exempt = True
+    return view_func
+
+def overloaded_response(e):
+    response = JsonResponse({'error': 'Server is busy, please retry later'}, status=503)
+    response['Retry-After'] = str(e.retry_after)
+    return response
+
+# ============================
+# Sugar Production
+# ============================
+
+@csrf_exempt
+@track_requests('predict_sugar_production')
+def predict_sugar_production(request):
+    """
+    Predicts sugar production based on average yearly sunshine hours, soil temperature, and max temperature.
+    Expects a POST request with JSON data containing 'sunshine', 'soil_temp', and 'temp_max'.
+    """
+    logger.debug("Received request method: %s", request.method)
+    if request.method == 'POST':
+        try:
+            # Parse the request body (expecting JSON data)
+            data = json.loads(request.body)
+            logger.debug("Request data: %s", data)
+
+            # Extract the input values
+            sunshine = float(data.get('sunshine'))
+            soil_temp = float(data.get('soil_temp'))
+            temp_max = float(data.get('temp_max'))
+
+            # Validate inputs
+            if sunshine is None or soil_temp is None or temp_max is None:
+                logger.info("Missing required fields")
+                return JsonResponse({'error': 'Missing required fields: sunshine, soil_temp, and temp_max are required'}, status=400)
+
+            # Make prediction using the loaded model (or the precomputed grid, when enabled)
+            prediction = predict_sugar_production_value(sunshine, soil_temp, temp_max)
+            logger.debug("Predicted sugar production: %s", prediction)
+
+            # Return the prediction in a JSON response
+            return JsonResponse({
+                'predicted_sugar_production': round(prediction, 2),  # Round to 2 decimal places for readability
+                'unit': 'tons'
+            })
+
+        except ValueError as ve:
+            logger.info("Invalid input values: %s", ve)
+            return JsonResponse({'error': 'Invalid input values: sunshine, soil_temp, and temp_max must be numeric'}, status=400)
+        except Exception as e:
+            logger.exception("Exception occurred")
+            return JsonResponse({'error': str(e)}, status=500)
+    else:
+        logger.info("Invalid request method")
+        return JsonResponse({'error': 'Invalid request method'}, status=400)
+
+# ============================
+# Bulk Sugar Production Forecasting
+# ============================
+
+@csrf_exempt
+@track_requests('predict_sugar_production_bulk')
+def predict_sugar_production_bulk(request):
+    """
+    Predicts sugar production for many (sunshine, soil_temp, temp_max) rows in one request.
+    The body is a JSON array, CSV or Arrow IPC stream (by Content-Type); it is scored in
+    chunks and streamed back in the same format, or the one given by ?format=json|csv|arrow.
+    Rows with missing or non-numeric values get a null prediction.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request method'}, status=400)
+
+    input_format = bulk.CONTENT_TYPES.get(request.content_type)
+    if input_format is None:
+        return JsonResponse(
+            {'error': f"Unsupported Content-Type '{request.content_type}'; use one of: {', '.join(bulk.CONTENT_TYPES)}"},
+            status=415,
+        )
+    output_format = request.GET.get('format', input_format)
+    if output_format not in bulk.WRITERS:
+        return JsonResponse({'error': f"Unsupported format '{output_format}'; use one of: {', '.join(bulk.WRITERS)}"}, status=400)
+
+    try:
+        # Load the model before streaming starts, so a broken model file is still a 500
+        registry.get('sugar_production')
+        body = bulk.bulk_predictions(request, input_format, output_format)
+    except bulk.BulkInputError as e:
+        logger.info("Invalid bulk request: %s", e)
+        return JsonResponse({'error': str(e)}, status=400)
+    except Exception as e:
+        logger.exception("Exception occurred")
+        return JsonResponse({'error': str(e)}, status=500)
+    return StreamingHttpResponse(body, content_type=bulk.OUTPUT_CONTENT_TYPES[output_format])
+
+@async_csrf_exempt
+@track_requests('predict_sugar_production_async')
+async def predict_sugar_production_async(request):
+    """
+    Async version of predict_sugar_production; the model runs in the bounded inference pool.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request method'}, status=400)
+
+    try:
+        data = json.loads(request.body)
+        sunshine = float(data.get('sunshine'))
+        soil_temp = float(data.get('soil_temp'))
+        temp_max = float(data.get('temp_max'))
+    except TypeError:
+        return JsonResponse({'error': 'Missing required fields: sunshine, soil_temp, and temp_max are required'}, status=400)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid input values: sunshine, soil_temp, and temp_max must be numeric'}, status=400)
+
+    try:
+        with inference_pool.admit():
+            prediction = await inference_pool.run(predict_sugar_production_value, sunshine, soil_temp, temp_max)
+        return JsonResponse({
+            'predicted_sugar_production': round(prediction, 2),
+            'unit': 'tons'
+        })
+    except Overloaded as e:
+        return overloaded_response(e)
+    except Exception as e:
+        logger.exception("Exception occurred")
+        return JsonResponse({'error': str(e)}, status=500)
+
+# ============================
+# Model Status and Metrics
+# ============================
+
+def model_status(request):
+    """
+    Reports load state and load/warm-up timings for every registered model,
+    plus batch size and queue wait stats when detection micro-batching is enabled.
+    """
+    return JsonResponse({
+        'models': registry.stats(),
+        'detection_batching': {name: batcher.stats() for name, batcher in detection_batchers.items()},
+    })
+
+def metrics_view(request):
+    """
+    Serves request, stage, model-load and cache metrics in the Prometheus text format.
+    """
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
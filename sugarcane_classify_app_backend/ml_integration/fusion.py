@@ -0,0 +1,149 @@
+"""
+Fusion of the bud and stem class probabilities into one variety prediction.
+
+The fusion settings (strategy, per-organ weights and calibration) belong to
+a pair of classifier versions, so ML_FUSION['VERSIONS'] can override them
+for specific '<bud classifier file>:<stem classifier file>' pairs; the
+engine for the configured model files is resolved once at startup.
+
+Strategies, applied to the calibrated probabilities:
+
+    weighted_mean    weighted average (the original 0.5 / 0.5 average)
+    geometric_mean   weighted log-linear pooling, renormalized
+    max_confidence   the row of whichever organ is more confident
+
+Calibration is temperature scaling: p ** (1 / T), renormalized; T = 1
+leaves an organ's probabilities untouched.
+
+With EARLY_EXIT enabled, the FIRST organ is detected and classified before
+the other one, and when its top calibrated probability reaches THRESHOLD
+the prediction is made from it alone: the second organ's detection and
+feature extraction are skipped or, with DEFER, run after the response so
+ml_fusion_early_exit_agreement_total measures how often the early answer
+matches the full one. Responses report the path taken under 'fusion'.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+from django.conf import settings
+
+from .registry import MODEL_PATHS
+
+ORGANS = ('bud', 'stem')
+
+STRATEGIES = ('weighted_mean', 'geometric_mean', 'max_confidence')
+
+DEFAULT_FUSION_CONFIG = {
+    'STRATEGY': 'weighted_mean',
+    'WEIGHTS': {'bud': 0.5, 'stem': 0.5},
+    'TEMPERATURES': {'bud': 1.0, 'stem': 1.0},
+    'EARLY_EXIT': {
+        'ENABLED': False,
+        'FIRST': 'bud',        # Organ processed first
+        'THRESHOLD': 0.9,      # Calibrated top probability at which the first organ decides alone
+        'DEFER': False,        # Run the skipped organ after responding, to measure agreement
+    },
+    # {'<bud classifier file>:<stem classifier file>': {setting overrides}}
+    'VERSIONS': {},
+}
+
+_SECTIONS = ('WEIGHTS', 'TEMPERATURES', 'EARLY_EXIT')
+
+
+def _merge(base, overrides):
+    merged = {**base, **overrides}
+    for section in _SECTIONS:
+        merged[section] = {**base[section], **overrides.get(section, {})}
+    return merged
+
+
+FUSION_CONFIG = _merge(DEFAULT_FUSION_CONFIG, getattr(settings, 'ML_FUSION', {}))
+
+
+def weighted_mean(bud_class_probabilities, stem_class_probabilities, bud_weight=0.5, stem_weight=0.5):
+    return (bud_weight * bud_class_probabilities + stem_weight * stem_class_probabilities) / (bud_weight + stem_weight)
+
+
+class FusionEngine:
+    def __init__(self, strategy, weights, temperatures, early_exit, version=''):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown fusion strategy: {strategy}")
+        if early_exit['FIRST'] not in ORGANS:
+            raise ValueError(f"Unknown early exit organ: {early_exit['FIRST']}")
+        self.strategy = strategy
+        self.weights = weights
+        self.temperatures = temperatures
+        self.early_exit = early_exit['ENABLED']
+        self.first = early_exit['FIRST']
+        self.threshold = early_exit['THRESHOLD']
+        self.defer = early_exit['DEFER']
+        self.version = version
+        self.order = (self.first,) + tuple(organ for organ in ORGANS if organ != self.first)
+        # Separates cached responses of different fusion settings; empty for the defaults
+        settings_json = json.dumps([strategy, weights, temperatures, early_exit], sort_keys=True)
+        default_json = json.dumps([
+            DEFAULT_FUSION_CONFIG['STRATEGY'], DEFAULT_FUSION_CONFIG['WEIGHTS'],
+            DEFAULT_FUSION_CONFIG['TEMPERATURES'], DEFAULT_FUSION_CONFIG['EARLY_EXIT'],
+        ], sort_keys=True)
+        self.signature = '' if settings_json == default_json else hashlib.blake2b(
+            settings_json.encode('utf-8'), digest_size=6).hexdigest()
+
+    @classmethod
+    def from_config(cls, config, model_paths):
+        """
+        Returns the engine for the given classifier files, applying their VERSIONS entry if any.
+        """
+        version = f"{os.path.basename(model_paths['bud_classifier'])}:{os.path.basename(model_paths['stem_classifier'])}"
+        if version in config['VERSIONS']:
+            config = _merge(config, config['VERSIONS'][version])
+        return cls(config['STRATEGY'], config['WEIGHTS'], config['TEMPERATURES'], config['EARLY_EXIT'], version)
+
+    def calibrate(self, organ, class_probabilities):
+        class_probabilities = np.asarray(class_probabilities, dtype=float)
+        temperature = self.temperatures[organ]
+        if temperature == 1:
+            return class_probabilities
+        scaled = np.power(class_probabilities, 1.0 / temperature)
+        return scaled / scaled.sum(axis=-1, keepdims=True)
+
+    def decisive(self, organ, class_probabilities):
+        """
+        Whether an organ's (1-D) probabilities are confident enough to skip the other organ.
+        """
+        return self.early_exit and float(self.calibrate(organ, class_probabilities).max()) >= self.threshold
+
+    def fuse(self, bud_class_probabilities, stem_class_probabilities):
+        """
+        Fuses bud and stem class probabilities (1-D or stacked 2-D). Either may be None
+        after an early exit, in which case the other organ's calibrated probabilities are returned.
+        """
+        if stem_class_probabilities is None:
+            return self.calibrate('bud', bud_class_probabilities)
+        if bud_class_probabilities is None:
+            return self.calibrate('stem', stem_class_probabilities)
+        bud = self.calibrate('bud', bud_class_probabilities)
+        stem = self.calibrate('stem', stem_class_probabilities)
+        bud_weight, stem_weight = self.weights['bud'], self.weights['stem']
+        if self.strategy == 'weighted_mean':
+            return weighted_mean(bud, stem, bud_weight, stem_weight)
+        if self.strategy == 'geometric_mean':
+            log_pooled = (bud_weight * np.log(np.maximum(bud, 1e-12)) + stem_weight * np.log(np.maximum(stem, 1e-12)))
+            pooled = np.exp(log_pooled / (bud_weight + stem_weight))
+            return pooled / pooled.sum(axis=-1, keepdims=True)
+        return np.where((bud.max(axis=-1) >= stem.max(axis=-1))[..., None], bud, stem)
+
+    def describe(self, organs):
+        """
+        Returns the 'fusion' entry of a response for a prediction made from the given organs.
+        """
+        return {
+            'path': 'full' if len(organs) == len(ORGANS) else 'early_exit',
+            'organs': list(organs),
+            'strategy': self.strategy,
+            'version': self.version,
+        }
+
+
+fusion_engine = FusionEngine.from_config(FUSION_CONFIG, MODEL_PATHS)
@@ -0,0 +1,454 @@
+"""
+Background job worker for submit/poll variety predictions.
+
+POST /api/jobs/ stores the uploads in a PredictionJob row and returns its id
+straight away; GET /api/jobs/<id>/ reports its status and, once finished,
+the same body predict_variety would have returned (or the error).
+
+Jobs are run by a worker started with each server process (see apps.py; with
+AUTOSTART off, on the first jobs request): a dispatcher thread claims queued
+jobs from the database, up to CONCURRENCY at a time, and runs them in a thread
+pool. Claims are atomic updates, so several server processes can share one
+queue, and a job stores its result only while it is still claimed by the
+worker that ran it.
+
+Crash recovery: a job left 'running' by a process that is gone (same host,
+pid no longer running or reused by a restarted server) or that has been
+running for longer than STALE_AFTER seconds is queued again, up to
+MAX_ATTEMPTS runs in total, then failed. Finished jobs are deleted RETENTION
+seconds after they finish.
+
+When a job has a webhook_url, the finished job is POSTed there as JSON, from
+a separate pool of WEBHOOK_WORKERS threads so retries never hold a job slot.
+With WEBHOOK_SECRET set, the body is signed with HMAC-SHA256 in the
+X-Signature-SHA256 header. Webhook URLs must name a host in
+WEBHOOK_ALLOWED_HOSTS when that is set, and otherwise resolve to public
+addresses only (checked on submission and again before each delivery;
+redirects are not followed), so jobs cannot be used to reach loopback,
+private or link-local services such as cloud metadata endpoints. The
+delivery connects to the very addresses it checked rather than resolving
+the host again, so a host whose DNS answer changes in between (DNS
+rebinding) cannot slip through; it also bypasses HTTP(S)_PROXY, which would
+resolve the host itself.
+"""
+import hashlib
+import hmac
+import http.client
+import ipaddress
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import F
+from django.utils import timezone
+
+from .feature_store import pair_keys
+from .metrics import JOBS
+from .models import PredictionJob
+from .pipeline import (
+    MULTI_DETECTION_CONFIG, SKIPPED_ORGAN, classify_organs, detections_summary, variety_response,
+)
+from .uploads import UploadRejected, decode_for_detection
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JOBS_CONFIG = {
+    'CONCURRENCY': 2,
+    'POLL_INTERVAL': 5.0,       # Seconds between checks for jobs queued by other processes
+    'RETENTION': 24 * 3600,     # Seconds finished jobs are kept
+    'STALE_AFTER': 15 * 60,     # Seconds after which a running job is assumed lost
+    'MAX_ATTEMPTS': 3,
+    'MAINTENANCE_INTERVAL': 60.0,
+    'WEBHOOK_TIMEOUT': 5.0,
+    'WEBHOOK_RETRIES': 3,
+    'WEBHOOK_SECRET': '',
+    'WEBHOOK_WORKERS': 2,
+    'WEBHOOK_ALLOWED_HOSTS': [],    # When set, the only hosts webhooks may be sent to
+    'AUTOSTART': True,              # Start the worker with the server rather than on the first jobs request
+}
+
+JOBS_CONFIG = {**DEFAULT_JOBS_CONFIG, **getattr(settings, 'ML_JOBS', {})}
+
+_worker_ids = {}
+
+
+def current_worker_id():
+    """
+    Identifies this process; the start token tells a restarted server apart from one reusing
+    its pid. Looked up per pid, so processes forked after startup (gunicorn --preload) each
+    get their own.
+    """
+    pid = os.getpid()
+    if pid not in _worker_ids:
+        _worker_ids[pid] = f"{socket.gethostname()}:{pid}:{int(time.time() * 1000)}"
+    return _worker_ids[pid]
+
+
+class JobError(Exception):
+    """
+    Raised by the job pipeline for an expected failure (undecodable image, nothing detected).
+    """
+
+
+# ============================
+# Running Jobs
+# ============================
+
+def run_variety_pipeline(bud_bytes, bud_image_name, stem_bytes, stem_image_name):
+    """
+    Runs the predict_variety pipeline on raw upload bytes and returns its response body.
+    """
+    try:
+        bud_image = decode_for_detection(bud_bytes, 'Bud image', 'bud')
+        stem_image = decode_for_detection(stem_bytes, 'Stem image', 'stem')
+    except UploadRejected as e:
+        raise JobError(str(e))
+    if bud_image is None:
+        raise JobError('Bud image could not be decoded')
+    if stem_image is None:
+        raise JobError('Stem image could not be decoded')
+
+    results, missing = classify_organs({'bud': bud_image, 'stem': stem_image}, pair_keys([bud_bytes], [stem_bytes]))
+    if missing is not None:
+        raise JobError(f'No {missing} detected in the image')
+    bud_crops, bud_boxes, bud_confidences, bud_class_probabilities = results.get('bud', SKIPPED_ORGAN)
+    stem_crops, stem_boxes, stem_confidences, stem_class_probabilities = results.get('stem', SKIPPED_ORGAN)
+    response = variety_response(
+        bud_crops[0] if bud_crops else None, bud_image_name, stem_crops[0] if stem_crops else None, stem_image_name,
+        bud_class_probabilities, stem_class_probabilities,
+    )
+    if MULTI_DETECTION_CONFIG['ENABLED']:
+        response['detections'] = {
+            'bud': detections_summary(bud_boxes, bud_confidences),
+            'stem': detections_summary(stem_boxes, stem_confidences),
+        }
+    return response
+
+
+def claim_job(job_id, worker_id=None):
+    """
+    Atomically moves a queued job to running for this worker. Returns False if another worker got it first.
+    """
+    worker_id = worker_id or current_worker_id()
+    claimed = PredictionJob.objects.filter(pk=job_id, status=PredictionJob.QUEUED).update(
+        status=PredictionJob.RUNNING, worker=worker_id, started_at=timezone.now(), attempts=F('attempts') + 1,
+    )
+    return bool(claimed)
+
+
+def run_job(job_id, worker_id=None):
+    """
+    Runs a job claimed by worker_id and stores its result or error; the uploaded images are
+    dropped once it finishes. Returns the finished job, or None if the job was taken from
+    this worker meanwhile (recovered as interrupted), in which case nothing is stored.
+    """
+    worker_id = worker_id or current_worker_id()
+    job = PredictionJob.objects.get(pk=job_id)
+    try:
+        job.result = run_variety_pipeline(
+            bytes(job.bud_image), job.bud_image_name, bytes(job.stem_image), job.stem_image_name,
+        )
+        job.status = PredictionJob.SUCCEEDED
+    except JobError as e:
+        job.status, job.error = PredictionJob.FAILED, str(e)
+    except Exception as e:
+        logger.exception("Job %s failed", job_id)
+        job.status, job.error = PredictionJob.FAILED, str(e)
+
+    job.bud_image = job.stem_image = b''
+    job.finished_at = timezone.now()
+    # Conditional on the claim, so a job recovery has requeued meanwhile is not overwritten
+    stored = PredictionJob.objects.filter(pk=job_id, status=PredictionJob.RUNNING, worker=worker_id).update(
+        status=job.status, result=job.result, error=job.error, bud_image=b'', stem_image=b'', finished_at=job.finished_at,
+    )
+    if not stored:
+        logger.warning("Job %s was taken over by another worker; discarding its %s result", job_id, job.status)
+        return None
+    JOBS.inc(job.status)
+    logger.debug("Job %s %s", job_id, job.status)
+    return job
+
+
+# ============================
+# Webhooks
+# ============================
+
+def _public_address(address):
+    ip = ipaddress.ip_address(address.split('%', 1)[0])  # Drop an IPv6 zone index
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return ip.is_global
+
+
+def webhook_url_allowed(url):
+    """
+    Whether a webhook may be sent to url: its host must be in WEBHOOK_ALLOWED_HOSTS when
+    that is set, and otherwise resolve to public addresses only (not loopback, private,
+    link-local, shared or reserved ones).
+    """
+    try:
+        host = urllib.parse.urlsplit(url).hostname
+    except ValueError:
+        return False
+    if not host:
+        return False
+    allowed = JOBS_CONFIG['WEBHOOK_ALLOWED_HOSTS']
+    if allowed:
+        return host.lower() in {allowed_host.lower() for allowed_host in allowed}
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, None)}
+    except (socket.gaierror, UnicodeError):
+        return False
+    return bool(addresses) and all(_public_address(address) for address in addresses)
+
+
+class _NoRedirects(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None  # A redirect could point anywhere, including internal addresses
+
+
+def _connect_public(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None, **kwargs):
+    """
+    socket.create_connection that resolves the host once and connects only if every address
+    is public, to the address it checked.
+    """
+    host, port = address
+    addresses = [info[4][0] for info in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)]
+    if not addresses or not all(_public_address(ip) for ip in addresses):
+        raise ConnectionRefusedError(f"{host} does not resolve to public addresses only")
+    error = None
+    for ip in addresses:
+        try:
+            return socket.create_connection((ip, port), timeout, source_address)
+        except OSError as e:
+            error = e
+    raise error
+
+
+class _PublicHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _connect_public
+
+
+class _PublicHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _connect_public  # TLS is still verified against the host name
+
+
+class _PublicHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(_PublicHTTPConnection, req)
+
+
+class _PublicHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(_PublicHTTPSConnection, req, context=self._context)
+
+
+# Hosts named in WEBHOOK_ALLOWED_HOSTS are trusted wherever they resolve; any other host is
+# connected to directly (no proxy) and only at the public addresses checked on connect
+_allowed_host_opener = urllib.request.build_opener(_NoRedirects)
+_public_opener = urllib.request.build_opener(
+    urllib.request.ProxyHandler({}), _NoRedirects, _PublicHTTPHandler, _PublicHTTPSHandler)
+
+
+def deliver_webhook(job):
+    """
+    POSTs the finished job to its webhook URL, retrying with backoff on failure.
+    Blocks for the retries; JobWorker runs it in its webhook pool.
+    """
+    if not webhook_url_allowed(job.webhook_url):
+        logger.warning("Not delivering webhook for job %s: %s is not an allowed address", job.pk, job.webhook_url)
+        return False
+    body = json.dumps(job.to_dict()).encode('utf-8')
+    headers = {'Content-Type': 'application/json'}
+    if JOBS_CONFIG['WEBHOOK_SECRET']:
+        signature = hmac.new(JOBS_CONFIG['WEBHOOK_SECRET'].encode('utf-8'), body, hashlib.sha256).hexdigest()
+        headers['X-Signature-SHA256'] = signature
+
+    opener = _allowed_host_opener if JOBS_CONFIG['WEBHOOK_ALLOWED_HOSTS'] else _public_opener
+    for attempt in range(JOBS_CONFIG['WEBHOOK_RETRIES']):
+        try:
+            request = urllib.request.Request(job.webhook_url, data=body, headers=headers, method='POST')
+            with opener.open(request, timeout=JOBS_CONFIG['WEBHOOK_TIMEOUT']):
+                pass
+            PredictionJob.objects.filter(pk=job.pk).update(webhook_delivered=True)
+            return True
+        except Exception as e:
+            logger.warning("Webhook for job %s failed (attempt %d): %s", job.pk, attempt + 1, e)
+            if attempt + 1 < JOBS_CONFIG['WEBHOOK_RETRIES']:
+                time.sleep(2 ** attempt)
+    return False
+
+
+# ============================
+# Recovery and Retention
+# ============================
+
+def _worker_gone(worker):
+    try:
+        host, pid, token = worker.rsplit(':', 2)
+        pid = int(pid)
+    except ValueError:
+        return True
+    if host != socket.gethostname():
+        return False  # Cannot check another host; left to STALE_AFTER
+    if pid == os.getpid():
+        return worker != current_worker_id()  # Our pid, but an earlier process that used it
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+def recover_interrupted_jobs():
+    """
+    Requeues running jobs whose worker is gone or which have gone stale, failing
+    those that already used MAX_ATTEMPTS. Returns the number of jobs recovered.
+    """
+    stale_before = timezone.now() - timedelta(seconds=JOBS_CONFIG['STALE_AFTER'])
+    recovered = 0
+    running = PredictionJob.objects.filter(status=PredictionJob.RUNNING).exclude(worker=current_worker_id())
+    for job in running.only('id', 'worker', 'attempts', 'started_at'):
+        if not (_worker_gone(job.worker) or (job.started_at and job.started_at < stale_before)):
+            continue
+        # Conditional on the same worker, so a job that finished meanwhile is left alone
+        interrupted = PredictionJob.objects.filter(pk=job.pk, status=PredictionJob.RUNNING, worker=job.worker)
+        if job.attempts >= JOBS_CONFIG['MAX_ATTEMPTS']:
+            updated = interrupted.update(
+                status=PredictionJob.FAILED, error='Job was interrupted too many times',
+                bud_image=b'', stem_image=b'', finished_at=timezone.now(),
+            )
+        else:
+            updated = interrupted.update(status=PredictionJob.QUEUED, worker='', started_at=None)
+        if updated:
+            logger.warning("Recovered interrupted job %s from worker %s", job.pk, job.worker)
+            recovered += 1
+    return recovered
+
+
+def purge_finished_jobs():
+    """
+    Deletes jobs that finished more than RETENTION seconds ago. Returns the number deleted.
+    """
+    cutoff = timezone.now() - timedelta(seconds=JOBS_CONFIG['RETENTION'])
+    deleted, _ = PredictionJob.objects.filter(status__in=PredictionJob.FINISHED, finished_at__lt=cutoff).delete()
+    return deleted
+
+
+# ============================
+# Worker
+# ============================
+
+class JobWorker:
+    def __init__(self, concurrency, poll_interval, maintenance_interval, webhook_workers):
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.maintenance_interval = maintenance_interval
+        self.webhook_workers = webhook_workers
+        self.running = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._executor = None
+        self._webhook_executor = None
+        self._thread = None
+        self._pid = None
+        self._last_maintenance = 0.0
+
+    def start(self):
+        """
+        Starts the dispatcher thread and the job pools once per process.
+        """
+        with self._lock:
+            # A process forked from one that started the worker inherits none of its threads
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.running = 0
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='prediction-job')
+            self._webhook_executor = ThreadPoolExecutor(
+                max_workers=self.webhook_workers, thread_name_prefix='prediction-job-webhook')
+            self._thread = threading.Thread(target=self._loop, name='prediction-job-dispatcher', daemon=True)
+            self._thread.start()
+
+    def notify(self):
+        """
+        Wakes the dispatcher, e.g. after a job was submitted.
+        """
+        self._wake.set()
+
+    def _loop(self):
+        while True:
+            try:
+                self._maintain()
+                self._dispatch()
+            except Exception:
+                logger.exception("Job dispatcher error")
+            finally:
+                connections.close_all()
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+    def _maintain(self):
+        now = time.monotonic()
+        if now - self._last_maintenance < self.maintenance_interval:
+            return
+        self._last_maintenance = now
+        recover_interrupted_jobs()
+        deleted = purge_finished_jobs()
+        if deleted:
+            logger.info("Deleted %d expired prediction jobs", deleted)
+
+    def _dispatch(self):
+        free = self.concurrency - self.running
+        if free <= 0:
+            return
+        queued = PredictionJob.objects.filter(status=PredictionJob.QUEUED).values_list('id', flat=True)[:free]
+        for job_id in list(queued):
+            if claim_job(job_id):
+                with self._lock:
+                    self.running += 1
+                self._executor.submit(self._run, job_id)
+
+    def _run(self, job_id):
+        try:
+            job = run_job(job_id)
+            if job is not None and job.webhook_url:
+                self._webhook_executor.submit(self._deliver, job)
+        except Exception:
+            logger.exception("Job %s could not be run", job_id)
+        finally:
+            connections.close_all()
+            with self._lock:
+                self.running -= 1
+            self._wake.set()
+
+    def _deliver(self, job):
+        try:
+            deliver_webhook(job)
+        except Exception:
+            logger.exception("Webhook for job %s could not be delivered", job.pk)
+        finally:
+            connections.close_all()
+
+
+job_worker = JobWorker(
+    JOBS_CONFIG['CONCURRENCY'],
+    JOBS_CONFIG['POLL_INTERVAL'],
+    JOBS_CONFIG['MAINTENANCE_INTERVAL'],
+    JOBS_CONFIG['WEBHOOK_WORKERS'],
+)
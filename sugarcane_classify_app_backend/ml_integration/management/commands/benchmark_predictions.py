@@ -0,0 +1,85 @@
+import json
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ml_integration.benchmark import (
+    DEFAULT_CORPUS_DIR, ENDPOINTS, compare_runs, load_corpus, run_benchmark, run_metadata,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Replays a corpus of bud/stem images through the prediction endpoints and reports "
+        "p50/p95/p99 latency, throughput per concurrency level and per-stage timings, "
+        "writing the results to a JSON file for comparison across commits."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--endpoints', nargs='+', choices=list(ENDPOINTS), default=['predict'])
+        parser.add_argument('--corpus-dir', default=DEFAULT_CORPUS_DIR)
+        parser.add_argument('--corpus-limit', type=int, default=None, help="Use at most this many images")
+        parser.add_argument('--requests', type=int, default=100, help="Measured requests per concurrency level")
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4])
+        parser.add_argument('--warmup', type=int, default=5, help="Unmeasured requests sent first")
+        parser.add_argument('--use-cache', action='store_true',
+                            help="Let requests hit the prediction cache (bypassed by default)")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', default=None,
+                            help="Results file (default: benchmarks/<timestamp>-<commit>.json)")
+        parser.add_argument('--compare', default=None, help="Earlier results file to compare against")
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1 or min(options['concurrency']) < 1:
+            raise CommandError("--requests and --concurrency must be at least 1")
+        corpus = load_corpus(options['corpus_dir'], options['corpus_limit'])
+        self.stdout.write(f"Loaded {len(corpus)} images from {options['corpus_dir']}")
+
+        report = {'meta': run_metadata(options['corpus_dir'], corpus), 'runs': []}
+        for endpoint in options['endpoints']:
+            for concurrency in options['concurrency']:
+                try:
+                    run = run_benchmark(
+                        endpoint, corpus,
+                        requests=options['requests'],
+                        concurrency=concurrency,
+                        warmup=options['warmup'],
+                        use_cache=options['use_cache'],
+                        seed=options['seed'],
+                    )
+                except ValueError as e:
+                    raise CommandError(str(e))
+                report['runs'].append(run)
+                self.write_run(run)
+
+        output = options['output'] or self.default_output(report['meta'])
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        self.stdout.write(self.style.SUCCESS(f"Wrote {output}"))
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+            self.stdout.write(f"Compared with {options['compare']} ({baseline['meta'].get('git_commit')}):")
+            for line in compare_runs(baseline, report):
+                self.stdout.write(f"  {line}")
+
+    def write_run(self, run):
+        latency = run['latency_ms']
+        self.stdout.write(
+            f"{run['endpoint']} @ concurrency {run['concurrency']}: {run['requests']} requests, "
+            f"{run['throughput_rps']:.1f} req/s, statuses {run['statuses']}"
+        )
+        self.stdout.write(
+            f"  latency ms: p50 {latency['p50']:.1f}  p95 {latency['p95']:.1f}  "
+            f"p99 {latency['p99']:.1f}  max {latency['max']:.1f}"
+        )
+        for name, stage in run['stages_ms'].items():
+            self.stdout.write(f"  {name:<9} mean {stage['mean']:8.2f} ms  p95 {stage['p95']:8.2f} ms")
+
+    def default_output(self, meta):
+        timestamp = meta['timestamp'][:19].replace(':', '').replace('-', '')
+        commit = (meta['git_commit'] or 'nogit')[:10]
+        return os.path.join(settings.BASE_DIR, 'benchmarks', f"{timestamp}-{commit}.json")
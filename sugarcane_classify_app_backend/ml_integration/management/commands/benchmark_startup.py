@@ -0,0 +1,71 @@
+import json
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ml_integration.benchmark import run_metadata
+from ml_integration.profiles import PROFILES
+from ml_integration.startup import measure_profile
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures the startup of each deployment profile (ML_PROFILE) in fresh interpreters: "
+        "import time, RSS and the heavy libraries loaded, optionally after warming up the "
+        "profile's models, and writes the results to a JSON file for comparison across commits."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profiles', nargs='+', choices=PROFILES, default=list(PROFILES))
+        parser.add_argument('--repeat', type=int, default=3, help="Interpreters started per profile (the median is reported)")
+        parser.add_argument('--warm-up', action='store_true', help="Also load and warm up the profile's models")
+        parser.add_argument('--output', default=None,
+                            help="Results file (default: benchmarks/startup-<timestamp>-<commit>.json)")
+        parser.add_argument('--compare', default=None, help="Earlier results file to compare against")
+
+    def handle(self, *args, **options):
+        meta = run_metadata()
+        report = {'meta': meta, 'runs': []}
+        for profile in options['profiles']:
+            try:
+                run = measure_profile(profile, options['repeat'], options['warm_up'], cwd=settings.BASE_DIR)
+            except RuntimeError as e:
+                raise CommandError(str(e))
+            report['runs'].append(run)
+            self.write_run(run)
+
+        output = options['output'] or self.default_output(meta)
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        self.stdout.write(self.style.SUCCESS(f"Wrote {output}"))
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+            previous = {run['profile']: run for run in baseline['runs']}
+            self.stdout.write(f"Compared with {options['compare']} ({baseline['meta'].get('git_commit')}):")
+            for run in report['runs']:
+                before = previous.get(run['profile'])
+                if before is None:
+                    continue
+                self.stdout.write(
+                    f"  {run['profile']}: import {before['import_seconds'] * 1000:.0f} -> {run['import_seconds'] * 1000:.0f} ms, "
+                    f"RSS {before['rss_mb']:.0f} -> {run['rss_mb']:.0f} MB"
+                )
+
+    def write_run(self, run):
+        self.stdout.write(
+            f"{run['profile']}: import {run['import_seconds'] * 1000:.0f} ms "
+            f"(setup {run['setup_seconds'] * 1000:.0f} ms, urls {run['urls_seconds'] * 1000:.0f} ms), "
+            f"process {run['wall_seconds'] * 1000:.0f} ms, RSS {run['rss_mb']:.0f} MB, {run['modules']} modules"
+        )
+        if run['warm_up_seconds'] is not None:
+            self.stdout.write(f"  warm-up {run['warm_up_seconds'] * 1000:.0f} ms")
+        self.stdout.write(f"  heavy libraries: {', '.join(run['heavy_modules']) or 'none'}")
+
+    def default_output(self, meta):
+        timestamp = meta['timestamp'][:19].replace(':', '').replace('-', '')
+        commit = (meta['git_commit'] or 'nogit')[:10]
+        return os.path.join(settings.BASE_DIR, 'benchmarks', f"startup-{timestamp}-{commit}.json")
@@ -0,0 +1,35 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ml_integration.registry import MODEL_PATHS, load_pickle, registry
+from ml_integration.sugar_grid import GRID_CONFIG, build_grid
+
+
+class Command(BaseCommand):
+    help = (
+        "Precomputes the sugar production model over the ML_SUGAR_GRID axes into a "
+        "memory-mapped .npy grid and records its maximum interpolation error."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=GRID_CONFIG['PATH'],
+                            help="Grid file to write (a .json metadata file is written next to it)")
+
+    def handle(self, *args, **options):
+        model_path = MODEL_PATHS['sugar_production']
+        if not os.path.exists(model_path):
+            raise CommandError(f"Sugar production model not found: {model_path}")
+
+        self.stdout.write(f"Building sugar production grid from {model_path}...")
+        metadata = build_grid(load_pickle(model_path), options['output'], registry.fingerprint(['sugar_production']))
+        shape = ' x '.join(str(size) for size in metadata['shape'])
+        self.stdout.write(self.style.SUCCESS(
+            f"  wrote {options['output']} ({shape} points, "
+            f"{os.path.getsize(options['output']) / 1e6:.1f} MB) in {metadata['build_seconds']:.1f}s"
+        ))
+        self.stdout.write(
+            f"  max interpolation error: {metadata['max_error']:.4g} tons ({metadata['max_error_method']})"
+        )
+        if not GRID_CONFIG['ENABLED']:
+            self.stdout.write(self.style.WARNING("  ML_SUGAR_GRID['ENABLED'] is off; the grid will not be used"))
@@ -0,0 +1,74 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ml_integration.offline import (
+    OUTPUT_FORMATS, classify_pairs, output_format, pairs_from_dirs, pairs_from_manifest,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Classifies every bud/stem image pair of an archive with a process pool, using the "
+        "same pipeline as predict_variety, and appends the results to a CSV or JSONL file. "
+        "Re-running with the same output resumes an interrupted run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bud-dir', help="Directory of bud images, paired with --stem-dir by relative path")
+        parser.add_argument('--stem-dir', help="Directory of stem images")
+        parser.add_argument('--manifest', help="CSV file with bud_image, stem_image and optional id columns")
+        parser.add_argument('--output', required=True, help="Results file (.csv or .jsonl)")
+        parser.add_argument('--format', choices=OUTPUT_FORMATS, help="Output format (default: from the extension)")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--threads-per-worker', type=int, default=1,
+                            help="OpenCV / PyTorch threads in each worker process")
+        parser.add_argument('--chunk-pairs', type=int, default=64, help="Pairs per worker task")
+        parser.add_argument('--batch-pairs', type=int, default=8, help="Pairs per detector / classifier call")
+        parser.add_argument('--restart', action='store_true', help="Discard an existing output file instead of resuming")
+
+    def handle(self, *args, **options):
+        if options['manifest']:
+            if options['bud_dir'] or options['stem_dir']:
+                raise CommandError("Use either --manifest or --bud-dir/--stem-dir")
+            try:
+                pairs = pairs_from_manifest(options['manifest'])
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Cannot read manifest: {str(e)}")
+        elif options['bud_dir'] and options['stem_dir']:
+            for directory in (options['bud_dir'], options['stem_dir']):
+                if not os.path.isdir(directory):
+                    raise CommandError(f"Directory not found: {directory}")
+            pairs, unmatched = pairs_from_dirs(options['bud_dir'], options['stem_dir'])
+            if unmatched:
+                self.stdout.write(self.style.WARNING(
+                    f"{len(unmatched)} images have no partner and are skipped, e.g. {unmatched[0]}"
+                ))
+        else:
+            raise CommandError("Give --manifest or both --bud-dir and --stem-dir")
+
+        output = options['output']
+        if options['restart'] and os.path.exists(output):
+            os.remove(output)
+        fmt = output_format(output, options['format'])
+        self.stdout.write(f"Classifying {len(pairs)} pairs with {options['workers']} workers into {output}...")
+
+        def progress(summary):
+            done = summary['skipped'] + summary['classified'] + summary['failed']
+            rate = summary['classified'] / summary['seconds'] if summary['seconds'] else 0.0
+            self.stdout.write(f"  {done}/{summary['pairs']} pairs ({rate:.1f} pairs/s)")
+
+        summary = classify_pairs(
+            pairs, output, fmt,
+            workers=options['workers'],
+            chunk_pairs=options['chunk_pairs'],
+            batch_pairs=options['batch_pairs'],
+            threads=options['threads_per_worker'],
+            progress=progress,
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Classified {summary['classified']} pairs in {summary['seconds']:.1f}s "
+            f"({summary['errors']} with errors, {summary['skipped']} already done)"
+        ))
+        if summary['failed']:
+            raise CommandError(f"{summary['failed']} pairs failed; run the command again to retry them")
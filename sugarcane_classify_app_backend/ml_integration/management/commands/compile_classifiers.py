@@ -0,0 +1,85 @@
+import glob
+import os
+import time
+
+import cv2
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ml_integration import features
+from ml_integration.compiled_trees import CompiledForest, compile_classifier, compiled_path
+from ml_integration.registry import MODEL_PATHS, load_joblib
+
+CORPUS = {
+    'bud_classifier': ('cropped_buds', features.extract_bud_features),
+    'stem_classifier': ('cropped_stems', features.extract_stem_features),
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Compiles the bud RF and stem XGBoost classifiers into flattened array-backed "
+        "ensembles (<pickle>.compiled.npz) and checks their probabilities against the "
+        "originals on a corpus of cropped images, for use with ML_USE_COMPILED_CLASSIFIERS."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--models', nargs='+', choices=list(CORPUS), default=list(CORPUS))
+        parser.add_argument('--corpus-root', default=str(settings.BASE_DIR),
+                            help="Directory containing cropped_buds/ and cropped_stems/ sample crops")
+        parser.add_argument('--tolerance', type=float, default=1e-6,
+                            help="Maximum allowed absolute difference in class probabilities")
+
+    def handle(self, *args, **options):
+        for name in options['models']:
+            model_path = MODEL_PATHS[name]
+            if not os.path.exists(model_path):
+                raise CommandError(f"Classifier {name} not found: {model_path}")
+
+            self.stdout.write(f"Compiling {name} ({model_path})...")
+            model = load_joblib(model_path)
+            try:
+                compiled = compile_classifier(model)
+            except ValueError as e:
+                raise CommandError(f"Cannot compile {name}: {str(e)}")
+
+            target = compiled_path(model_path)
+            compiled.save(target)
+            compiled = CompiledForest.load(target)
+            self.stdout.write(self.style.SUCCESS(
+                f"  wrote {target} ({compiled.n_trees} trees, {compiled.n_nodes} nodes, "
+                f"{os.path.getsize(target) / 1e6:.1f} MB vs {os.path.getsize(model_path) / 1e6:.1f} MB pickle)"
+            ))
+            self.check_parity(name, model, compiled, options)
+
+    def load_corpus(self, name, corpus_root):
+        directory, extract = CORPUS[name]
+        paths = sorted(glob.glob(os.path.join(corpus_root, directory, '*')))
+        crops = [crop for crop in (cv2.imread(path) for path in paths) if crop is not None]
+        if not crops:
+            return None
+        return extract(features.resize_batch(crops))
+
+    def check_parity(self, name, model, compiled, options):
+        X = self.load_corpus(name, options['corpus_root'])
+        if X is None:
+            self.stdout.write(self.style.WARNING(f"  no corpus images for {name}; parity not checked"))
+            return
+
+        start = time.perf_counter()
+        expected = model.predict_proba(X)
+        original_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        actual = compiled.predict_proba(X)
+        compiled_seconds = time.perf_counter() - start
+
+        max_error = float(np.abs(expected - actual).max())
+        mismatched = int((expected.argmax(axis=1) != actual.argmax(axis=1)).sum())
+        self.stdout.write(
+            f"  {len(X)} samples: max |dp| = {max_error:.3g}, {mismatched} argmax mismatches, "
+            f"{original_seconds * 1000:.1f} ms original vs {compiled_seconds * 1000:.1f} ms compiled"
+        )
+        if max_error > options['tolerance'] or mismatched:
+            os.remove(compiled_path(MODEL_PATHS[name]))
+            raise CommandError(f"Compiled {name} does not match the original model; removed the compiled file")
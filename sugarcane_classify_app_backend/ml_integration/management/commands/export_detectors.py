@@ -0,0 +1,106 @@
+import glob
+import os
+import shutil
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from ml_integration.detectors import exported_path, preprocess
+from ml_integration.registry import MODEL_PATHS
+
+
+class Command(BaseCommand):
+    help = (
+        "Exports the bud and stem YOLO detectors to ONNX (optionally INT8-quantized) or OpenVINO, "
+        "next to the .pt weights, for use with ML_DETECTOR_BACKEND."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=['onnx', 'openvino'], default='onnx')
+        parser.add_argument('--models', nargs='+', choices=['bud_detector', 'stem_detector'],
+                            default=['bud_detector', 'stem_detector'])
+        parser.add_argument('--imgsz', type=int, default=640)
+        parser.add_argument('--int8', action='store_true',
+                            help="Also write an INT8-quantized copy (<name>.int8.onnx or <name>_int8_openvino_model)")
+        parser.add_argument('--calibration-dir', default=None,
+                            help="Directory of sample images for static INT8 calibration; "
+                                 "without it ONNX weights are quantized dynamically")
+        parser.add_argument('--calibration-images', type=int, default=64)
+
+    def handle(self, *args, **options):
+        try:
+            from ultralytics import YOLO
+        except ImportError:
+            raise CommandError("Exporting requires ultralytics (and torch) to be installed")
+
+        for name in options['models']:
+            weights_path = MODEL_PATHS[name]
+            if not os.path.exists(weights_path):
+                raise CommandError(f"Weights for {name} not found: {weights_path}")
+
+            self.stdout.write(f"Exporting {name} ({weights_path}) to {options['format']}...")
+            model = YOLO(weights_path)
+            if options['format'] == 'onnx':
+                # Dynamic axes so the micro-batcher can send several images per call
+                exported = model.export(format='onnx', imgsz=options['imgsz'], dynamic=True, simplify=True)
+                self.stdout.write(self.style.SUCCESS(f"  wrote {exported}"))
+                if options['int8']:
+                    target = exported_path(weights_path, 'onnx', int8=True)
+                    self.quantize_onnx(exported, target, options)
+                    self.stdout.write(self.style.SUCCESS(f"  wrote {target}"))
+            else:
+                exported = model.export(format='openvino', imgsz=options['imgsz'])
+                self.stdout.write(self.style.SUCCESS(f"  wrote {exported}"))
+                if options['int8']:
+                    if not options['calibration_dir']:
+                        raise CommandError("OpenVINO INT8 export needs --calibration-dir (a YOLO dataset yaml)")
+                    exported = model.export(format='openvino', imgsz=options['imgsz'], int8=True,
+                                            data=options['calibration_dir'])
+                    target = exported_path(weights_path, 'openvino', int8=True)
+                    if os.path.abspath(exported) != os.path.abspath(target):
+                        shutil.rmtree(target, ignore_errors=True)
+                        shutil.move(exported, target)
+                    self.stdout.write(self.style.SUCCESS(f"  wrote {target}"))
+
+    def quantize_onnx(self, source, target, options):
+        try:
+            from onnxruntime.quantization import (
+                CalibrationDataReader, QuantFormat, QuantType, quantize_dynamic, quantize_static,
+            )
+        except ImportError:
+            raise CommandError("INT8 quantization requires onnxruntime to be installed")
+
+        if not options['calibration_dir']:
+            quantize_dynamic(source, target, weight_type=QuantType.QUInt8)
+            return
+
+        import cv2
+        import onnxruntime as ort
+
+        paths = sorted(
+            glob.glob(os.path.join(options['calibration_dir'], '*.jpg'))
+            + glob.glob(os.path.join(options['calibration_dir'], '*.png'))
+        )[:options['calibration_images']]
+        if not paths:
+            raise CommandError(f"No calibration images found in {options['calibration_dir']}")
+        input_name = ort.InferenceSession(source, providers=['CPUExecutionProvider']).get_inputs()[0].name
+        imgsz = options['imgsz']
+
+        class ImageReader(CalibrationDataReader):
+            """
+            Feeds letterboxed calibration images exactly as the ONNX backend preprocesses them.
+            """
+
+            def __init__(self):
+                self._paths = iter(paths)
+
+            def get_next(self):
+                for path in self._paths:
+                    image = cv2.imread(path)
+                    if image is not None:
+                        batch, _ = preprocess([image], imgsz)
+                        return {input_name: batch.astype(np.float32)}
+                return None
+
+        quantize_static(source, target, ImageReader(), quant_format=QuantFormat.QDQ,
+                        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
@@ -0,0 +1,28 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ml_integration.crops import CROPS_CONFIG, purge_crops
+
+
+class Command(BaseCommand):
+    help = (
+        "Deletes crop thumbnails of lean responses (ML_CROPS) last referenced more than RETENTION "
+        "seconds ago, then the least recently referenced ones until the crop store holds at most "
+        "MAX_BYTES. Run it periodically."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retention', type=float, default=CROPS_CONFIG['RETENTION'],
+                            help="Seconds a crop is kept after it was last referenced")
+        parser.add_argument('--max-bytes', type=int, default=CROPS_CONFIG['MAX_BYTES'],
+                            help="Total size to purge the store down to")
+
+    def handle(self, *args, **options):
+        if not os.path.isdir(CROPS_CONFIG['DIR']):
+            self.stdout.write(f"No crop store at {CROPS_CONFIG['DIR']}")
+            return
+        if options['max_bytes'] is not None and options['max_bytes'] < 0:
+            raise CommandError("--max-bytes must not be negative")
+        deleted, deleted_bytes = purge_crops(options['retention'], options['max_bytes'])
+        self.stdout.write(f"Deleted {deleted} crops ({deleted_bytes / (1024 * 1024):.1f} MB)")
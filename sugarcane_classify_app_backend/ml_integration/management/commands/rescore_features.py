@@ -0,0 +1,87 @@
+import csv
+import os
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from ml_integration.feature_store import FEATURE_STORE_CONFIG, FeatureStore, key_hex, rescore
+from ml_integration.pipeline import combine_probabilities, final_prediction
+from ml_integration.registry import MODEL_PATHS, load_classifier, load_joblib
+
+CLASSIFIERS = {'bud': 'bud_classifier', 'stem': 'stem_classifier'}
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-scores every bud/stem pair in the feature store (ML_FEATURE_STORE) with the given "
+        "classifier pickles, without decoding images or running detection and feature "
+        "extraction, and reports how the predictions differ from the current models'."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bud-classifier', help="Bud classifier pickle (default: the current model)")
+        parser.add_argument('--stem-classifier', help="Stem classifier pickle (default: the current model)")
+        parser.add_argument('--store', default=FEATURE_STORE_CONFIG['DIR'], help="Feature store directory")
+        parser.add_argument('--chunk-rows', type=int, default=FEATURE_STORE_CONFIG['CHUNK_ROWS'],
+                            help="Feature rows per predict_proba call")
+        parser.add_argument('--output', help="CSV file to write one row per re-scored pair to")
+
+    def handle(self, *args, **options):
+        if not os.path.isdir(options['store']):
+            raise CommandError(f"Feature store not found: {options['store']}")
+        store = FeatureStore(options['store'], options['chunk_rows'], FEATURE_STORE_CONFIG['FLUSH_INTERVAL'])
+
+        scores = {}
+        for organ, model_name in CLASSIFIERS.items():
+            path = options[f'{organ}_classifier']
+            if path and not os.path.exists(path):
+                raise CommandError(f"Classifier not found: {path}")
+            if not os.path.exists(MODEL_PATHS[model_name]):
+                raise CommandError(f"Current {model_name} not found: {MODEL_PATHS[model_name]}")
+            new_model = load_joblib(path) if path else None
+            current_model = load_classifier(MODEL_PATHS[model_name])
+
+            start = time.perf_counter()
+            try:
+                images, pairs, current = rescore(store, organ, current_model, options['chunk_rows'])
+                new = rescore(store, organ, new_model, options['chunk_rows'])[2] if new_model is not None else current
+            except ValueError as e:
+                raise CommandError(str(e))
+            self.stdout.write(
+                f"{organ}: {len(images)} images scored in {time.perf_counter() - start:.2f}s"
+                + (f", {int((current.argmax(axis=1) != new.argmax(axis=1)).sum())} organ predictions changed"
+                   if new_model is not None and len(images) else "")
+            )
+            scores[organ] = images, pairs, current, new
+
+        bud_images, bud_pairs, bud_current, bud_new = scores['bud']
+        stem_images, _, stem_current, stem_new = scores['stem']
+        # Pair each bud with the stem image it was uploaded with
+        stem_rows = np.searchsorted(stem_images, bud_pairs)
+        stem_rows = np.minimum(stem_rows, max(len(stem_images) - 1, 0))
+        paired = np.flatnonzero(stem_images[stem_rows] == bud_pairs) if len(stem_images) else np.zeros(0, dtype=int)
+        if not len(paired):
+            self.stdout.write(self.style.WARNING("No complete bud/stem pairs in the feature store"))
+            return
+
+        current = combine_probabilities(bud_current[paired], stem_current[stem_rows[paired]])
+        new = combine_probabilities(bud_new[paired], stem_new[stem_rows[paired]])
+        changed = current.argmax(axis=1) != new.argmax(axis=1)
+        self.stdout.write(self.style.SUCCESS(
+            f"{len(paired)} pairs re-scored; {int(changed.sum())} variety predictions changed"
+        ))
+
+        if options['output']:
+            with open(options['output'], 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['bud_image', 'stem_image', 'variety', 'confidence', 'previous_variety', 'previous_confidence'])
+                bud_keys, stem_keys = key_hex(bud_images[paired]), key_hex(bud_pairs[paired])
+                for row in range(len(paired)):
+                    variety, confidence = final_prediction(new[row])
+                    previous_variety, previous_confidence = final_prediction(current[row])
+                    writer.writerow([
+                        bud_keys[row], stem_keys[row],
+                        variety, f"{confidence:.2f}", previous_variety, f"{previous_confidence:.2f}",
+                    ])
+            self.stdout.write(f"  wrote {options['output']}")
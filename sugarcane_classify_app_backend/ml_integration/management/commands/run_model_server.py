@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from ml_integration.model_server import DEFAULT_MODEL_SERVER_CONFIG, MODEL_SERVER_CONFIG, serve
+
+
+class Command(BaseCommand):
+    help = (
+        "Loads the prediction models once and serves them to the Django workers over a Unix "
+        "socket, for use with ML_MODEL_SERVER."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--socket', default=MODEL_SERVER_CONFIG['SOCKET'])
+        parser.add_argument('--models', nargs='+', choices=DEFAULT_MODEL_SERVER_CONFIG['MODELS'], default=MODEL_SERVER_CONFIG['MODELS'])
+
+    def handle(self, *args, **options):
+        if not MODEL_SERVER_CONFIG['ENABLED']:
+            self.stdout.write(self.style.WARNING(
+                "ML_MODEL_SERVER['ENABLED'] is off; the Django workers will still load their own models"
+            ))
+        self.stdout.write(f"Serving {', '.join(options['models'])} on {options['socket']}")
+        try:
+            serve(options['socket'], options['models'])
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,49 @@
+import json
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ml_integration.shadow import SHADOW_CONFIG, ComparisonStore, summarize
+
+
+class Command(BaseCommand):
+    help = (
+        "Summarizes the shadow / A/B comparison records (ML_SHADOW): how often the candidate "
+        "models agree with the current ones, how their confidence differs and each model's latency."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=SHADOW_CONFIG['DIR'], help="Comparison record directory")
+        parser.add_argument('--hours', type=float, default=None, help="Only records from the last HOURS hours")
+        parser.add_argument('--json', action='store_true', help="Print the summary as JSON")
+
+    def handle(self, *args, **options):
+        if not os.path.isdir(options['dir']):
+            raise CommandError(f"No comparison records found in {options['dir']}")
+        records = ComparisonStore(options['dir'], SHADOW_CONFIG['CHUNK_ROWS'], SHADOW_CONFIG['FLUSH_INTERVAL']).records()
+        if options['hours'] is not None:
+            records = records[records['recorded_at'] >= time.time() - options['hours'] * 3600]
+        summary = summarize(records)
+        if options['json']:
+            self.stdout.write(json.dumps(summary, indent=2))
+            return
+
+        self.stdout.write(
+            f"{summary['records']} records ({summary['served_by_candidate']} answered by the candidate), "
+            f"{summary['compared']} with a prediction from both model sets"
+        )
+        if summary['compared']:
+            self.stdout.write(
+                f"  agreement {summary['agreement'] * 100:.1f}%, confidence delta (candidate - primary) "
+                f"{summary['confidence_delta_mean'] * 100:+.2f} points, mean |delta| "
+                f"{summary['confidence_delta_abs_mean'] * 100:.2f} points"
+            )
+        self.stdout.write(
+            f"  nothing detected: primary {summary['undetected']['primary']}, candidate {summary['undetected']['candidate']}"
+        )
+        for model, latency in summary['latency'].items():
+            if latency['runs']:
+                self.stdout.write(
+                    f"  {model}: median {latency['median_ms']:.1f} ms, p95 {latency['p95_ms']:.1f} ms ({latency['runs']} runs)"
+                )
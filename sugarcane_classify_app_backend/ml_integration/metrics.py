@@ -0,0 +1,185 @@
+"""
+In-process counters and histograms, exposed in the Prometheus text format at /api/metrics.
+
+Kept dependency-free: each metric is a small lock-protected dict keyed by
+label values. Values are per process, so with several server workers each
+one has to be scraped on its own (or run a single worker per container).
+"""
+import asyncio
+import bisect
+import functools
+import threading
+import time
+
+# Latency buckets (seconds), from sub-millisecond stages up to slow full requests
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"'))
+        for name, value in pairs
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def value(self, *labelvalues):
+        return self._values.get(labelvalues, 0)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for labelvalues, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labelvalues -> [per-bucket counts (last is +Inf), sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labelvalues)
+            if state is None:
+                state = self._values[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def count(self, *labelvalues):
+        state = self._values.get(labelvalues)
+        return state[2] if state is not None else 0
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for labelvalues, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    labels = _format_labels(self.labelnames, labelvalues, [('le', _format_value(bound))])
+                    lines.append(f'{self.name}_bucket{labels} {cumulative}')
+                labels = _format_labels(self.labelnames, labelvalues)
+                lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+                lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text exposition format (version 0.0.4).
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+
+REQUESTS = metrics.counter(
+    'ml_requests_total', 'Prediction requests by endpoint and response status.', ['endpoint', 'status'])
+REQUEST_DURATION = metrics.histogram(
+    'ml_request_duration_seconds', 'Prediction request latency by endpoint.', ['endpoint'])
+STAGE_DURATION = metrics.histogram(
+    'ml_stage_duration_seconds', 'Time spent in each prediction pipeline stage.', ['stage'])
+MODEL_LOADS = metrics.counter(
+    'ml_model_loads_total', 'Model loads (including reloads) by model and result.', ['model', 'result'])
+MODEL_LOAD_DURATION = metrics.histogram(
+    'ml_model_load_duration_seconds', 'Time taken to load a model file.', ['model'],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+PREDICTION_CACHE = metrics.counter(
+    'ml_prediction_cache_requests_total', 'Prediction cache lookups by result.', ['result'])
+JOBS = metrics.counter(
+    'ml_jobs_total', 'Finished prediction jobs by final status.', ['status'])
+SUGAR_GRID_LOOKUPS = metrics.counter(
+    'ml_sugar_grid_lookups_total', 'Sugar production rows served from the precomputed grid or the model.', ['source'])
+FUSION_PATHS = metrics.counter(
+    'ml_fusion_paths_total', 'Variety predictions by fusion path and the organ processed first.', ['path', 'first'])
+EARLY_EXIT_AGREEMENT = metrics.counter(
+    'ml_fusion_early_exit_agreement_total',
+    'Deferred full predictions after an early exit, by whether they agree with the early answer.', ['outcome'])
+AB_REQUESTS = metrics.counter(
+    'ml_ab_requests_total', 'Variety requests by the model set (primary or candidate) that answered them.', ['model_set'])
+SHADOW_RUNS = metrics.counter(
+    'ml_shadow_runs_total', 'Comparison runs of the model set that did not answer, by result.', ['result'])
+DETECTION_TILES = metrics.counter(
+    'ml_detection_tiles_total', 'Tiles of high-resolution images run through the detector or skipped.', ['organ', 'result'])
+
+
+def track_requests(endpoint):
+    """
+    View decorator counting requests by response status and observing their latency.
+    Works for both sync and coroutine views.
+    """
+    def record(start, status):
+        REQUESTS.inc(endpoint, str(status))
+        REQUEST_DURATION.observe(time.perf_counter() - start, endpoint)
+
+    def decorator(view_func):
+        if asyncio.iscoroutinefunction(view_func):
+            @functools.wraps(view_func)
+            async def async_wrapper(request, *args, **kwargs):
+                start, status = time.perf_counter(), 500
+                try:
+                    response = await view_func(request, *args, **kwargs)
+                    status = response.status_code
+                    return response
+                finally:
+                    record(start, status)
+            return async_wrapper
+
+        @functools.wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            start, status = time.perf_counter(), 500
+            try:
+                response = view_func(request, *args, **kwargs)
+                status = response.status_code
+                return response
+            finally:
+                record(start, status)
+        return wrapper
+    return decorator
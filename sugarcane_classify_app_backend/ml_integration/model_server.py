@@ -0,0 +1,272 @@
+"""
+Local model server, so WSGI workers share one copy of the models.
+
+Every Django worker process that loads the models keeps its own copy of
+both YOLO networks and the three tree/regression models, which caps how
+many workers fit on a box. With ML_MODEL_SERVER enabled, the models in
+MODELS are loaded once by `manage.py run_model_server`, and the registry
+in each worker hands out RemoteModel proxies instead: the pipeline keeps
+calling detect(), predict_proba() and predict() as before, and the calls
+run in the server.
+
+Workers reach the server over a Unix socket (multiprocessing.connection,
+authenticated with AUTHKEY before anything is unpickled). Images are not
+sent through the socket: each worker thread owns a shared memory segment,
+copies the images of a detect() call into it and sends only their offsets
+and shapes; the server reads them in place. Feature matrices and results
+are small and go through the socket.
+
+The server runs each connection in its own thread. Calls to one detector
+are serialized, as the YOLO predictors are not thread-safe; classifier and
+regression calls run concurrently.
+"""
+import atexit
+import hashlib
+import logging
+import os
+import threading
+from multiprocessing import AuthenticationError, resource_tracker, shared_memory
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL_SERVER_CONFIG = {
+    'ENABLED': False,
+    'SOCKET': os.path.join(settings.BASE_DIR, 'cache', 'model_server.sock'),
+    'MODELS': ['bud_detector', 'bud_classifier', 'stem_detector', 'stem_classifier', 'sugar_production'],
+    'TIMEOUT': 60.0,         # Seconds to wait for a reply before giving up on the server
+    'AUTHKEY': '',           # Defaults to a key derived from SECRET_KEY
+}
+
+MODEL_SERVER_CONFIG = {**DEFAULT_MODEL_SERVER_CONFIG, **getattr(settings, 'ML_MODEL_SERVER', {})}
+
+METHODS = ('detect', 'predict_proba', 'predict')
+
+# Shared memory segments grow in steps of this size, so similar uploads reuse one segment
+SEGMENT_GRANULARITY = 16 * 1024 * 1024
+
+
+class ModelServerError(RuntimeError):
+    """
+    Raised when the model server cannot be reached or a model call fails in it.
+    """
+
+
+def authkey():
+    key = MODEL_SERVER_CONFIG['AUTHKEY'] or 'ml-model-server:' + settings.SECRET_KEY
+    return hashlib.sha256(key.encode('utf-8')).digest()
+
+
+# ============================
+# Client
+# ============================
+
+class _Channel(threading.local):
+    pid = None
+    connection = None
+    segment = None
+
+
+_channel = _Channel()
+_segments = set()  # Every live segment of this process, unlinked at exit
+_segments_lock = threading.Lock()
+
+
+@atexit.register
+def _unlink_segments():
+    with _segments_lock:
+        for segment in _segments:
+            if segment.pid != os.getpid():
+                continue  # Inherited through fork; the parent unlinks it
+            segment.close()
+            segment.unlink()
+        _segments.clear()
+
+
+def _current_channel():
+    # A forked worker must not share its parent's connection or segment
+    if _channel.pid != os.getpid():
+        _channel.pid, _channel.connection, _channel.segment = os.getpid(), None, None
+    return _channel
+
+
+def _close_channel():
+    if _channel.connection is not None:
+        _channel.connection.close()
+    _channel.connection = None
+
+
+def _segment(size):
+    """
+    Returns this thread's shared memory segment, replacing it when it is too small.
+    """
+    segment = _current_channel().segment
+    if segment is None or segment.size < size:
+        size = -(-size // SEGMENT_GRANULARITY) * SEGMENT_GRANULARITY
+        with _segments_lock:
+            if segment is not None:
+                _segments.discard(segment)
+                segment.close()
+                segment.unlink()
+            segment = _channel.segment = shared_memory.SharedMemory(create=True, size=size)
+            segment.pid = os.getpid()
+            _segments.add(segment)
+    return segment
+
+
+def call(method, name, payload):
+    """
+    Runs one model call in the server and returns its result. Reconnects once if the
+    connection was lost (e.g. the server restarted).
+    """
+    for attempt in range(2):
+        try:
+            if _current_channel().connection is None:
+                _channel.connection = Client(MODEL_SERVER_CONFIG['SOCKET'], family='AF_UNIX', authkey=authkey())
+            connection = _channel.connection
+            connection.send((method, name, payload))
+            if not connection.poll(MODEL_SERVER_CONFIG['TIMEOUT']):
+                # A late reply would be read as the answer to the next call
+                _close_channel()
+                raise ModelServerError(f"Model server did not answer {method} on '{name}' in time")
+            status, result = connection.recv()
+            break
+        except AuthenticationError:
+            _close_channel()
+            raise ModelServerError("Model server rejected the connection; check ML_MODEL_SERVER['AUTHKEY']")
+        except (OSError, EOFError) as e:
+            _close_channel()
+            if attempt:
+                raise ModelServerError(f"Model server unavailable at {MODEL_SERVER_CONFIG['SOCKET']}: {e}")
+    if status != 'ok':
+        raise ModelServerError(result)
+    return result
+
+
+class RemoteModel:
+    """
+    Registry stand-in for a model loaded in the model server.
+    """
+
+    def __init__(self, name, path=None):
+        self.name = name
+        self.path = path
+
+    def detect(self, images):
+        images = [np.ascontiguousarray(image, dtype=np.uint8) for image in images]
+        offsets = np.concatenate(([0], np.cumsum([image.nbytes for image in images]))).tolist()
+        segment = _segment(max(offsets[-1], 1))
+        for image, offset in zip(images, offsets):
+            segment.buf[offset:offset + image.nbytes] = image.reshape(-1)
+        layout = [(offset, image.shape) for image, offset in zip(images, offsets)]
+        return call('detect', self.name, (segment.name, layout))
+
+    def predict_proba(self, X):
+        return call('predict_proba', self.name, np.asarray(X))
+
+    def predict(self, X):
+        return call('predict', self.name, np.asarray(X))
+
+    def __repr__(self):
+        return f"RemoteModel({self.name!r})"
+
+
+# ============================
+# Server
+# ============================
+
+def _attach(name):
+    segment = shared_memory.SharedMemory(name=name)
+    # The client owns and unlinks the segment; without this the server's tracker would unlink it too
+    resource_tracker.unregister(segment._name, 'shared_memory')
+    return segment
+
+
+class ModelServer:
+    def __init__(self, registry, names):
+        self.registry = registry
+        self.names = names
+        self.listener = None
+        self._detector_locks = {name: threading.Lock() for name in names}
+
+    def serve_forever(self, socket_path):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        os.makedirs(os.path.dirname(os.path.abspath(socket_path)), exist_ok=True)
+        previous_umask = os.umask(0o077)  # Only this user may connect
+        try:
+            self.listener = Listener(socket_path, family='AF_UNIX', authkey=authkey())
+        finally:
+            os.umask(previous_umask)
+        logger.info("Model server listening on %s", socket_path)
+        try:
+            while True:
+                try:
+                    connection = self.listener.accept()
+                except (OSError, EOFError, AuthenticationError) as e:
+                    # Failed handshakes (wrong key, client gone) do not stop the server
+                    logger.warning("Rejected model server connection: %s", e)
+                    continue
+                threading.Thread(target=self.handle, args=(connection,), daemon=True).start()
+        finally:
+            self.listener.close()
+
+    def handle(self, connection):
+        segments = {}
+        try:
+            while True:
+                try:
+                    method, name, payload = connection.recv()
+                except (OSError, EOFError):
+                    return
+                try:
+                    result = ('ok', self.dispatch(method, name, payload, segments))
+                except Exception as e:
+                    logger.exception("Model server call %s on '%s' failed", method, name)
+                    result = ('error', f"{type(e).__name__}: {e}")
+                connection.send(result)
+        finally:
+            connection.close()
+            for segment in segments.values():
+                self._close(segment)
+
+    def dispatch(self, method, name, payload, segments):
+        if method not in METHODS or name not in self.names:
+            raise ValueError(f"Unknown model call {method} on '{name}'")
+        model = self.registry.get(name)
+        if method != 'detect':
+            return getattr(model, method)(payload)
+
+        segment_name, layout = payload
+        if segment_name not in segments:
+            # A client replaces its segment only to grow it, so the old mapping can go
+            for old in segments.values():
+                self._close(old)
+            segments.clear()
+            segments[segment_name] = _attach(segment_name)
+        buffer = segments[segment_name].buf
+        images = [np.ndarray(shape, dtype=np.uint8, buffer=buffer, offset=offset) for offset, shape in layout]
+        with self._detector_locks[name]:
+            return model.detect(images)
+
+    @staticmethod
+    def _close(segment):
+        try:
+            segment.close()
+        except BufferError:
+            pass  # A detector still holds a view of the last batch; the mapping goes with it
+
+
+def serve(socket_path=None, names=None, registry=None):
+    """
+    Loads the served models and answers model calls on the Unix socket until interrupted.
+    """
+    from .registry import model_registry  # Deferred: the registry hands out RemoteModel proxies
+
+    names = names or MODEL_SERVER_CONFIG['MODELS']
+    registry = registry or model_registry(remote=False)
+    registry.warm_up(names)
+    ModelServer(registry, names).serve_forever(socket_path or MODEL_SERVER_CONFIG['SOCKET'])
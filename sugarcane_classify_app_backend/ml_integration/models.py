@@ -1,3 +1,63 @@
+import uuid
+
 from django.db import models
 
-# Create your models here.
+
+class PredictionJob(models.Model):
+    """
+    A variety prediction submitted through /api/jobs/ and run by the background job worker.
+    The uploaded images are kept in the row until the job finishes.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+    ]
+    FINISHED = (SUCCEEDED, FAILED)
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+
+    bud_image = models.BinaryField()
+    bud_image_name = models.CharField(max_length=255)
+    stem_image = models.BinaryField()
+    stem_image_name = models.CharField(max_length=255)
+
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+
+    webhook_url = models.URLField(max_length=2000, blank=True)
+    webhook_delivered = models.BooleanField(default=False)
+
+    # '<host>:<pid>:<start token>' of the worker process running the job, for crash recovery
+    worker = models.CharField(max_length=255, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    class Meta:
+        ordering = ['created_at']
+
+    def __str__(self):
+        return f"{self.id} ({self.status})"
+
+    def to_dict(self):
+        data = {
+            'id': str(self.id),
+            'status': self.status,
+            'created_at': self.created_at.isoformat(),
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
+        if self.status == self.SUCCEEDED:
+            data['result'] = self.result
+        elif self.status == self.FAILED:
+            data['error'] = self.error
+        return data
@@ -0,0 +1,319 @@
+"""
+Offline variety classification of bud/stem image archives (`manage.py classify_dir`).
+
+Pairs come from two directory trees (matched by relative path without the
+extension) or from a CSV manifest. They are classified in chunks by a
+process pool whose initializer loads the variety models once per worker.
+Workers run the stages the variety endpoints use (decode_for_detection,
+detect_and_crop_all_batch, classify_detections, combine_probabilities and
+final_prediction), so an archive gets the results the API would give,
+except that ML_FUSION's early exit is not applied: every pair is fused
+from both organs.
+Within a worker, the next batch of pairs is read and decoded in a
+background thread while the current batch goes through the models.
+
+Results are appended to the output file (CSV or JSONL) as chunks finish,
+and each write is fsynced. An interrupted run resumes where it stopped:
+pairs whose id is already in the output are skipped, and a partly written
+last line is dropped.
+"""
+import csv
+import io
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import cv2
+
+from .cache import VARIETY_MODELS
+from .executor import _init_process_worker
+from .feature_store import pair_records
+from .pipeline import (
+    classify_bud, classify_detections, classify_stem, combine_probabilities, detect_and_crop_all_batch,
+    final_prediction,
+)
+from .registry import registry
+from .uploads import UploadRejected, decode_for_detection
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp', '.tif', '.tiff')
+
+RESULT_FIELDS = ('id', 'bud_image', 'stem_image', 'variety', 'confidence', 'error')
+
+OUTPUT_FORMATS = ('csv', 'jsonl')
+
+
+# ============================
+# Pairing
+# ============================
+
+def _images_by_key(directory):
+    images = {}
+    for root, _, names in os.walk(directory):
+        for name in names:
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                path = os.path.join(root, name)
+                key = os.path.splitext(os.path.relpath(path, directory))[0].replace(os.sep, '/')
+                images[key] = path
+    return images
+
+
+def pairs_from_dirs(bud_dir, stem_dir):
+    """
+    Pairs the images of two directory trees by relative path without extension
+    (buds/plot1/12.jpg with stems/plot1/12.png). Returns (pairs, unmatched keys),
+    pairs being (id, bud_path, stem_path) tuples sorted by id.
+    """
+    buds, stems = _images_by_key(bud_dir), _images_by_key(stem_dir)
+    pairs = [(key, buds[key], stems[key]) for key in sorted(buds.keys() & stems.keys())]
+    return pairs, sorted(buds.keys() ^ stems.keys())
+
+
+def pairs_from_manifest(path):
+    """
+    Reads (id, bud_path, stem_path) pairs from a CSV manifest with bud_image and stem_image
+    columns and an optional id column (default: the row number). Relative paths are
+    resolved against the manifest's directory.
+    """
+    root = os.path.dirname(os.path.abspath(path))
+    with open(path, newline='') as f:
+        reader = csv.DictReader(f)
+        missing = [name for name in ('bud_image', 'stem_image') if name not in (reader.fieldnames or [])]
+        if missing:
+            raise ValueError(f"Manifest is missing columns: {', '.join(missing)}")
+        pairs = [
+            (row.get('id') or str(number), os.path.join(root, row['bud_image']), os.path.join(root, row['stem_image']))
+            for number, row in enumerate(reader, start=1)
+        ]
+    if len({pair[0] for pair in pairs}) != len(pairs):
+        raise ValueError("Manifest ids must be unique")
+    return pairs
+
+
+# ============================
+# Workers
+# ============================
+
+def init_worker(settings_module, threads):
+    """
+    Process pool initializer: sets up Django and loads every variety model once.
+    """
+    _init_process_worker(settings_module)
+    cv2.setNumThreads(threads)
+    for name in VARIETY_MODELS:
+        registry.get(name)
+    torch = sys.modules.get('torch')
+    if torch is not None:
+        torch.set_num_threads(threads)
+
+
+def _read(path, label, organ):
+    with open(path, 'rb') as f:
+        data = f.read()
+    image = decode_for_detection(data, label, organ)
+    if image is None:
+        raise UploadRejected(f"{label} could not be decoded")
+    return data, image
+
+
+def load_batch(pairs):
+    """
+    Reads and decodes the images of a batch of pairs. Returns (buffers, images, errors)
+    with buffers and images as (bud, stem) lists; a pair that failed has None images
+    and an entry in errors.
+    """
+    buffers, images, errors = ([], []), ([], []), {}
+    for i, (_, bud_path, stem_path) in enumerate(pairs):
+        try:
+            bud_data, bud_image = _read(bud_path, 'Bud image', 'bud')
+            stem_data, stem_image = _read(stem_path, 'Stem image', 'stem')
+        except (OSError, UploadRejected) as e:
+            bud_data = stem_data = bud_image = stem_image = None
+            errors[i] = str(e)
+        buffers[0].append(bud_data)
+        buffers[1].append(stem_data)
+        images[0].append(bud_image)
+        images[1].append(stem_image)
+    return buffers, images, errors
+
+
+def classify_batch(pairs, buffers, images, errors):
+    """
+    Classifies a decoded batch of pairs as predict_variety_batch does. Returns one result dict per pair.
+    """
+    decoded = [i for i in range(len(pairs)) if i not in errors]
+    bud_detections = [([], [], [])] * len(pairs)
+    stem_detections = [([], [], [])] * len(pairs)
+    if decoded:
+        found = detect_and_crop_all_batch(registry.get('bud_detector'), [images[0][i] for i in decoded], 'bud')
+        for i, detections in zip(decoded, found):
+            bud_detections[i] = detections
+        found = detect_and_crop_all_batch(registry.get('stem_detector'), [images[1][i] for i in decoded], 'stem')
+        for i, detections in zip(decoded, found):
+            stem_detections[i] = detections
+
+    results = []
+    for i, (pair_id, bud_path, stem_path) in enumerate(pairs):
+        result = dict.fromkeys(RESULT_FIELDS)
+        result.update(id=pair_id, bud_image=bud_path, stem_image=stem_path)
+        if i in errors:
+            result['error'] = errors[i]
+        elif not bud_detections[i][0]:
+            result['error'] = 'No bud detected in the image'
+        elif not stem_detections[i][0]:
+            result['error'] = 'No stem detected in the image'
+        results.append(result)
+
+    valid = [i for i, result in enumerate(results) if result['error'] is None]
+    if valid:
+        bud_record, stem_record = pair_records(
+            [buffers[0][i] for i in valid], [buffers[1][i] for i in valid],
+            [bud_detections[i][1] for i in valid], [bud_detections[i][2] for i in valid],
+            [stem_detections[i][1] for i in valid], [stem_detections[i][2] for i in valid],
+        )
+        bud_class_probabilities = classify_detections(
+            classify_bud, [bud_detections[i][0] for i in valid], [bud_detections[i][2] for i in valid],
+            record=bud_record)
+        stem_class_probabilities = classify_detections(
+            classify_stem, [stem_detections[i][0] for i in valid], [stem_detections[i][2] for i in valid],
+            record=stem_record)
+        combined_probabilities = combine_probabilities(bud_class_probabilities, stem_class_probabilities)
+        for row, i in enumerate(valid):
+            results[i]['variety'], results[i]['confidence'] = final_prediction(combined_probabilities[row])
+            results[i]['probabilities'] = [float(prob) for prob in combined_probabilities[row]]
+    return results
+
+
+def classify_chunk(pairs, batch_pairs):
+    """
+    Worker task: classifies a chunk of pairs batch by batch, decoding the next batch
+    in a background thread while the current one is classified.
+    """
+    batches = [pairs[start:start + batch_pairs] for start in range(0, len(pairs), batch_pairs)]
+    results = []
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='decode') as decoder:
+        upcoming = decoder.submit(load_batch, batches[0]) if batches else None
+        for k, batch in enumerate(batches):
+            decoded = upcoming.result()
+            if k + 1 < len(batches):
+                upcoming = decoder.submit(load_batch, batches[k + 1])
+            results.extend(classify_batch(batch, *decoded))
+    return results
+
+
+# ============================
+# Output
+# ============================
+
+def output_format(path, requested=None):
+    if requested:
+        return requested
+    return 'jsonl' if path.lower().endswith(('.jsonl', '.ndjson')) else 'csv'
+
+
+def completed_ids(path, fmt):
+    """
+    Returns the ids of the pairs already in an output file, first cutting off a
+    last line left partly written by an interrupted run.
+    """
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'rb+') as f:
+        data = f.read()
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            f.truncate(end)
+            data = data[:end]
+    lines = data.decode('utf-8').splitlines()
+    if fmt == 'jsonl':
+        return {json.loads(line)['id'] for line in lines if line.strip()}
+    return {row['id'] for row in csv.DictReader(lines)}
+
+
+class ResultWriter:
+    """
+    Appends results to a CSV or JSONL file, syncing every write to disk.
+    """
+
+    def __init__(self, path, fmt):
+        self.fmt = fmt
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'a', newline='', encoding='utf-8')
+        if new and fmt == 'csv':
+            self._write(','.join(RESULT_FIELDS) + '\n')
+
+    def write(self, results):
+        if self.fmt == 'jsonl':
+            self._write(''.join(json.dumps(result) + '\n' for result in results))
+            return
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator='\n').writerows(
+            ['' if result[field] is None else result[field] for field in RESULT_FIELDS] for result in results
+        )
+        self._write(buffer.getvalue())
+
+    def _write(self, text):
+        self.file.write(text)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+# ============================
+# Running
+# ============================
+
+def classify_pairs(pairs, output, fmt, workers, chunk_pairs=64, batch_pairs=8, threads=1, progress=None):
+    """
+    Classifies pairs not yet in output with a process pool, appending results as chunks finish.
+    progress, if given, is called with the summary after every chunk. Returns the summary.
+    """
+    done = completed_ids(output, fmt)
+    todo = [pair for pair in pairs if pair[0] not in done]
+    chunks = [todo[start:start + chunk_pairs] for start in range(0, len(todo), chunk_pairs)]
+    summary = {'pairs': len(pairs), 'skipped': len(pairs) - len(todo), 'classified': 0, 'errors': 0, 'failed': 0}
+    start = time.perf_counter()
+
+    writer = ResultWriter(output, fmt)
+    settings_module = os.environ.get('DJANGO_SETTINGS_MODULE', '')
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(settings_module, threads)) as pool:
+            remaining = iter(chunks)
+            in_flight = {}
+
+            def submit():
+                chunk = next(remaining, None)
+                if chunk is not None:
+                    in_flight[pool.submit(classify_chunk, chunk, batch_pairs)] = chunk
+
+            # Keep every worker busy with one chunk queued behind it, without loading the whole archive
+            for _ in range(2 * workers):
+                submit()
+            while in_flight:
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    chunk = in_flight.pop(future)
+                    try:
+                        results = future.result()
+                    except Exception:
+                        # Left out of the output, so the next run retries these pairs
+                        logger.exception("Failed to classify %d pairs starting at %s", len(chunk), chunk[0][0])
+                        summary['failed'] += len(chunk)
+                    else:
+                        writer.write(results)
+                        summary['classified'] += len(results)
+                        summary['errors'] += sum(result['error'] is not None for result in results)
+                    submit()
+                    summary['seconds'] = time.perf_counter() - start
+                    if progress is not None:
+                        progress(summary)
+    finally:
+        writer.close()
+    summary['seconds'] = time.perf_counter() - start
+    return summary
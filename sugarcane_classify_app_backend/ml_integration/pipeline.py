@@ -0,0 +1,447 @@
+"""
+Shared stages of the variety prediction pipeline.
+
+These functions are used by the sync and async views and are importable by
+worker processes, so they only take and return plain Python / NumPy values.
+The sugar production stages are in forecast.py, which does not need OpenCV.
+"""
+import atexit
+import base64
+import contextvars
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from django.conf import settings
+
+from . import features
+from .batching import detection_batchers
+from .crops import crop_reference
+from .feature_store import feature_store, organ_record
+from .fusion import fusion_engine
+from .metrics import EARLY_EXIT_AGREEMENT, FUSION_PATHS
+from .registry import active_registry, registry
+from .tiling import refine_detections, tiles_enabled
+from .timing import stage
+from .uploads import PreparedImage
+
+logger = logging.getLogger(__name__)
+
+# Models are loaded lazily through the registry:
+#   bud_detector / bud_classifier    - YOLO bud detector and RF classifier
+#   stem_detector / stem_classifier  - YOLO stem detector and XGBoost classifier
+
+DEFAULT_MULTI_DETECTION_CONFIG = {
+    'ENABLED': False,
+    'MIN_CONFIDENCE': 0.5,   # Detections below this are ignored (the best one is always kept)
+    'MAX_DETECTIONS': 8,     # Per image, highest confidence first
+}
+
+MULTI_DETECTION_CONFIG = {**DEFAULT_MULTI_DETECTION_CONFIG, **getattr(settings, 'ML_MULTI_DETECTION', {})}
+
+VARIETY_NAMES = {
+    1: "SL 96 128",
+    2: "SL 03 336",
+    3: "SL 03 1077",
+    4: "SL 03 1188"
+}
+
+# ============================
+# Detection
+# ============================
+
+def load_image(image):
+    """
+    Returns a BGR ndarray, reading it from disk if a path is given.
+    """
+    if image is None or isinstance(image, np.ndarray):
+        return image
+    if isinstance(image, PreparedImage):
+        return image.image
+    return cv2.imread(image)
+
+def detection_inputs(image):
+    """
+    Returns (image to crop from, image to run the detector on). They are the same
+    array except for a PreparedImage, which carries a smaller copy for detection.
+    """
+    if isinstance(image, PreparedImage):
+        return image.image, image.detect_image
+    img = load_image(image)
+    return img, img
+
+def scale_boxes(boxes, img, detect_img):
+    """
+    Maps xyxy boxes detected on detect_img to img's coordinates.
+    """
+    if detect_img is img:
+        return boxes
+    scale_x = img.shape[1] / detect_img.shape[1]
+    scale_y = img.shape[0] / detect_img.shape[0]
+    return boxes * np.array([scale_x, scale_y, scale_x, scale_y], dtype=np.float32)
+
+def resolve_detector(detector_name):
+    """
+    Returns the named detector of the active model set, loading it on first use. Called
+    before detection's error handling, so a model that cannot be loaded (missing weights
+    or backend) fails the request instead of reading as "nothing detected".
+    """
+    return active_registry().get(detector_name)
+
+def detect_boxes(detector_name, detector, img):
+    """
+    Runs the detector (resolve_detector(detector_name)) on one image and returns (boxes,
+    confidences) as NumPy arrays. Goes through the micro-batching scheduler when
+    ML_DETECTION_BATCHING is enabled.
+    """
+    # The batchers run the default registry's detectors
+    batcher = detection_batchers.get(detector_name) if active_registry() is registry else None
+    with stage('detect', detector_name):
+        if batcher is not None:
+            return batcher.detect(img)
+        return detector.detect([img])[0]  # Run YOLO inference
+
+def refine_boxes(detector, img, boxes, confidences, label):
+    """
+    Refines one image's detections (in img's coordinates) on full-resolution tiles when
+    ML_TILED_DETECTION applies to it; see tiling.py.
+    """
+    if not tiles_enabled(label, img):
+        return boxes, confidences
+    return refine_detections(detector, [img], [(boxes, confidences)], label)[0]
+
+def detect_and_crop(detector_name, image, label):
+    """
+    Detects an object in the image with the named YOLO detector and crops it.
+    Returns (cropped_image, box) where box is [x1, y1, x2, y2], or (None, None).
+    """
+    img, detect_img = detection_inputs(image)
+    if img is None:
+        logger.warning("Failed to load %s image", label)
+        return None, None
+
+    logger.debug("Detecting %s...", label)
+    detector = resolve_detector(detector_name)
+    try:
+        boxes, confidences = detect_boxes(detector_name, detector, detect_img)
+        if len(boxes) == 0:
+            logger.debug("No %s detected", label)
+            return None, None
+        boxes, confidences = refine_boxes(detector, img, scale_boxes(boxes, img, detect_img), confidences, label)
+
+        # Extract bounding box coordinates (most confident detection)
+        with stage('crop'):
+            x1, y1, x2, y2 = map(int, boxes[int(np.argmax(confidences))])
+            return img[y1:y2, x1:x2], [x1, y1, x2, y2]
+
+    except Exception:
+        logger.exception("Error processing %s YOLO results", label)
+        return None, None
+
+def select_detections(confidences):
+    """
+    Returns the indices of the detections to classify, most confident first: only the
+    best one, or with ML_MULTI_DETECTION every one above MIN_CONFIDENCE (up to MAX_DETECTIONS).
+    """
+    order = np.argsort(-np.asarray(confidences), kind='stable')
+    if not MULTI_DETECTION_CONFIG['ENABLED'] or len(order) == 0:
+        return order[:1]
+    selected = order[np.asarray(confidences)[order] >= MULTI_DETECTION_CONFIG['MIN_CONFIDENCE']]
+    return selected[:MULTI_DETECTION_CONFIG['MAX_DETECTIONS']] if len(selected) else order[:1]
+
+def crop_detections(img, boxes, confidences):
+    """
+    Crops the selected detections. Returns (crops, boxes, confidences), most confident first.
+    """
+    crops, crop_boxes = [], []
+    indices = select_detections(confidences)
+    with stage('crop'):
+        for index in indices:
+            x1, y1, x2, y2 = map(int, boxes[index])
+            crops.append(img[y1:y2, x1:x2])
+            crop_boxes.append([x1, y1, x2, y2])
+    return crops, crop_boxes, [float(confidences[index]) for index in indices]
+
+def detect_and_crop_all(detector_name, image, label):
+    """
+    Like detect_and_crop, but returns (crops, boxes, confidences) for every selected
+    detection (see select_detections); the lists are empty when nothing was detected.
+    """
+    img, detect_img = detection_inputs(image)
+    if img is None:
+        logger.warning("Failed to load %s image", label)
+        return [], [], []
+
+    logger.debug("Detecting %s...", label)
+    detector = resolve_detector(detector_name)
+    try:
+        boxes, confidences = detect_boxes(detector_name, detector, detect_img)
+        if len(boxes) == 0:
+            logger.debug("No %s detected", label)
+            return [], [], []
+        boxes, confidences = refine_boxes(detector, img, scale_boxes(boxes, img, detect_img), confidences, label)
+        return crop_detections(img, boxes, confidences)
+
+    except Exception:
+        logger.exception("Error processing %s YOLO results", label)
+        return [], [], []
+
+def detect_and_crop_all_batch(detector, images_or_paths, label):
+    """
+    Batched detect_and_crop_all: one detector call over every image. Returns a list of
+    (crops, boxes, confidences) aligned with images_or_paths.
+    """
+    results = [([], [], [])] * len(images_or_paths)
+    images = []
+    detect_images = []
+    indices = []
+    for i, image in enumerate(images_or_paths):
+        img, detect_img = detection_inputs(image)
+        if img is None:
+            logger.warning("Failed to load %s image %d", label, i)
+            continue
+        images.append(img)
+        detect_images.append(detect_img)
+        indices.append(i)
+
+    if not images:
+        return results
+
+    logger.debug("Detecting %s in %d images...", label, len(images))
+    with stage('detect'):
+        detections = detector.detect(detect_images)  # One YOLO forward over the whole stack
+    detections = refine_detections(detector, images, [
+        (scale_boxes(boxes, img, detect_img), confidences)
+        for img, detect_img, (boxes, confidences) in zip(images, detect_images, detections)
+    ], label)
+    for i, img, (boxes, confidences) in zip(indices, images, detections):
+        if len(boxes) == 0:
+            logger.debug("No %s detected in image %d", label, i)
+            continue
+        results[i] = crop_detections(img, boxes, confidences)
+    return results
+
+def current_fusion_engine():
+    """
+    Returns the fusion engine of the active model set: the candidate's inside
+    shadow.use_arm('candidate'), otherwise the one for the configured models.
+    """
+    return getattr(active_registry(), 'fusion_engine', None) or fusion_engine
+
+def combine_probabilities(bud_class_probabilities, stem_class_probabilities):
+    """
+    Combines bud and stem class probabilities (1-D or stacked 2-D arrays) with the fusion
+    engine (ML_FUSION). Either may be None when the other organ decided alone.
+    """
+    return current_fusion_engine().fuse(bud_class_probabilities, stem_class_probabilities)
+
+def encode_crop_base64(crop):
+    """
+    Encodes a cropped image as a base64 JPEG string.
+    """
+    with stage('encode'):
+        _, buffer = cv2.imencode('.jpg', crop)
+        return base64.b64encode(buffer).decode('utf-8')
+
+# ============================
+# Classification and Fusion
+# ============================
+
+def classify_bud(crops, with_features=False):
+    """
+    Returns the bud classifier's class probabilities, one row per cropped bud
+    (and the feature rows, with with_features).
+    """
+    with stage('features'):
+        bud_features = features.extract_bud_features(features.resize_batch(crops))
+    with stage('classify', 'bud_classifier'):
+        class_probabilities = active_registry().get('bud_classifier').predict_proba(bud_features)
+    return (class_probabilities, bud_features) if with_features else class_probabilities
+
+def classify_stem(crops, with_features=False):
+    """
+    Returns the stem classifier's class probabilities, one row per cropped stem
+    (and the feature rows, with with_features).
+    """
+    with stage('features'):
+        stem_features = features.extract_stem_features(features.resize_batch(crops))
+    with stage('classify', 'stem_classifier'):
+        class_probabilities = active_registry().get('stem_classifier').predict_proba(stem_features)
+    return (class_probabilities, stem_features) if with_features else class_probabilities
+
+ORGAN_CLASSIFIERS = {classify_bud: 'bud', classify_stem: 'stem'}
+
+def aggregate_probabilities(class_probabilities, confidence_groups):
+    """
+    Averages per-crop class probabilities into one row per group of crops (e.g. all
+    buds detected in one photo), weighting each crop by its detection confidence.
+    class_probabilities holds the rows of all groups back to back.
+    """
+    class_probabilities = np.asarray(class_probabilities, dtype=float)
+    sizes = [len(group) for group in confidence_groups]
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1])).astype(np.intp)
+    # Floor the weights so detectors reporting zero confidence still average evenly
+    weights = np.maximum(np.concatenate([np.asarray(group, dtype=float) for group in confidence_groups]), 1e-6)
+    totals = np.add.reduceat(class_probabilities * weights[:, None], starts, axis=0)
+    return totals / np.add.reduceat(weights, starts)[:, None]
+
+def classify_detections(classify, crop_groups, confidence_groups, record=None):
+    """
+    Classifies every crop of every group with one classifier call (classify_bud or
+    classify_stem) and returns one confidence-weighted probability row per group.
+    With record (from feature_store.pair_records), the crops' feature rows
+    are added to the feature store.
+    """
+    crops = [crop for group in crop_groups for crop in group]
+    if record is None:
+        class_probabilities = classify(crops)
+    else:
+        class_probabilities, crop_features = classify(crops, with_features=True)
+        feature_store.record(ORGAN_CLASSIFIERS[classify], crop_features, **record)
+    return aggregate_probabilities(class_probabilities, confidence_groups)
+
+ORGAN_DETECTORS = {'bud': 'bud_detector', 'stem': 'stem_detector'}
+ORGAN_CLASSIFY = {organ: classify for classify, organ in ORGAN_CLASSIFIERS.items()}
+
+# Unpacked in place of an organ's detect_and_classify result when an early exit skipped it
+SKIPPED_ORGAN = ([], [], [], None)
+
+_deferred_executor = None
+
+def detect_and_classify(organ, image, record_keys=None):
+    """
+    Detects and classifies one organ in one image. Returns (crops, boxes, confidences,
+    class_probabilities), or None if nothing was detected. record_keys is the organ's
+    entry of feature_store.pair_keys for the pair.
+    """
+    crops, boxes, confidences = detect_and_crop_all(ORGAN_DETECTORS[organ], image, organ)
+    if not crops:
+        logger.debug("No %s detected", organ)
+        return None
+    record = organ_record(record_keys, [boxes], [confidences])
+    class_probabilities = classify_detections(ORGAN_CLASSIFY[organ], [crops], [confidences], record)[0]
+    return crops, boxes, confidences, [float(prob) for prob in class_probabilities]
+
+def count_fusion_path(organs):
+    engine = current_fusion_engine()
+    FUSION_PATHS.inc(engine.describe(organs)['path'], engine.first)
+
+def classify_organs(images, keys=None):
+    """
+    Runs detect_and_classify for each organ in fusion order, skipping the second organ
+    when the first is decisive (deferring it with EARLY_EXIT['DEFER']). images is
+    {organ: image}, keys the result of feature_store.pair_keys. Returns ({organ: result},
+    the organ that was not detected or None).
+    """
+    engine = current_fusion_engine()
+    results = {}
+    for organ in engine.order:
+        result = detect_and_classify(organ, images[organ], keys and keys[organ])
+        if result is None:
+            return results, organ
+        results[organ] = result
+        if len(results) == 1 and engine.decisive(organ, result[3]):
+            skipped = engine.order[1]
+            logger.debug("%s is decisive; skipping %s", organ, skipped)
+            if engine.defer:
+                defer_organ(skipped, images[skipped], keys and keys[skipped], {organ: result[3]})
+            break
+    count_fusion_path(list(results))
+    return results, None
+
+def _get_deferred_executor():
+    global _deferred_executor
+    if _deferred_executor is None:
+        _deferred_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='fusion-deferred')
+        atexit.register(_deferred_executor.shutdown, wait=False, cancel_futures=True)
+    return _deferred_executor
+
+def _complete_deferred(organ, image, record_keys, early_probabilities):
+    try:
+        result = detect_and_classify(organ, image, record_keys)
+        if result is None:
+            EARLY_EXIT_AGREEMENT.inc('undetected')
+            return
+        full_probabilities = {**early_probabilities, organ: result[3]}
+        early = np.argmax(combine_probabilities(early_probabilities.get('bud'), early_probabilities.get('stem')))
+        full = np.argmax(combine_probabilities(full_probabilities['bud'], full_probabilities['stem']))
+        EARLY_EXIT_AGREEMENT.inc('agree' if early == full else 'disagree')
+    except Exception:
+        logger.exception("Deferred %s classification failed", organ)
+
+def defer_organ(organ, image, record_keys, early_probabilities):
+    """
+    Classifies an organ skipped by an early exit in the background and counts whether
+    the full prediction agrees with the early one (ml_fusion_early_exit_agreement_total).
+    """
+    # The copied context keeps the deferred run on the request's model set
+    return _get_deferred_executor().submit(
+        contextvars.copy_context().run, _complete_deferred, organ, image, record_keys, early_probabilities)
+
+def detections_summary(boxes, confidences):
+    return [{'box': box, 'confidence': confidence} for box, confidence in zip(boxes, confidences)]
+
+def final_prediction(combined_probabilities):
+    """
+    Returns (variety_name, confidence_percent) for one row of combined probabilities.
+    """
+    final_predicted_class_index = int(np.argmax(combined_probabilities))
+    final_variety = VARIETY_NAMES.get(final_predicted_class_index + 1, "Unknown Variety")
+    final_confidence = float(combined_probabilities[final_predicted_class_index]) * 100
+    return final_variety, final_confidence
+
+def save_crops(cropped_bud, bud_image_name, cropped_stem, stem_image_name):
+    """
+    Writes the cropped bud and stem to MEDIA_ROOT/cropped_buds and MEDIA_ROOT/cropped_stems.
+    A crop skipped by an early exit is None and not written.
+    """
+    with stage('save'):
+        if cropped_bud is not None:
+            cropped_bud_path = os.path.join(settings.MEDIA_ROOT, 'cropped_buds', f"cropped_{bud_image_name}")
+            os.makedirs(os.path.dirname(cropped_bud_path), exist_ok=True)
+            cv2.imwrite(cropped_bud_path, cropped_bud)
+        if cropped_stem is not None:
+            cropped_stem_path = os.path.join(settings.MEDIA_ROOT, 'cropped_stems', f"cropped_{stem_image_name}")
+            os.makedirs(os.path.dirname(cropped_stem_path), exist_ok=True)
+            cv2.imwrite(cropped_stem_path, cropped_stem)
+
+def fusion_response(bud_class_probabilities, stem_class_probabilities):
+    """
+    Returns the 'fusion' entry of a variety response: the path taken and the organs used.
+    """
+    class_probabilities = {'bud': bud_class_probabilities, 'stem': stem_class_probabilities}
+    engine = current_fusion_engine()
+    return engine.describe([organ for organ in engine.order if class_probabilities[organ] is not None])
+
+def variety_response(cropped_bud, bud_image_name, cropped_stem, stem_image_name, bud_class_probabilities, stem_class_probabilities):
+    """
+    Fuses the per-organ probabilities, saves the crops and builds the predict_variety response body.
+    The crop and probabilities of an organ skipped by an early exit are None.
+    """
+    combined_probabilities = combine_probabilities(bud_class_probabilities, stem_class_probabilities)
+    final_variety, final_confidence = final_prediction(combined_probabilities)
+    save_crops(cropped_bud, bud_image_name, cropped_stem, stem_image_name)
+    return {
+        'variety': final_variety,
+        'confidence': final_confidence,
+        'cropped_bud_image': encode_crop_base64(cropped_bud) if cropped_bud is not None else None,
+        'cropped_stem_image': encode_crop_base64(cropped_stem) if cropped_stem is not None else None,
+        'fusion': fusion_response(bud_class_probabilities, stem_class_probabilities),
+    }
+
+def lean_variety_response(cropped_bud, bud_box, cropped_stem, stem_box, bud_class_probabilities, stem_class_probabilities):
+    """
+    Builds the lean predict_variety response body: crop ids and boxes instead of base64 crops.
+    The crops go to the content-addressed crop store, not to cropped_buds/ and cropped_stems/.
+    """
+    combined_probabilities = combine_probabilities(bud_class_probabilities, stem_class_probabilities)
+    final_variety, final_confidence = final_prediction(combined_probabilities)
+    return {
+        'variety': final_variety,
+        'confidence': final_confidence,
+        'bud_crop': crop_reference(cropped_bud, bud_box) if cropped_bud is not None else None,
+        'stem_crop': crop_reference(cropped_stem, stem_box) if cropped_stem is not None else None,
+        'fusion': fusion_response(bud_class_probabilities, stem_class_probabilities),
+    }
@@ -0,0 +1,29 @@
+"""
+Deployment profiles, selected per process with ML_PROFILE.
+
+    full      - every endpoint
+    forecast  - sugar production forecasting, /api/models/ and /api/metrics only.
+                The URLconf then never imports views.py, so OpenCV, scikit-image,
+                the detectors and the variety pipeline are not loaded: run many
+                of these small workers for forecasting and fewer full ones.
+
+`manage.py benchmark_startup` measures import time and RSS per profile.
+"""
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+PROFILES = ('full', 'forecast')
+
+PROFILE = getattr(settings, 'ML_PROFILE', 'full')
+if PROFILE not in PROFILES:
+    raise ImproperlyConfigured(f"Unknown ML_PROFILE '{PROFILE}'; use one of: {', '.join(PROFILES)}")
+
+
+def profile_models(profile=PROFILE):
+    """
+    Returns the names of the models a profile uses, or None for all of them.
+    """
+    if profile == 'forecast':
+        from .forecast import FORECAST_MODELS  # Deferred: importing forecast builds the model registry
+        return FORECAST_MODELS
+    return None
@@ -0,0 +1,280 @@
+"""
+Lazy, thread-safe registry for the ML models used by the prediction views.
+
+Models are loaded on first use instead of at import time, so management
+commands and endpoints that do not need a model never pay for loading it,
+and one unreadable model file only breaks the endpoints that use it.
+"""
+import contextlib
+import contextvars
+import functools
+import logging
+import os
+import pickle
+import threading
+import time
+
+from django.conf import settings
+
+from .compiled_trees import CompiledForest, compiled_path
+from .detectors import detector_path, load_detector, warm_up_detector
+from .metrics import MODEL_LOAD_DURATION, MODEL_LOADS
+from .model_server import MODEL_SERVER_CONFIG, RemoteModel
+from .sugar_grid import GRID_CONFIG, load_sugar_grid
+
+logger = logging.getLogger(__name__)
+
+MODELS_DIR = os.path.join(settings.BASE_DIR, 'ml_models')
+
+DEFAULT_MODEL_PATHS = {
+    'bud_detector': os.path.join(MODELS_DIR, 'best.pt'),
+    'bud_classifier': os.path.join(MODELS_DIR, 'sugarcane_rf_model.pkl'),
+    'stem_detector': os.path.join(MODELS_DIR, 'StemDetection_v1.pt'),
+    'stem_classifier': os.path.join(MODELS_DIR, 'modelsbest_xgboost.pkl'),
+    'sugar_production': os.path.join(MODELS_DIR, 'sugar_production_model.pkl'),
+}
+
+MODEL_PATHS = {**DEFAULT_MODEL_PATHS, **getattr(settings, 'ML_MODEL_PATHS', {})}
+
+# Seconds between mtime checks when ML_MODEL_AUTO_RELOAD is enabled
+AUTO_RELOAD = getattr(settings, 'ML_MODEL_AUTO_RELOAD', False)
+RELOAD_CHECK_INTERVAL = getattr(settings, 'ML_MODEL_RELOAD_CHECK_INTERVAL', 5.0)
+
+# Serve the classifiers from the .compiled.npz files written by compile_classifiers
+USE_COMPILED_CLASSIFIERS = getattr(settings, 'ML_USE_COMPILED_CLASSIFIERS', False)
+
+
+# ============================
+# Loaders and Warm-up Functions
+# ============================
+
+def load_joblib(path):
+    import joblib
+    return joblib.load(path)
+
+
+def load_pickle(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def load_classifier(path):
+    """
+    Loads a tree-ensemble classifier, preferring its compiled form when enabled.
+    A compiled file older than the pickle is stale and ignored.
+    """
+    if USE_COMPILED_CLASSIFIERS:
+        compiled = compiled_path(path)
+        try:
+            if os.path.getmtime(compiled) >= os.path.getmtime(path):
+                return CompiledForest.load(compiled)
+            logger.warning("Ignoring stale compiled classifier %s; run compile_classifiers", compiled)
+        except OSError:
+            pass
+    return load_joblib(path)
+
+
+class ModelEntry:
+    def __init__(self, name, path, loader, warm_up=None):
+        self.name = name
+        self.path = path
+        self.loader = loader
+        self.warm_up = warm_up
+        self.model = None
+        self.mtime = None
+        self.load_seconds = None
+        self.warm_up_seconds = None
+        self.loaded_at = None
+        self.load_count = 0
+        self.last_error = None
+        self.last_checked = 0.0
+        self.lock = threading.Lock()
+
+
+class ModelRegistry:
+    """
+    Loads each registered model lazily on first use, under a per-model lock.
+    """
+
+    def __init__(self):
+        self._entries = {}
+
+    def register(self, name, path, loader, warm_up=None):
+        self._entries[name] = ModelEntry(name, path, loader, warm_up)
+
+    def names(self):
+        return list(self._entries)
+
+    def get(self, name):
+        """
+        Returns the model registered under name, loading it on first use.
+        """
+        entry = self._entries[name]
+        model = entry.model
+        if model is not None:
+            if AUTO_RELOAD:
+                self._reload_if_changed(entry)
+                return entry.model
+            return model
+
+        with entry.lock:
+            if entry.model is None:
+                self._load(entry)
+            return entry.model
+
+    def _load(self, entry):
+        start = time.perf_counter()
+        try:
+            model = entry.loader(entry.path)
+        except Exception as e:
+            entry.last_error = str(e)
+            MODEL_LOADS.inc(entry.name, 'error')
+            raise
+        entry.load_seconds = time.perf_counter() - start
+        MODEL_LOADS.inc(entry.name, 'success')
+        MODEL_LOAD_DURATION.observe(entry.load_seconds, entry.name)
+        entry.mtime = os.path.getmtime(entry.path)
+        entry.loaded_at = time.time()
+        entry.load_count += 1
+        entry.last_error = None
+        # Swap in last, so readers never see a half-initialised entry
+        entry.model = model
+        logger.info("Loaded model '%s' from %s in %.2fs", entry.name, entry.path, entry.load_seconds)
+
+    def _reload_if_changed(self, entry):
+        now = time.monotonic()
+        if now - entry.last_checked < RELOAD_CHECK_INTERVAL:
+            return
+        entry.last_checked = now
+        try:
+            mtime = os.path.getmtime(entry.path)
+        except OSError:
+            return
+        if mtime == entry.mtime:
+            return
+        try:
+            self.reload(entry.name)
+        except Exception:
+            # A half-written or broken file: keep serving the old model, and retry
+            # only once the file changes again rather than on every check
+            logger.exception("Failed to reload model '%s' from %s (%s); keeping the loaded model",
+                             entry.name, entry.path, entry.last_error)
+            entry.mtime = mtime
+
+    def reload(self, name):
+        """
+        Reloads a model from its file without restarting the process.
+        Requests already holding the old model keep using it; if the new file
+        fails to load, the old model stays in service and the error is raised.
+        """
+        entry = self._entries[name]
+        with entry.lock:
+            self._load(entry)
+            if entry.warm_up is not None:
+                self._warm_up(entry)
+        return entry.model
+
+    def _warm_up(self, entry):
+        start = time.perf_counter()
+        entry.warm_up(entry.model)
+        entry.warm_up_seconds = time.perf_counter() - start
+
+    def warm_up(self, names=None):
+        """
+        Eagerly loads (and warms up) the given models, or all of them.
+        Failures are reported and skipped so one bad file does not stop the others.
+        """
+        for name in names or self.names():
+            entry = self._entries[name]
+            try:
+                self.get(name)
+                if entry.warm_up is not None and entry.warm_up_seconds is None:
+                    with entry.lock:
+                        self._warm_up(entry)
+            except Exception as e:
+                entry.last_error = str(e)
+                logger.error("Failed to load model '%s': %s", name, e)
+
+    def fingerprint(self, names=None):
+        """
+        Returns a short string identifying the current version of the given model files.
+        Built from file size and mtime, so it changes when a model file is replaced
+        and does not require the model to be loaded.
+        """
+        parts = []
+        for name in names or self.names():
+            entry = self._entries[name]
+            try:
+                stat = os.stat(entry.path)
+                parts.append(f"{name}:{stat.st_size}:{stat.st_mtime_ns}")
+            except OSError:
+                parts.append(f"{name}:missing")
+        return '|'.join(parts)
+
+    def stats(self):
+        """
+        Returns load state and timings for every registered model.
+        """
+        return {
+            name: {
+                'path': entry.path,
+                'loaded': entry.model is not None,
+                'load_seconds': entry.load_seconds,
+                'warm_up_seconds': entry.warm_up_seconds,
+                'loaded_at': entry.loaded_at,
+                'load_count': entry.load_count,
+                'last_error': entry.last_error,
+            }
+            for name, entry in self._entries.items()
+        }
+
+
+def model_registry(remote=False):
+    """
+    Returns a registry with every prediction model registered. With remote, the models
+    in ML_MODEL_SERVER['MODELS'] are RemoteModel proxies to the model server.
+    """
+    def loader(name, local_loader):
+        if remote and name in MODEL_SERVER_CONFIG['MODELS']:
+            return functools.partial(RemoteModel, name)
+        return local_loader
+
+    def warm_up(name, local_warm_up):
+        # The server warms up the models it serves
+        return None if remote and name in MODEL_SERVER_CONFIG['MODELS'] else local_warm_up
+
+    registry = ModelRegistry()
+    for name in ('bud_detector', 'stem_detector'):
+        registry.register(name, detector_path(MODEL_PATHS[name]), loader(name, load_detector), warm_up(name, warm_up_detector))
+    for name in ('bud_classifier', 'stem_classifier'):
+        registry.register(name, MODEL_PATHS[name], loader(name, load_classifier))
+    registry.register('sugar_production', MODEL_PATHS['sugar_production'], loader('sugar_production', load_pickle))
+    if GRID_CONFIG['ENABLED']:
+        # Memory-mapped, so processes already share it through the page cache
+        registry.register('sugar_grid', GRID_CONFIG['PATH'], load_sugar_grid)
+    return registry
+
+
+registry = model_registry(remote=MODEL_SERVER_CONFIG['ENABLED'])
+
+_active = contextvars.ContextVar('active_registry', default=None)
+
+
+def active_registry():
+    """
+    Returns the registry the pipeline takes models from in this context: the candidate
+    model set inside use_registry (see shadow.py), otherwise the default registry.
+    """
+    return _active.get() or registry
+
+
+@contextlib.contextmanager
+def use_registry(models):
+    """
+    Runs the block (and the inference pool threads it starts) with models as the active registry.
+    """
+    token = _active.set(models)
+    try:
+        yield models
+    finally:
+        _active.reset(token)
@@ -0,0 +1,349 @@
+"""
+Shadow and A/B inference for candidate model versions.
+
+ML_SHADOW['CANDIDATE_PATHS'] names new files for any of the bud/stem
+detectors and classifiers; together with the current files of the other
+models they form the 'candidate' model set, next to the 'primary' one that
+normally answers. The candidate models are loaded lazily, in this process
+(also when the primary set is served by the model server), and a candidate
+classifier is fused with the ML_FUSION settings of its own version.
+
+    shadow  the primary set answers every request
+    ab      AB_PERCENT percent of requests are answered by the candidate set
+
+In both modes the set that did not answer runs afterwards on the same
+decoded images, for SAMPLE_RATE of the requests, in a small pool of
+low-priority threads (NICE). A run that would wait behind MAX_QUEUE others
+is dropped rather than queued, so a traffic spike never builds a backlog;
+ml_shadow_runs_total counts completed, dropped and failed runs. The other
+set classifies both organs without early exit and records no features.
+
+Each comparison is one RECORD_DTYPE row (both sets' predicted variety,
+confidence and fused probabilities, and each model's latency), buffered and
+written in chunks as <DIR>/<time>-<pid>-<n>.npy like the feature store's
+(see chunks.py), at most FLUSH_INTERVAL after they were recorded;
+`manage.py shadow_report` summarizes them. Only the single-pair endpoints
+(sync and async) are routed and shadowed.
+"""
+import atexit
+import contextlib
+import glob
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.conf import settings
+
+from .chunks import ChunkWriter, save_npy
+from .detectors import detector_path, load_detector, warm_up_detector
+from .fusion import FUSION_CONFIG, ORGANS, FusionEngine
+from .metrics import AB_REQUESTS, SHADOW_RUNS
+from .pipeline import VARIETY_NAMES, combine_probabilities, detect_and_classify
+from .registry import MODEL_PATHS, ModelRegistry, load_classifier, registry, use_registry
+from .timing import collect_stages
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SHADOW_CONFIG = {
+    'MODE': 'off',              # 'off', 'shadow' or 'ab'
+    'CANDIDATE_PATHS': {},      # {model name: candidate file}
+    'AB_PERCENT': 0.0,          # Percentage of requests the candidate set answers in 'ab' mode
+    'SAMPLE_RATE': 1.0,         # Fraction of requests on which the other set runs for comparison
+    'WORKERS': 1,
+    'MAX_QUEUE': 8,             # Comparison runs waiting or running; further ones are dropped
+    'NICE': 10,                 # Added to the shadow threads' niceness where supported
+    'DIR': os.path.join(settings.BASE_DIR, 'cache', 'shadow'),
+    'CHUNK_ROWS': 1024,
+    'FLUSH_INTERVAL': 60.0,     # Seconds a buffered record may wait for its chunk to fill
+}
+
+SHADOW_CONFIG = {**DEFAULT_SHADOW_CONFIG, **getattr(settings, 'ML_SHADOW', {})}
+
+MODES = ('off', 'shadow', 'ab')
+
+ARMS = ('primary', 'candidate')
+
+# Models a candidate set can replace, in the order of RECORD_DTYPE's model_ms columns
+MODELS = ('bud_detector', 'bud_classifier', 'stem_detector', 'stem_classifier')
+
+RECORD_DTYPE = np.dtype([
+    ('recorded_at', '<f8'),
+    ('served', 'u1'),                                          # Index in ARMS of the set that answered
+    ('variety', 'i1', (len(ARMS),)),                           # Class index per set; -1 if an organ was not found
+    ('confidence', '<f4', (len(ARMS),)),                       # Top fused probability per set
+    ('probabilities', '<f4', (len(ARMS), len(VARIETY_NAMES))),
+    ('model_ms', '<f4', (len(ARMS), len(MODELS))),             # NaN when not run or not measured
+])
+
+if SHADOW_CONFIG['MODE'] not in MODES:
+    raise ValueError(f"Unknown ML_SHADOW mode: {SHADOW_CONFIG['MODE']}")
+_unknown = set(SHADOW_CONFIG['CANDIDATE_PATHS']) - set(MODELS)
+if _unknown:
+    raise ValueError(f"ML_SHADOW candidates must be among {', '.join(MODELS)}, not {', '.join(sorted(_unknown))}")
+
+
+# ============================
+# Model Sets
+# ============================
+
+class CandidateRegistry(ModelRegistry):
+    """
+    The candidate model set: the models given paths are loaded from those files, every
+    other model is taken from the primary registry.
+    """
+
+    def __init__(self, primary, paths):
+        super().__init__()
+        self.primary = primary
+        self._fingerprint = None
+        for name, path in paths.items():
+            if name.endswith('_detector'):
+                self.register(name, detector_path(path), load_detector, warm_up_detector)
+            else:
+                self.register(name, path, load_classifier)
+        self.fusion_engine = FusionEngine.from_config(FUSION_CONFIG, {**MODEL_PATHS, **paths})
+
+    def get(self, name):
+        if name in self._entries:
+            return super().get(name)
+        return self.primary.get(name)
+
+    def fingerprint(self, names=None):
+        """
+        Like ModelRegistry.fingerprint, but the candidate files' fingerprint is computed
+        again only when a candidate model is (re)loaded, so A/B requests do not stat them.
+        """
+        if names is not None:
+            return super().fingerprint(names)
+        loads = tuple(entry.load_count for entry in self._entries.values())
+        cached = self._fingerprint
+        if cached is None or cached[0] != loads:
+            cached = self._fingerprint = (loads, super().fingerprint())
+        return cached[1]
+
+
+candidate_registry = CandidateRegistry(registry, SHADOW_CONFIG['CANDIDATE_PATHS'])
+
+ENABLED = SHADOW_CONFIG['MODE'] != 'off' and bool(SHADOW_CONFIG['CANDIDATE_PATHS'])
+AB_ENABLED = ENABLED and SHADOW_CONFIG['MODE'] == 'ab'
+
+
+def arm_registry(arm):
+    return candidate_registry if arm == 'candidate' else registry
+
+
+def use_arm(arm):
+    """
+    Runs the block on the given model set's models and fusion settings.
+    """
+    return use_registry(arm_registry(arm))
+
+
+def in_arm(arm, fn, *args, **kwargs):
+    """
+    Calls fn on the given model set. For inference pool calls, which in a process pool
+    do not inherit the caller's context.
+    """
+    with use_arm(arm):
+        return fn(*args, **kwargs)
+
+
+def choose_arm():
+    """
+    Returns the model set that answers a request.
+    """
+    if not ENABLED:
+        return 'primary'
+    arm = 'candidate' if AB_ENABLED and random.random() * 100 < SHADOW_CONFIG['AB_PERCENT'] else 'primary'
+    AB_REQUESTS.inc(arm)
+    return arm
+
+
+def served_timings():
+    """
+    Collects the per-model timings of the answering set while comparisons are enabled.
+    """
+    return collect_stages() if ENABLED else contextlib.nullcontext()
+
+
+# ============================
+# Comparison Records
+# ============================
+
+class ComparisonStore:
+    def __init__(self, directory, chunk_rows, flush_interval):
+        self.directory = directory
+        self._writer = ChunkWriter(self._write, chunk_rows, flush_interval, name='shadow-record-writer')
+
+    def record(self, row):
+        self._writer.add('records', row, len(row))
+
+    def flush(self):
+        self._writer.flush()
+
+    def _write(self, stream, rows, name):
+        records = np.concatenate(rows)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            save_npy(self.directory, name, records)
+        except OSError as e:
+            logger.warning("Failed to write %d shadow comparison records: %s", len(records), e)
+
+    def records(self):
+        """
+        Returns every stored record, oldest chunk first.
+        """
+        paths = sorted(path for path in glob.glob(os.path.join(self.directory, '*.npy')) if '.tmp.' not in path)
+        chunks = [np.load(path) for path in paths]
+        return np.concatenate(chunks) if chunks else np.zeros(0, dtype=RECORD_DTYPE)
+
+
+comparison_store = ComparisonStore(SHADOW_CONFIG['DIR'], SHADOW_CONFIG['CHUNK_ROWS'], SHADOW_CONFIG['FLUSH_INTERVAL'])
+
+
+def comparison_record(served, probabilities, model_seconds):
+    """
+    Builds one record. probabilities and model_seconds map each arm to its fused
+    probabilities (None when an organ was not found) and its {model: seconds}.
+    """
+    row = np.zeros(1, dtype=RECORD_DTYPE)
+    row['recorded_at'] = time.time()
+    row['served'] = ARMS.index(served)
+    row['variety'] = -1
+    row['model_ms'] = np.nan
+    for i, arm in enumerate(ARMS):
+        if probabilities.get(arm) is not None:
+            row['probabilities'][0, i] = probabilities[arm]
+            row['variety'][0, i] = int(np.argmax(probabilities[arm]))
+            row['confidence'][0, i] = float(np.max(probabilities[arm]))
+        for j, model in enumerate(MODELS):
+            if model in (model_seconds.get(arm) or {}):
+                row['model_ms'][0, i, j] = model_seconds[arm][model] * 1000
+    return row
+
+
+def summarize(records):
+    """
+    Returns the agreement, confidence delta and per-model latency of compared records.
+    Only records in which both sets predicted a variety count towards agreement.
+    """
+    both = records[(records['variety'] >= 0).all(axis=1)]
+    delta = both['confidence'][:, 1] - both['confidence'][:, 0]
+    latency = {}
+    for i, arm in enumerate(ARMS):
+        for j, model in enumerate(MODELS):
+            values = records['model_ms'][:, i, j]
+            values = values[~np.isnan(values)]
+            latency[f'{arm}:{model}'] = {
+                'runs': int(len(values)),
+                'median_ms': float(np.median(values)) if len(values) else None,
+                'p95_ms': float(np.percentile(values, 95)) if len(values) else None,
+            }
+    return {
+        'records': int(len(records)),
+        'served_by_candidate': int((records['served'] == ARMS.index('candidate')).sum()),
+        'compared': int(len(both)),
+        'agreement': float((both['variety'][:, 0] == both['variety'][:, 1]).mean()) if len(both) else None,
+        'confidence_delta_mean': float(delta.mean()) if len(both) else None,
+        'confidence_delta_abs_mean': float(np.abs(delta).mean()) if len(both) else None,
+        'undetected': {arm: int((records['variety'][:, i] < 0).sum()) for i, arm in enumerate(ARMS)},
+        'latency': latency,
+    }
+
+
+# ============================
+# Comparison Runs
+# ============================
+
+def _lower_priority(nice):
+    try:
+        # Linux applies niceness per thread
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), os.getpriority(os.PRIO_PROCESS, 0) + nice)
+    except (AttributeError, OSError):
+        pass
+
+
+def run_arm(arm, images):
+    """
+    Detects and classifies both organs with a model set. Returns (fused probabilities,
+    or None when an organ was not found, and {model: seconds}).
+    """
+    with use_arm(arm), collect_stages() as timings:
+        results = {organ: detect_and_classify(organ, images[organ]) for organ in ORGANS}
+        probabilities = None
+        if all(result is not None for result in results.values()):
+            probabilities = combine_probabilities(results['bud'][3], results['stem'][3])
+    return probabilities, timings.models
+
+
+class ShadowRunner:
+    def __init__(self, store, workers, max_queue, nice):
+        self.store = store
+        self.workers = workers
+        self.max_queue = max_queue
+        self.nice = nice
+        self.pending = 0
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix='shadow',
+                initializer=_lower_priority, initargs=(self.nice,),
+            )
+            atexit.register(self._executor.shutdown, wait=False, cancel_futures=True)
+        return self._executor
+
+    def submit(self, served, images, bud_class_probabilities, stem_class_probabilities, timings):
+        """
+        Queues a run of the set that did not answer, or drops it when MAX_QUEUE runs are pending.
+        """
+        with self._lock:
+            if self.pending >= self.max_queue:
+                SHADOW_RUNS.inc('dropped')
+                return None
+            self.pending += 1
+        # Submitted without the request's context, so the run has its own timings and model set
+        future = self._get_executor().submit(
+            self._compare, served, images, bud_class_probabilities, stem_class_probabilities, timings)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self.pending -= 1
+
+    def _compare(self, served, images, bud_class_probabilities, stem_class_probabilities, timings):
+        other = ARMS[1 - ARMS.index(served)]
+        try:
+            other_probabilities, other_seconds = run_arm(other, images)
+            with use_arm(served):
+                served_probabilities = combine_probabilities(bud_class_probabilities, stem_class_probabilities)
+            self.store.record(comparison_record(
+                served,
+                {served: served_probabilities, other: other_probabilities},
+                {served: timings.models if timings is not None else {}, other: other_seconds},
+            ))
+            SHADOW_RUNS.inc('completed')
+        except Exception:
+            SHADOW_RUNS.inc('failed')
+            logger.exception("Shadow run on the %s models failed", other)
+
+
+shadow_runner = ShadowRunner(
+    comparison_store, SHADOW_CONFIG['WORKERS'], SHADOW_CONFIG['MAX_QUEUE'], SHADOW_CONFIG['NICE'])
+
+
+def compare(served, images, bud_class_probabilities, stem_class_probabilities, timings):
+    """
+    Compares an answered request with the other model set off the request path.
+    images is {organ: decoded image}; timings the served_timings() of the answer.
+    """
+    if not ENABLED or random.random() >= SHADOW_CONFIG['SAMPLE_RATE']:
+        return None
+    return shadow_runner.submit(served, images, bud_class_probabilities, stem_class_probabilities, timings)
@@ -0,0 +1,98 @@
+"""
+Startup benchmark for the deployment profiles (`manage.py benchmark_startup`).
+
+Each measurement runs in a fresh interpreter (`python -m ml_integration.startup`)
+with ML_PROFILE set, timing django.setup(), loading the URLconf (which imports
+the profile's views) and, optionally, warming up the profile's models, then
+reporting the process RSS and which heavy libraries were imported. Only the
+standard library is imported at module level, so the probe measures the
+profile and not itself.
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HEAVY_MODULES = ('numpy', 'cv2', 'skimage', 'sklearn', 'xgboost', 'torch', 'ultralytics', 'onnxruntime', 'openvino')
+
+
+def rss_mb():
+    """
+    Returns the current resident set size in MB (the peak where /proc is not available).
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def probe(warm_up=False):
+    """
+    Starts Django in this process and returns its startup timings and footprint.
+    """
+    start = time.perf_counter()
+    import django
+    django.setup()
+    setup_done = time.perf_counter()
+    from django.urls import get_resolver
+    get_resolver().url_patterns  # Imports the URLconf and the views it routes to
+    urls_done = time.perf_counter()
+    warm_up_seconds = None
+    if warm_up:
+        from ml_integration.profiles import PROFILE, profile_models
+        from ml_integration.registry import registry
+        registry.warm_up(profile_models(PROFILE))
+        warm_up_seconds = time.perf_counter() - urls_done
+    return {
+        'setup_seconds': setup_done - start,
+        'urls_seconds': urls_done - setup_done,
+        'import_seconds': urls_done - start,
+        'warm_up_seconds': warm_up_seconds,
+        'rss_mb': rss_mb(),
+        'modules': len(sys.modules),
+        'heavy_modules': [name for name in HEAVY_MODULES if name in sys.modules],
+    }
+
+
+def measure_profile(profile, repeat=3, warm_up=False, cwd=None):
+    """
+    Runs the probe `repeat` times in fresh interpreters with ML_PROFILE=profile and
+    returns the median of each measurement, with the interpreter's total wall time.
+    """
+    env = {**os.environ, 'ML_PROFILE': profile}
+    env.setdefault('DJANGO_SETTINGS_MODULE', 'sugarcane_classify_app_backend.settings')
+    command = [sys.executable, '-m', 'ml_integration.startup'] + (['--warm-up'] if warm_up else [])
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        completed = subprocess.run(command, cwd=cwd, env=env, capture_output=True, text=True)
+        wall_seconds = time.perf_counter() - start
+        if completed.returncode != 0:
+            raise RuntimeError(f"Startup probe for profile '{profile}' failed:\n{completed.stderr.strip()}")
+        # The report is the last line; Django or model loading may have logged before it
+        runs.append({**json.loads(completed.stdout.strip().splitlines()[-1]), 'wall_seconds': wall_seconds})
+
+    def median(key):
+        values = [run[key] for run in runs if run[key] is not None]
+        return statistics.median(values) if values else None
+
+    return {
+        'profile': profile,
+        'repeat': repeat,
+        'warm_up': warm_up,
+        **{key: median(key) for key in (
+            'wall_seconds', 'import_seconds', 'setup_seconds', 'urls_seconds', 'warm_up_seconds', 'rss_mb', 'modules')},
+        'heavy_modules': runs[-1]['heavy_modules'],
+    }
+
+
+if __name__ == '__main__':
+    print(json.dumps(probe(warm_up='--warm-up' in sys.argv[1:])))
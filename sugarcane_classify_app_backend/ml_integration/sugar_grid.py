@@ -0,0 +1,266 @@
+"""
+Precomputed response grid for the sugar production model.
+
+Clients send the three climate inputs at coarse precision, so the same
+values come in again and again. build_grid() evaluates the model once over
+a quantized (sunshine, soil_temp, temp_max) grid and stores the result as
+a .npy file that is memory-mapped at load time, plus a .json sidecar with
+the grid axes, the model fingerprint it was built from and its error bound.
+
+Lookups on a grid point return the stored model output exactly. Points
+between grid points are trilinearly interpolated when INTERPOLATE is on,
+and otherwise, like points outside the grid, are left to the live model.
+
+The recorded max_error bounds |interpolated - model| over the whole grid.
+For a sklearn tree ensemble it is computed exactly from the split
+thresholds: the forest is constant between consecutive thresholds, so
+evaluating it on the grid refined with every threshold gives the full range
+of values inside each grid cell, and an interpolated value (a weighted mean
+of the cell's corners) always lies in its cell's range. For other models it is the largest error measured on a
+random sample of points ('max_error_method': 'sampled').
+"""
+import json
+import logging
+import os
+import time
+
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+FEATURES = ('sunshine', 'soil_temp', 'temp_max')
+
+DEFAULT_GRID_CONFIG = {
+    'ENABLED': False,
+    'PATH': os.path.join(settings.BASE_DIR, 'ml_models', 'sugar_production_grid.npy'),
+    # (start, stop, step) per input; the stop value is included
+    'AXES': {
+        'sunshine': (4.0, 10.0, 0.1),
+        'soil_temp': (24.0, 34.0, 0.1),
+        'temp_max': (20.0, 40.0, 0.1),
+    },
+    'INTERPOLATE': True,
+    'BUILD_IF_STALE': False,  # Build (or rebuild) the grid on load instead of failing
+}
+
+GRID_CONFIG = {**DEFAULT_GRID_CONFIG, **getattr(settings, 'ML_SUGAR_GRID', {})}
+
+# Inputs this close to a grid point (in units of the step) are treated as on it
+SNAP_TOLERANCE = 1e-6
+
+SAMPLED_ERROR_POINTS = 200000
+
+
+def metadata_path(grid_path):
+    return os.path.splitext(grid_path)[0] + '.json'
+
+
+def axis_points(start, stop, step):
+    """
+    Returns the grid coordinates along one axis, rounded so they compare equal to decimal client input.
+    """
+    count = int(round((stop - start) / step)) + 1
+    return np.round(start + step * np.arange(count), 10)
+
+
+def predict_points(model, axes, chunk_rows=1 << 20):
+    """
+    Evaluates the model on the full product of the given axes; returns an array of shape (len(a) for a in axes).
+    """
+    shape = tuple(len(axis) for axis in axes)
+    values = np.empty(shape, dtype=np.float64)
+    plane = len(axes[1]) * len(axes[2])
+    step = max(1, chunk_rows // plane)
+    rest = np.stack(np.meshgrid(axes[1], axes[2], indexing='ij'), axis=-1).reshape(-1, 2)
+    for start in range(0, shape[0], step):
+        first = axes[0][start:start + step]
+        X = np.column_stack((np.repeat(first, len(rest)), np.tile(rest, (len(first), 1))))
+        values[start:start + step] = model.predict(X).reshape((len(first),) + shape[1:])
+    return values
+
+
+# ============================
+# Error Bound
+# ============================
+
+def _forest_thresholds(model, feature):
+    trees = [estimator.tree_ for estimator in getattr(model, 'estimators_', [])]
+    if not trees or not all(hasattr(tree, 'threshold') for tree in trees):
+        return None
+    thresholds = np.unique(np.concatenate([tree.threshold[tree.feature == feature] for tree in trees]))
+    # sklearn sends float32(x) <= threshold left, so the last input going left is the
+    # largest float32 not above the threshold
+    left = thresholds.astype(np.float32)
+    left = np.where(left > thresholds, np.nextafter(left, np.float32(-np.inf)), left)
+    return np.unique(left.astype(np.float64))
+
+
+def _cell_reduce(values, grid_indices, axis, ufunc):
+    # Reduces each [grid point i, grid point i + 1] block of the refined axis (both ends included)
+    segments = ufunc.reduceat(values, grid_indices[:-1], axis=axis)
+    return ufunc(segments, np.take(values, grid_indices[1:], axis=axis))
+
+
+def max_interpolation_error(model, axes, seed=0):
+    """
+    Returns (bound, method) for the largest |trilinear interpolation - model| anywhere on the grid.
+    """
+    thresholds = [_forest_thresholds(model, j) for j in range(len(axes))]
+    if any(t is None for t in thresholds):
+        rng = np.random.default_rng(seed)
+        X = np.column_stack([rng.uniform(axis[0], axis[-1], SAMPLED_ERROR_POINTS) for axis in axes])
+        grid = SugarGrid(predict_points(model, axes), axes, interpolate=True)
+        predictions, _ = grid.lookup(X)
+        return float(np.abs(predictions - model.predict(X)).max()), 'sampled'
+
+    refined_axes, grid_indices = [], []
+    for axis, axis_thresholds in zip(axes, thresholds):
+        inside = axis_thresholds[(axis_thresholds > axis[0]) & (axis_thresholds < axis[-1])]
+        refined = np.union1d(axis, inside)
+        refined_axes.append(refined)
+        grid_indices.append(np.searchsorted(refined, axis))
+    values = predict_points(model, refined_axes)
+    highs, lows = values, values
+    for axis_index, indices in enumerate(grid_indices):
+        highs = _cell_reduce(highs, indices, axis_index, np.maximum)
+        lows = _cell_reduce(lows, indices, axis_index, np.minimum)
+    return float((highs - lows).max()), 'exact'
+
+
+# ============================
+# Grid Lookup
+# ============================
+
+class SugarGrid:
+    def __init__(self, values, axes, interpolate=True, metadata=None):
+        self.values = values
+        self.axes = axes
+        self.interpolate = interpolate
+        self.metadata = metadata or {}
+        self.starts = np.array([axis[0] for axis in axes])
+        self.steps = np.array([axis[1] - axis[0] for axis in axes])
+        self.sizes = np.array([len(axis) for axis in axes])
+
+    def lookup(self, X):
+        """
+        Returns (predictions, served) for an (N, 3) array. Rows the grid does not
+        serve (outside it, or between grid points with interpolation off) are NaN.
+        """
+        X = np.asarray(X, dtype=np.float64)
+        positions = (X - self.starts) / self.steps
+        nearest = np.rint(positions)
+        on_point = np.abs(positions - nearest) <= SNAP_TOLERANCE
+        positions = np.where(on_point, nearest, positions)
+        inside = ((positions >= 0) & (positions <= self.sizes - 1)).all(axis=1)
+        served = inside if self.interpolate else inside & on_point.all(axis=1)
+
+        predictions = np.full(len(X), np.nan)
+        if not served.any():
+            return predictions, served
+        positions = positions[served]
+        lower = np.minimum(np.floor(positions).astype(np.intp), self.sizes - 2)
+        fraction = positions - lower
+        result = np.zeros(len(positions))
+        # Trilinear: weighted sum of the 8 cell corners; exact on grid points, where the weights are 0/1
+        for corner in range(8):
+            offsets = np.array([(corner >> 2) & 1, (corner >> 1) & 1, corner & 1])
+            weights = np.prod(np.where(offsets, fraction, 1.0 - fraction), axis=1)
+            index = lower + offsets
+            result += weights * self.values[index[:, 0], index[:, 1], index[:, 2]]
+        predictions[served] = result
+        return predictions, served
+
+
+# ============================
+# Building and Loading
+# ============================
+
+def grid_axes(axes_config=None):
+    axes_config = axes_config or GRID_CONFIG['AXES']
+    return [axis_points(*axes_config[name]) for name in FEATURES]
+
+
+def build_grid(model, path, model_fingerprint, axes_config=None):
+    """
+    Evaluates the model over the configured grid, writes <path> (.npy) and its .json
+    metadata, and returns the metadata.
+    """
+    axes_config = axes_config or GRID_CONFIG['AXES']
+    axes = grid_axes(axes_config)
+    start = time.perf_counter()
+    values = predict_points(model, axes)
+    max_error, method = max_interpolation_error(model, axes)
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # Write to temporary names and swap in, so a running server never maps a half-written grid
+    temporary = path + '.tmp.npy'
+    np.save(temporary, values)
+    metadata = {
+        'features': list(FEATURES),
+        'axes': {name: list(axes_config[name]) for name in FEATURES},
+        'shape': list(values.shape),
+        'model_fingerprint': model_fingerprint,
+        'max_error': max_error,
+        'max_error_method': method,
+        'build_seconds': time.perf_counter() - start,
+        'built_at': time.time(),
+    }
+    with open(metadata_path(path) + '.tmp', 'w') as f:
+        json.dump(metadata, f, indent=2)
+    os.replace(metadata_path(path) + '.tmp', metadata_path(path))
+    os.replace(temporary, path)
+    return metadata
+
+
+def load_grid(path):
+    with open(metadata_path(path)) as f:
+        metadata = json.load(f)
+    axes = grid_axes(metadata['axes'])
+    values = np.load(path, mmap_mode='r')
+    if list(values.shape) != [len(axis) for axis in axes]:
+        raise ValueError(f"Sugar production grid {path} does not match its metadata")
+    return SugarGrid(values, axes, interpolate=GRID_CONFIG['INTERPOLATE'], metadata=metadata)
+
+
+def load_sugar_grid(path):
+    """
+    Registry loader: maps the grid, checking it was built from the current sugar production model.
+    """
+    from .registry import registry  # Deferred: the registry registers this loader
+
+    fingerprint = registry.fingerprint(['sugar_production'])
+    try:
+        grid = load_grid(path)
+        if grid.metadata.get('model_fingerprint') == fingerprint:
+            return grid
+        problem = f"Sugar production grid {path} was built from another model version"
+    except FileNotFoundError:
+        problem = f"Sugar production grid {path} not found"
+
+    if not GRID_CONFIG['BUILD_IF_STALE']:
+        raise ValueError(f"{problem}; run `manage.py build_sugar_grid`")
+    logger.info("%s; building it", problem)
+    build_grid(registry.get('sugar_production'), path, fingerprint)
+    return load_grid(path)
+
+
+_fallback_logged = False
+
+
+def lookup(X):
+    """
+    Looks the rows of X up in the registry's sugar production grid.
+    Returns (predictions, served); nothing is served when the grid cannot be loaded.
+    """
+    global _fallback_logged
+    from .registry import registry
+
+    try:
+        grid = registry.get('sugar_grid')
+    except Exception as e:
+        if not _fallback_logged:
+            logger.warning("Sugar production grid unavailable, using the live model: %s", e)
+            _fallback_logged = True
+        return np.full(len(X), np.nan), np.zeros(len(X), dtype=bool)
+    return grid.lookup(X)
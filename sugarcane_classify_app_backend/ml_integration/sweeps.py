@@ -0,0 +1,222 @@
+"""
+Variety prediction from a sweep along a cane: a short video clip or a burst of frames.
+
+Frames are read one at a time (a clip with cv2.VideoCapture, a burst upload
+by upload) and offered to a FrameSampler, which keeps at most MAX_FRAMES of
+them. Frames closer than MIN_HASH_DISTANCE bits to the last kept frame by a
+64-bit difference hash are skipped as near-duplicates; when more than
+MAX_FRAMES frames qualify, every other kept frame is dropped and the
+sampling stride doubles, so the kept frames stay spread over the whole
+sweep. Clips are read for at most MAX_DECODED_FRAMES frames and only about
+CANDIDATES of them are converted and hashed, so a clip costs a bounded
+amount of decoding, and at most MAX_FRAMES frames (downscaled to MAX_SIDE)
+are held in memory and reach the models.
+
+The kept frames go through the bud and stem detectors BATCH_FRAMES at a
+time, every selected detection is classified, and the per-frame class
+probabilities are averaged, weighted by each frame's best detection
+confidence, before the two organs are fused as for a photo pair.
+"""
+import logging
+import os
+import tempfile
+
+import cv2
+import numpy as np
+from django.conf import settings
+
+from .pipeline import (
+    ORGAN_CLASSIFY, ORGAN_DETECTORS, aggregate_probabilities, classify_detections, detect_and_crop_all_batch,
+)
+from .registry import registry
+from .timing import stage
+from .uploads import UploadRejected, decode_upload
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SWEEP_CONFIG = {
+    'MAX_FRAMES': 16,                      # Frames that reach the detectors per request (the frame budget)
+    'MAX_DECODED_FRAMES': 600,             # Frames read from a clip at most (10 s at 60 fps)
+    'CANDIDATES': 64,                      # Frames of a clip considered for sampling, evenly spaced
+    'MIN_HASH_DISTANCE': 6,                # Differing hash bits (of 64) for a frame not to be a near-duplicate
+    'BATCH_FRAMES': 8,                     # Frames per detector / classifier call
+    'MAX_SIDE': 1280,                      # Kept frames are downscaled to this long side
+    'MAX_BURST_FRAMES': 60,                # Frame uploads accepted per burst
+    'MAX_VIDEO_BYTES': 100 * 1024 * 1024,
+}
+
+SWEEP_CONFIG = {**DEFAULT_SWEEP_CONFIG, **getattr(settings, 'ML_SWEEP', {})}
+
+
+class SweepRejected(ValueError):
+    """
+    Raised when no usable frame could be read from a sweep.
+    """
+
+
+# ============================
+# Frame Sampling
+# ============================
+
+def frame_hash(frame):
+    """
+    Returns the 64-bit difference hash of a frame: whether each pixel of a 9x8
+    grayscale thumbnail is brighter than its left neighbour.
+    """
+    thumbnail = cv2.resize(frame, (9, 8), interpolation=cv2.INTER_AREA)
+    if thumbnail.ndim == 3:
+        thumbnail = cv2.cvtColor(thumbnail, cv2.COLOR_BGR2GRAY)
+    bits = thumbnail[:, 1:] > thumbnail[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def hash_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+def shrink(frame, max_side):
+    height, width = frame.shape[:2]
+    scale = max_side / max(height, width)
+    if scale >= 1:
+        return frame
+    return cv2.resize(frame, (max(1, round(width * scale)), max(1, round(height * scale))), interpolation=cv2.INTER_AREA)
+
+
+class FrameSampler:
+    """
+    Keeps at most max_frames distinct frames spread over a stream of frames.
+    """
+
+    def __init__(self, max_frames, min_distance, max_side, stride=1):
+        self.max_frames = max_frames
+        self.min_distance = min_distance
+        self.max_side = max_side
+        self.stride = stride
+        self.kept = []  # (index, frame, hash)
+        self.offered = 0
+        self.duplicates = 0
+
+    def wants(self, index):
+        """
+        Whether the frame at index is a sampling candidate; others need not be decoded.
+        """
+        return index % self.stride == 0
+
+    def offer(self, index, frame):
+        self.offered += 1
+        # Prepared uploads are hashed on their small detection copy
+        digest = frame_hash(getattr(frame, 'detect_image', frame))
+        if self.kept and hash_distance(digest, self.kept[-1][2]) < self.min_distance:
+            self.duplicates += 1
+            return False
+        if isinstance(frame, np.ndarray):
+            frame = shrink(frame, self.max_side)
+        self.kept.append((index, frame, digest))
+        if len(self.kept) > self.max_frames:
+            # Over budget: keep every other frame and sample half as often from here on
+            self.kept = self.kept[::2]
+            self.stride *= 2
+        return True
+
+    @property
+    def frames(self):
+        return [frame for _, frame, _ in self.kept]
+
+    def summary(self, read):
+        return {'read': read, 'candidates': self.offered, 'duplicates': self.duplicates, 'sampled': len(self.kept)}
+
+
+def _video_path(uploaded_file, spool):
+    if hasattr(uploaded_file, 'temporary_file_path'):
+        return uploaded_file.temporary_file_path()
+    # OpenCV reads clips from a path; small uploads only exist in memory
+    for chunk in uploaded_file.chunks():
+        spool.write(chunk)
+    spool.flush()
+    return spool.name
+
+
+def sample_video(uploaded_file, config=SWEEP_CONFIG):
+    """
+    Reads an uploaded clip frame by frame and returns (frames, summary).
+    """
+    suffix = os.path.splitext(uploaded_file.name or '')[1]
+    with tempfile.NamedTemporaryFile(suffix=suffix) as spool:
+        capture = cv2.VideoCapture(_video_path(uploaded_file, spool))
+        try:
+            if not capture.isOpened():
+                raise SweepRejected('Video could not be decoded')
+            limit = config['MAX_DECODED_FRAMES']
+            frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+            if 0 < frame_count < limit:
+                limit = frame_count
+            sampler = FrameSampler(
+                config['MAX_FRAMES'], config['MIN_HASH_DISTANCE'], config['MAX_SIDE'],
+                stride=max(1, -(-limit // config['CANDIDATES'])),
+            )
+            read = 0
+            with stage('decode'):
+                while read < limit and capture.grab():
+                    if sampler.wants(read):
+                        ok, frame = capture.retrieve()
+                        if ok:
+                            sampler.offer(read, frame)
+                    read += 1
+        finally:
+            capture.release()
+    if not sampler.kept:
+        raise SweepRejected('Video could not be decoded')
+    return sampler.frames, sampler.summary(read)
+
+
+def sample_burst(uploaded_files, config=SWEEP_CONFIG):
+    """
+    Decodes burst frame uploads one by one and returns (frames, summary). Undecodable
+    or rejected (blank, tiny) frames are skipped.
+    """
+    sampler = FrameSampler(config['MAX_FRAMES'], config['MIN_HASH_DISTANCE'], config['MAX_SIDE'])
+    for index, uploaded_file in enumerate(uploaded_files):
+        if not sampler.wants(index):
+            continue
+        try:
+            frame = decode_upload(uploaded_file, 'Frame')
+        except UploadRejected as e:
+            logger.debug("Skipping burst frame %d: %s", index, e)
+            continue
+        if frame is not None:
+            sampler.offer(index, frame)
+    if not sampler.kept:
+        raise SweepRejected('No frame could be decoded')
+    return sampler.frames, sampler.summary(len(uploaded_files))
+
+
+# ============================
+# Classification
+# ============================
+
+def classify_frames(organ, frames, batch_frames=None):
+    """
+    Detects and classifies one organ in every frame, batch_frames frames per detector and
+    classifier call. Returns (class_probabilities, frames_used, best_crop, best_box), the
+    probabilities averaged over the frames by their best detection confidence, or None
+    when the organ was not found in any frame.
+    """
+    batch_frames = batch_frames or SWEEP_CONFIG['BATCH_FRAMES']
+    rows, weights = [], []
+    best = None
+    for start in range(0, len(frames), batch_frames):
+        detections = detect_and_crop_all_batch(
+            registry.get(ORGAN_DETECTORS[organ]), frames[start:start + batch_frames], organ)
+        detections = [(crops, boxes, confidences) for crops, boxes, confidences in detections if crops]
+        if not detections:
+            continue
+        rows.extend(classify_detections(
+            ORGAN_CLASSIFY[organ], [crops for crops, _, _ in detections], [confidences for _, _, confidences in detections]))
+        for crops, boxes, confidences in detections:
+            weights.append(confidences[0])
+            if best is None or confidences[0] > best[0]:
+                best = confidences[0], crops[0], boxes[0]
+    if not rows:
+        return None
+    class_probabilities = aggregate_probabilities(rows, [weights])[0]
+    return [float(prob) for prob in class_probabilities], len(rows), best[1], best[2]
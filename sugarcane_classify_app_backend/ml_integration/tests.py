@@ -1,3 +1,1091 @@
-from django.test import TestCase
+import glob
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import cv2
+import numpy as np
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+from skimage.feature import hog
+from skimage.feature.texture import graycomatrix, graycoprops
+
+from . import (
+    batching, benchmark, bulk, cache, crops, detectors, feature_store, features, fusion, jobs, model_server, offline,
+    pipeline, shadow, startup, sugar_grid, sweeps, tiling, uploads, views,
+)
+from .compiled_trees import CompiledForest, compile_classifier
+from .executor import InferencePool
+from .metrics import MetricsRegistry
+from .models import PredictionJob
+from .registry import MODEL_PATHS, ModelRegistry, active_registry, load_joblib, registry, use_registry
+
+
+def load_sample_crops(directory, limit=8):
+    """
+    Loads a few stored crops from the repository, falling back to random images.
+    """
+    paths = sorted(glob.glob(os.path.join(settings.BASE_DIR, directory, '*.jpg')))[:limit]
+    crops = [cv2.imread(path) for path in paths]
+    crops = [crop for crop in crops if crop is not None]
+    rng = np.random.default_rng(0)
+    crops.append(rng.integers(0, 256, size=(97, 143, 3), dtype=np.uint8))
+    crops.append(np.full((64, 64, 3), 120, dtype=np.uint8))  # Flat image: zero texture variance
+    return crops
+
+
+# Reference implementations: the original per-image feature extraction the classifiers were trained with
+
+def reference_bud_features(img):
+    img = cv2.cvtColor(cv2.resize(img, (128, 128)), cv2.COLOR_BGR2RGB)
+    hist = np.concatenate([cv2.calcHist([img], [i], None, [256], [0, 256]).flatten() for i in range(3)])
+    gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    hog_features = hog(gray, orientations=9, pixels_per_cell=(8, 8), cells_per_block=(2, 2),
+                       block_norm='L2-Hys', feature_vector=True)
+    return np.concatenate((hist, hog_features))
+
+
+def reference_stem_features(image):
+    image = cv2.resize(image, (128, 128))
+    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+    hist = []
+    for source in (image, hsv):
+        for i in range(3):
+            hist.extend(cv2.calcHist([source], [i], None, [32], [0, 256]).flatten())
+    stats = []
+    for source in (image, hsv):
+        for i in range(3):
+            stats.append(np.mean(source[:, :, i]))
+            stats.append(np.std(source[:, :, i]))
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    glcm = graycomatrix(gray, distances=[1], angles=[0], levels=256, symmetric=True, normed=True)
+    texture = [graycoprops(glcm, prop)[0, 0]
+               for prop in ('contrast', 'dissimilarity', 'homogeneity', 'energy', 'correlation')]
+    return np.concatenate((np.array(hist), np.array(stats), np.array(texture)))
+
+
+class BudFeatureTests(SimpleTestCase):
+    def test_matches_reference(self):
+        crops = load_sample_crops('cropped_buds')
+        batch_features = features.extract_bud_features(features.resize_batch(crops))
+        for crop, row in zip(crops, batch_features):
+            np.testing.assert_array_equal(row, reference_bud_features(crop))
+
+
+class StemFeatureTests(SimpleTestCase):
+    def setUp(self):
+        self.crops = load_sample_crops('cropped_stems')
+        self.batch_features = features.extract_stem_features(features.resize_batch(self.crops))
+        self.reference = np.stack([reference_stem_features(crop) for crop in self.crops])
+
+    def test_feature_layout(self):
+        self.assertEqual(self.batch_features.shape, (len(self.crops), 209))
+
+    def test_histograms_and_means_are_exact(self):
+        np.testing.assert_array_equal(self.batch_features[:, :192], self.reference[:, :192])
+        np.testing.assert_array_equal(self.batch_features[:, 192:204:2], self.reference[:, 192:204:2])
+
+    def test_stds_and_texture_within_tolerance(self):
+        np.testing.assert_allclose(self.batch_features[:, 193:204:2], self.reference[:, 193:204:2], rtol=1e-12, atol=1e-12)
+        np.testing.assert_allclose(self.batch_features[:, 204:], self.reference[:, 204:], rtol=1e-9, atol=1e-12)
+
+
+class CompiledClassifierTests(SimpleTestCase):
+    """
+    The compiled ensembles must give the same class probabilities as the models they replace.
+    """
+
+    def assert_parity(self, model, X, atol):
+        compiled = compile_classifier(model)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'model.compiled.npz')
+            compiled.save(path)
+            compiled = CompiledForest.load(path)
+        np.testing.assert_allclose(compiled.predict_proba(X), model.predict_proba(X), rtol=0, atol=atol)
+        np.testing.assert_array_equal(compiled.predict(X), model.predict(X))
+
+    def test_random_forest(self):
+        from sklearn.ensemble import RandomForestClassifier
+        rng = np.random.default_rng(0)
+        X = rng.normal(size=(300, 20))
+        y = rng.integers(0, 4, size=300)
+        model = RandomForestClassifier(n_estimators=25, random_state=0).fit(X, y)
+        self.assert_parity(model, rng.normal(size=(100, 20)), atol=1e-12)
+
+    def test_xgboost_with_missing_values(self):
+        from xgboost import XGBClassifier
+        rng = np.random.default_rng(0)
+        X = rng.normal(size=(300, 20))
+        X[rng.random(X.shape) < 0.1] = np.nan
+        y = rng.integers(0, 4, size=300)
+        model = XGBClassifier(n_estimators=20, max_depth=4).fit(X, y)
+        X_test = rng.normal(size=(100, 20))
+        X_test[rng.random(X_test.shape) < 0.1] = np.nan
+        self.assert_parity(model, X_test, atol=1e-6)
+
+    def test_stem_classifier_on_stored_crops(self):
+        path = MODEL_PATHS['stem_classifier']
+        if not os.path.exists(path):
+            self.skipTest(f"{path} not found")
+        crops = load_sample_crops('cropped_stems', limit=40)
+        X = features.extract_stem_features(features.resize_batch(crops))
+        self.assert_parity(load_joblib(path), X, atol=1e-6)
+
+    def test_bud_classifier_on_stored_crops(self):
+        path = MODEL_PATHS['bud_classifier']
+        if not os.path.exists(path):
+            self.skipTest(f"{path} not found")
+        crops = load_sample_crops('cropped_buds', limit=60)
+        X = features.extract_bud_features(features.resize_batch(crops))
+        self.assert_parity(load_joblib(path), X, atol=1e-12)
+
+
+class MetricsTests(SimpleTestCase):
+    def test_prometheus_text_format(self):
+        registry = MetricsRegistry()
+        requests = registry.counter('requests_total', 'Requests.', ['endpoint'])
+        latency = registry.histogram('latency_seconds', 'Latency.', ['endpoint'], buckets=(0.1, 1.0))
+        requests.inc('predict')
+        requests.inc('predict')
+        for value in (0.05, 0.1, 0.5, 3.0):
+            latency.observe(value, 'pre"dict')
+
+        lines = registry.render().splitlines()
+        self.assertIn('# TYPE requests_total counter', lines)
+        self.assertIn('requests_total{endpoint="predict"} 2', lines)
+        self.assertIn('latency_seconds_bucket{endpoint="pre\\"dict",le="0.1"} 2', lines)
+        self.assertIn('latency_seconds_bucket{endpoint="pre\\"dict",le="1.0"} 3', lines)
+        self.assertIn('latency_seconds_bucket{endpoint="pre\\"dict",le="+Inf"} 4', lines)
+        self.assertIn('latency_seconds_sum{endpoint="pre\\"dict"} 3.65', lines)
+        self.assertIn('latency_seconds_count{endpoint="pre\\"dict"} 4', lines)
+
+
+class BenchmarkHarnessTests(SimpleTestCase):
+    def test_sugar_inputs_stay_within_the_grid_axes(self):
+        inputs = benchmark.Replay('predict-sugar-production', []).sugar_inputs
+        for column, name in zip(inputs.T, sugar_grid.FEATURES):
+            start, stop, _ = sugar_grid.GRID_CONFIG['AXES'][name]
+            self.assertTrue(((column >= start) & (column <= stop)).all(), name)
+
+    def test_run_and_compare(self):
+        run = benchmark.run_benchmark('predict-sugar-production', [], requests=4, concurrency=2, warmup=1)
+        self.assertEqual((run['requests'], run['statuses']), (4, {'200': 4}))
+        self.assertEqual(set(run['latency_ms']), {'mean', 'p50', 'p95', 'p99', 'max'})
+        baseline = {'runs': [run, {**run, 'concurrency': 4}]}
+        current = {'runs': [{**run, 'throughput_rps': run['throughput_rps'] * 2}, {**run, 'concurrency': 4, 'latency_ms': None}]}
+        lines = benchmark.compare_runs(baseline, current)
+        self.assertEqual(len(lines), 1)
+        self.assertIn('(+100.0%)', lines[0])
+
+    def test_rejects_runs_without_requests(self):
+        with self.assertRaises(ValueError):
+            benchmark.run_benchmark('predict-sugar-production', [], requests=0)
+        with self.assertRaisesMessage(CommandError, '--requests'):
+            call_command('benchmark_predictions', '--requests', '0', stdout=io.StringIO())
+
+
+class BulkSugarProductionTests(SimpleTestCase):
+    def setUp(self):
+        if not os.path.exists(MODEL_PATHS['sugar_production']):
+            self.skipTest("sugar production model not found")
+        self.X = np.array([[2000.5, 25.1, 30.2], [2400.0, 22.0, 33.0], [1900.0, 31.0, 29.0]])
+        self.expected = np.round(registry.get('sugar_production').predict(self.X), 2)
+
+    def run_bulk(self, body, input_format, output_format, chunk_rows=2):
+        body = body if isinstance(body, bytes) else body.encode()
+        return ''.join(bulk.bulk_predictions(io.BytesIO(body), input_format, output_format, chunk_rows))
+
+    def test_csv_columns_in_any_order(self):
+        body = 'temp_max,id,sunshine,soil_temp\n' + ''.join(f'{c},x,{a},{b}\n' for a, b, c in self.X)
+        rows = self.run_bulk(body, 'csv', 'csv').splitlines()
+        self.assertEqual(rows[0], 'sunshine,soil_temp,temp_max,predicted_sugar_production')
+        self.assertEqual([float(row.split(',')[3]) for row in rows[1:]], self.expected.tolist())
+
+    def test_invalid_rows_get_null_predictions(self):
+        rows = [dict(zip(bulk.FEATURES, row)) for row in self.X.tolist()]
+        rows.insert(1, {'sunshine': 'n/a', 'soil_temp': 25, 'temp_max': 30})
+        result = json.loads(self.run_bulk(json.dumps(rows), 'json', 'json'))
+        self.assertEqual(result['predictions'], [self.expected[0], None] + self.expected[1:].tolist())
+        self.assertEqual((result['rows'], result['invalid_rows']), (4, 1))
+
+    def test_invalid_utf8_rows_get_null_predictions(self):
+        rows = [f'{a},{b},{c}\n'.encode() for a, b, c in self.X]
+        rows.insert(2, b'\xff\xfe,25,30\n')  # In the second chunk, after the response has started
+        result = json.loads(self.run_bulk(b'sunshine,soil_temp,temp_max\n' + b''.join(rows), 'csv', 'json'))
+        self.assertEqual(result['predictions'], self.expected[:2].tolist() + [None, self.expected[2]])
+
+    def test_missing_columns_rejected_before_streaming(self):
+        with self.assertRaises(bulk.BulkInputError):
+            self.run_bulk('sunshine,soil_temp\n1,2\n', 'csv', 'csv')
+
+
+class SugarGridTests(SimpleTestCase):
+    # Coarse axes spanning the model's split thresholds, so cells contain real steps
+    AXES = {'sunshine': (6.5, 7.5, 0.25), 'soil_temp': (28.5, 30.5, 0.5), 'temp_max': (25.0, 35.0, 2.5)}
+
+    def setUp(self):
+        if not os.path.exists(MODEL_PATHS['sugar_production']):
+            self.skipTest("sugar production model not found")
+        self.model = registry.get('sugar_production')
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'grid.npy')
+        self.metadata = sugar_grid.build_grid(self.model, path, 'test', self.AXES)
+        self.grid = sugar_grid.load_grid(path)
+
+    def test_grid_points_match_model(self):
+        X = np.array(np.meshgrid(*self.grid.axes, indexing='ij')).reshape(3, -1).T
+        predictions, served = self.grid.lookup(X)
+        self.assertTrue(served.all())
+        np.testing.assert_array_equal(predictions, self.model.predict(X))
+
+    def test_interpolation_within_recorded_bound(self):
+        self.assertEqual(self.metadata['max_error_method'], 'exact')
+        rng = np.random.default_rng(0)
+        X = np.column_stack([rng.uniform(axis[0], axis[-1], 20000) for axis in self.grid.axes])
+        predictions, served = self.grid.lookup(X)
+        self.assertTrue(served.all())
+        error = np.abs(predictions - self.model.predict(X)).max()
+        self.assertGreater(error, 0)
+        self.assertLessEqual(error, self.metadata['max_error'] + 1e-9)
+
+    def test_outside_grid_not_served(self):
+        X = np.array([[6.0, 29.0, 30.0], [7.0, 29.0, 40.0], [np.nan, 29.0, 30.0], [7.0, 29.0, 30.0]])
+        predictions, served = self.grid.lookup(X)
+        self.assertEqual(served.tolist(), [False, False, False, True])
+        self.assertTrue(np.isnan(predictions[:3]).all())
+
+
+class MultiDetectionTests(SimpleTestCase):
+    def test_selects_confident_detections_best_first(self):
+        confidences = np.array([0.6, 0.2, 0.9, 0.7], dtype=np.float32)
+        self.assertEqual(pipeline.select_detections(confidences).tolist(), [2])
+        config = {'ENABLED': True, 'MIN_CONFIDENCE': 0.5, 'MAX_DETECTIONS': 2}
+        with mock.patch.dict(pipeline.MULTI_DETECTION_CONFIG, config):
+            self.assertEqual(pipeline.select_detections(confidences).tolist(), [2, 3])
+            # Nothing above the threshold: the best detection is still used
+            self.assertEqual(pipeline.select_detections(np.array([0.1, 0.3])).tolist(), [1])
+
+    def test_confidence_weighted_aggregation_per_group(self):
+        probabilities = np.array([[1.0, 0.0], [0.0, 1.0], [0.2, 0.8]])
+        aggregated = pipeline.aggregate_probabilities(probabilities, [[0.75, 0.25], [0.5]])
+        np.testing.assert_allclose(aggregated, [[0.75, 0.25], [0.2, 0.8]])
+
+
+class PredictionCacheTests(SimpleTestCase):
+    def uploads(self, bud=b'bud', stem=b'stem'):
+        return SimpleUploadedFile('bud.jpg', bud), SimpleUploadedFile('stem.jpg', stem)
+
+    def test_lru_eviction_and_ttl_expiry(self):
+        lru = cache.LocMemPredictionCache(max_entries=2, ttl=60)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        self.assertEqual(lru.get('a'), 1)  # 'b' is now the least recently used
+        lru.set('c', 3)
+        self.assertEqual((lru.get('a'), lru.get('b'), lru.get('c')), (1, None, 3))
+        expired = cache.LocMemPredictionCache(max_entries=2, ttl=-1)
+        expired.set('a', 1)
+        self.assertIsNone(expired.get('a'))
+
+    def test_key_covers_uploads_model_fingerprint_and_variant(self):
+        key = cache.variety_cache_key(*self.uploads())
+        self.assertEqual(cache.variety_cache_key(*self.uploads()), key)
+        self.assertNotEqual(cache.variety_cache_key(*self.uploads(stem=b'other')), key)
+        self.assertNotEqual(cache.variety_cache_key(*self.uploads(), variant='lean'), key)
+        with mock.patch.object(cache.registry, 'fingerprint', return_value='retrained'):
+            self.assertNotEqual(cache.variety_cache_key(*self.uploads()), key)
+        with cache.bypass_prediction_cache():
+            self.assertIsNone(cache.variety_cache_key(*self.uploads()))
+            # Other contexts, e.g. concurrent requests, still use the cache
+            keys = []
+            other = threading.Thread(target=lambda: keys.append(cache.variety_cache_key(*self.uploads())))
+            other.start()
+            other.join()
+            self.assertEqual(keys, [key])
+
+    def test_hit_answers_without_running_the_pipeline(self):
+        store = cache.LocMemPredictionCache(max_entries=8, ttl=60)
+        key = cache.variety_cache_key(*self.uploads(), variant=views.cache_variant('full'))
+        store.set(key, {'response': {'variety': 'SL 96 128', 'confidence': 90.0}})
+        bud, stem = self.uploads()
+        with mock.patch.object(views, 'prediction_cache', store), \
+                mock.patch.object(views, 'classify_organs', side_effect=AssertionError("pipeline ran")):
+            response = self.client.post('/api/predict/', {'bud_image': bud, 'stem_image': stem})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'variety': 'SL 96 128', 'confidence': 90.0, 'cache': 'hit'})
+
+    def test_django_backend_clears_only_its_own_entries(self):
+        from django.core.cache import caches
+        shared = cache.DjangoPredictionCache('default', ttl=60)
+        caches['default'].set('session:1', 'kept')
+        shared.set('a', 1)
+        self.assertEqual(shared.get('a'), 1)
+        shared.clear()
+        self.assertIsNone(shared.get('a'))
+        self.assertEqual(caches['default'].get('session:1'), 'kept')
+
+
+class BatchPredictionTests(SimpleTestCase):
+    def upload(self, name, value):
+        image = np.full((64, 64, 3), value, dtype=np.uint8)
+        return SimpleUploadedFile(name, cv2.imencode('.png', image)[1].tobytes(), content_type='image/png')
+
+    def post(self, bud_values, stem_values):
+        # Stubbed detectors find an organ in any image that is not all black
+        def detect_and_crop_all_batch(detector, images, label):
+            return [([image], [[0, 0, 64, 64]], [0.9]) if image.any() else ([], [], []) for image in images]
+
+        def classify_detections(classify, crop_groups, confidence_groups, record=None):
+            return np.tile([0.1, 0.7, 0.1, 0.1], (len(crop_groups), 1))
+
+        data = {
+            'bud_image': [self.upload(f'bud{i}.png', value) for i, value in enumerate(bud_values)],
+            'stem_image': [self.upload(f'stem{i}.png', value) for i, value in enumerate(stem_values)],
+        }
+        with mock.patch.object(views.registry, 'get', side_effect=lambda name: name), \
+                mock.patch.object(views, 'detect_and_crop_all_batch', side_effect=detect_and_crop_all_batch) as detect, \
+                mock.patch.object(views, 'classify_detections', side_effect=classify_detections), \
+                mock.patch.object(pipeline, 'save_crops'):
+            response = self.client.post('/api/predict-batch/', data)
+        return response, detect
+
+    def test_failed_pair_does_not_fail_the_batch(self):
+        response, detect = self.post([90, 0, 90], [90, 90, 90])
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual(results[1], {'error': 'No bud detected in the image'})
+        for result in (results[0], results[2]):
+            self.assertEqual(result['variety'], pipeline.VARIETY_NAMES[2])
+            self.assertAlmostEqual(result['confidence'], 70.0)
+        # One detector call per organ; the pair without a bud never reaches the stem detector
+        self.assertEqual([(call.args[0], len(call.args[1])) for call in detect.call_args_list],
+                         [('bud_detector', 3), ('stem_detector', 2)])
+
+    def test_rejects_mismatched_counts_and_too_many_pairs(self):
+        response, detect = self.post([90, 90], [90])
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('must match', response.json()['error'])
+        with mock.patch.object(views, 'MAX_BATCH_PAIRS', 2):
+            response, detect = self.post([90] * 3, [90] * 3)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('At most 2 image pairs', response.json()['error'])
+        detect.assert_not_called()
+
+
+class InferencePoolTests(SimpleTestCase):
+    async def test_saturated_pool_answers_503_with_retry_after(self):
+        pool = InferencePool('thread', workers=1, max_pending=2, retry_after=7)
+        body = json.dumps({'sunshine': 6.0, 'soil_temp': 25.0, 'temp_max': 32.0})
+        with mock.patch('ml_integration.forecast_views.inference_pool', pool), pool.admit(), pool.admit():
+            response = await self.async_client.post(
+                '/api/async/predict-sugar-production/', body, content_type='application/json')
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response['Retry-After'], '7')
+            self.assertEqual(pool.pending, 2)
+        self.assertEqual(pool.pending, 0)
+
+
+class DetectionBatchingTests(SimpleTestCase):
+    class FakeDetector:
+        """
+        Returns one box per image, its x1 the image's fill value.
+        """
+
+        def __init__(self, error=None):
+            self.calls = []
+            self.error = error
+
+        def detect(self, images):
+            self.calls.append(len(images))
+            if self.error is not None:
+                raise self.error
+            return [(np.array([[image[0, 0, 0], 0, 1, 1]], dtype=np.float32), np.array([0.9], dtype=np.float32))
+                    for image in images]
+
+    def submit_all(self, detector, count):
+        batcher = batching.DetectionBatcher('bud_detector', max_batch=8, window_ms=200)
+        images = [np.full((4, 4, 3), value, dtype=np.uint8) for value in range(count)]
+        with mock.patch.object(batching.registry, 'get', return_value=detector):
+            futures = [batcher.submit(image) for image in images]
+            for future in futures:
+                future.exception(timeout=5)
+        return batcher, futures
+
+    def test_concurrent_requests_share_one_call_and_get_their_own_result(self):
+        detector = self.FakeDetector()
+        batcher, futures = self.submit_all(detector, 3)
+        self.assertEqual(detector.calls, [3])
+        self.assertEqual([future.result()[0][0, 0] for future in futures], [0, 1, 2])
+        self.assertEqual(batcher.stats()['batch_sizes'], {'3': 1})
+
+    def test_missing_outputs_fail_their_waiters(self):
+        detector = self.FakeDetector()
+        detect = detector.detect
+        detector.detect = lambda images: detect(images)[:2]  # A backend with a fixed batch of two
+        _, futures = self.submit_all(detector, 3)
+        self.assertEqual([future.result()[0][0, 0] for future in futures[:2]], [0, 1])
+        self.assertIsInstance(futures[2].exception(), RuntimeError)
+
+    def test_detector_error_reaches_every_waiter(self):
+        error = RuntimeError("detector failed")
+        _, futures = self.submit_all(self.FakeDetector(error), 3)
+        self.assertEqual([future.exception() for future in futures], [error] * 3)
+
+
+class DetectorBackendTests(SimpleTestCase):
+    image = np.random.default_rng(0).integers(0, 256, size=(100, 300, 3), dtype=np.uint8)
+
+    def test_letterbox_pads_to_square_or_stride_multiple(self):
+        padded, gain, pad = detectors.letterbox(self.image, 64)
+        self.assertEqual((padded.shape, pad), ((64, 64, 3), (0, 21)))
+        self.assertAlmostEqual(gain, 64 / 300)
+        self.assertTrue((padded[:21] == 114).all() and (padded[-22:] == 114).all())
+        padded, _, pad = detectors.letterbox(self.image, 64, auto=True, stride=32)
+        self.assertEqual((padded.shape, pad), ((32, 64, 3), (0, 5)))
+
+    def test_preprocess_uses_rectangles_only_for_same_sized_batches(self):
+        batch, transforms = detectors.preprocess([self.image, self.image], 64, auto=True)
+        self.assertEqual(batch.shape, (2, 3, 32, 64))
+        self.assertLessEqual(batch.max(), 1.0)
+        batch, _ = detectors.preprocess([self.image, self.image[:50]], 64, auto=True)
+        self.assertEqual(batch.shape, (2, 3, 64, 64))
+
+    def test_nms_keeps_best_of_overlapping_boxes(self):
+        boxes = np.array([[0, 0, 10, 10], [1, 1, 10, 10], [20, 20, 30, 30], [0, 0, 10, 7]], dtype=np.float32)
+        scores = np.array([0.5, 0.9, 0.7, 0.6], dtype=np.float32)
+        self.assertEqual(detectors.nms(boxes, scores, 0.7).tolist(), [1, 2, 3])
+        self.assertEqual(detectors.nms(boxes, scores, 0.5).tolist(), [1, 2])
+
+    def test_postprocess_thresholds_and_maps_back_per_class(self):
+        # (4 + 2 classes, anchors): cx, cy, w, h, then class scores
+        prediction = np.array([
+            [32, 32, 32, 10],
+            [26, 26, 26, 30],
+            [20, 20, 20, 4],
+            [10, 10, 10, 4],
+            [0.9, 0.1, 0.8, 0.1],
+            [0.1, 0.8, 0.1, 0.2],
+        ], dtype=np.float32)
+        transform = (0.5, (0, 5), (100, 200))  # gain, (pad_x, pad_y), original (height, width)
+        boxes, scores = detectors.postprocess(prediction, transform, conf_threshold=0.25, iou_threshold=0.7)
+        np.testing.assert_allclose(scores, [0.9, 0.8])  # The overlapping class-0 box is suppressed, class 1 is kept
+        np.testing.assert_allclose(boxes, [[44, 32, 84, 52], [44, 32, 84, 52]])
+
+    def test_letterbox_matches_ultralytics(self):
+        try:
+            from ultralytics.data.augment import LetterBox
+        except ImportError:
+            self.skipTest("ultralytics not installed")
+        for auto in (False, True):
+            expected = LetterBox((640, 640), auto=auto, stride=32)(image=self.image)
+            np.testing.assert_array_equal(detectors.letterbox(self.image, 640, auto=auto, stride=32)[0], expected)
+
+
+class ModelRegistryTests(SimpleTestCase):
+    def test_failed_auto_reload_keeps_serving_the_loaded_model(self):
+        weights = tempfile.NamedTemporaryFile(suffix='.pkl')
+        self.addCleanup(weights.close)
+        loads = []
+
+        def loader(path):
+            loads.append(path)
+            if len(loads) > 1:
+                raise EOFError("Ran out of input")
+            return 'first'
+
+        models = ModelRegistry()
+        models.register('sugar_production', weights.name, loader)
+        self.assertEqual(models.get('sugar_production'), 'first')
+        mtime = os.path.getmtime(weights.name) + 10
+        os.utime(weights.name, (mtime, mtime))  # A new, broken file
+        with mock.patch('ml_integration.registry.AUTO_RELOAD', True), \
+                mock.patch('ml_integration.registry.RELOAD_CHECK_INTERVAL', 0), \
+                self.assertLogs('ml_integration.registry', 'ERROR'):
+            self.assertEqual(models.get('sugar_production'), 'first')
+            self.assertEqual(models.get('sugar_production'), 'first')  # Not retried until the file changes again
+        self.assertEqual(len(loads), 2)
+        with self.assertRaises(EOFError):
+            models.reload('sugar_production')
+
+
+class DetectAndCropTests(SimpleTestCase):
+    def registry(self, loader):
+        weights = tempfile.NamedTemporaryFile(suffix='.pt')
+        self.addCleanup(weights.close)
+        models = ModelRegistry()
+        models.register('bud_detector', weights.name, loader)
+        return models
+
+    def test_model_load_errors_are_raised(self):
+        def loader(path):
+            raise ModuleNotFoundError("No module named 'ultralytics'")
+
+        with use_registry(self.registry(loader)), self.assertRaises(ModuleNotFoundError):
+            pipeline.detect_and_crop('bud_detector', np.zeros((32, 32, 3), dtype=np.uint8), 'bud')
+
+    def test_detection_errors_read_as_nothing_detected(self):
+        detector = mock.Mock()
+        detector.detect.side_effect = ValueError("bad output")
+        with use_registry(self.registry(lambda path: detector)), self.assertLogs(pipeline.logger, 'ERROR'):
+            self.assertEqual(pipeline.detect_and_crop_all('bud_detector', np.zeros((32, 32, 3), dtype=np.uint8), 'bud'), ([], [], []))
+
+
+class UploadDecodingTests(SimpleTestCase):
+    image = np.random.default_rng(0).integers(0, 256, size=(48, 64, 3), dtype=np.uint8)
+
+    def test_decodes_in_memory_uploads_without_writing_files(self):
+        upload = SimpleUploadedFile('bud.png', cv2.imencode('.png', self.image)[1].tobytes())
+        self.assertIsInstance(uploads.upload_buffer(upload), memoryview)
+        with mock.patch.object(uploads.default_storage, 'save', side_effect=AssertionError("upload written")), \
+                mock.patch.object(uploads.cv2, 'imread', side_effect=AssertionError("decoded from a file")):
+            np.testing.assert_array_equal(uploads.decode_upload(upload), self.image)
+            self.assertIsNone(uploads.archive_upload(upload))
+
+    def test_undecodable_upload_answers_400(self):
+        bud = SimpleUploadedFile('bud.jpg', b'not an image')
+        stem = SimpleUploadedFile('stem.png', cv2.imencode('.png', self.image)[1].tobytes())
+        with mock.patch.object(views, 'classify_organs', side_effect=AssertionError("pipeline ran")):
+            response = self.client.post('/api/predict/', {'bud_image': bud, 'stem_image': stem})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': 'Bud image could not be decoded'})
+
+
+class UploadSizeLimitTests(SimpleTestCase):
+    def test_oversized_upload_answers_413_without_resetting_the_connection(self):
+        handler = uploads.MaxUploadSizeHandler(mock.Mock(), max_bytes=10)
+        with self.assertRaises(uploads.StopUpload) as stopped:
+            handler.receive_data_chunk(b'x' * 11, 0)
+        self.assertFalse(stopped.exception.connection_reset)
+
+        # Under the Content-Length bound for two files, so the limit is hit while the body streams in
+        bud = SimpleUploadedFile('bud.jpg', b'x' * 150000)
+        stem = SimpleUploadedFile('stem.jpg', b'x' * 10)
+        with mock.patch.object(uploads, 'MAX_UPLOAD_BYTES', 100000), \
+                mock.patch.object(views, 'classify_organs', side_effect=AssertionError("pipeline ran")):
+            response = self.client.post('/api/predict/', {'bud_image': bud, 'stem_image': stem})
+        self.assertEqual(response.status_code, 413)
+        self.assertIn('at most', response.json()['error'])
+
+    async def test_async_views_parse_uploads_off_the_event_loop(self):
+        threads = []
+        receive_data_chunk = uploads.MaxUploadSizeHandler.receive_data_chunk
+
+        def record_thread(handler, raw_data, start):
+            threads.append(threading.get_ident())
+            return receive_data_chunk(handler, raw_data, start)
+
+        bud = SimpleUploadedFile('bud.jpg', b'x' * 150000)
+        stem = SimpleUploadedFile('stem.jpg', b'x' * 10)
+        with mock.patch.object(uploads, 'MAX_UPLOAD_BYTES', 100000), \
+                mock.patch.object(uploads.MaxUploadSizeHandler, 'receive_data_chunk', record_thread):
+            response = await self.async_client.post('/api/async/predict/', {'bud_image': bud, 'stem_image': stem})
+        self.assertEqual(response.status_code, 413)
+        self.assertTrue(threads)
+        self.assertNotIn(threading.get_ident(), threads)
+
+
+class UploadPreprocessingTests(SimpleTestCase):
+    def encode(self, image, extension='.jpg'):
+        return cv2.imencode(extension, image)[1].tobytes()
+
+    def test_reads_size_from_header(self):
+        image = np.zeros((30, 70, 3), dtype=np.uint8)
+        self.assertEqual(uploads.image_size(self.encode(image)), (70, 30))
+        self.assertEqual(uploads.image_size(self.encode(image, '.png')), (70, 30))
+        self.assertIsNone(uploads.image_size(b'not an image'))
+
+    def test_reduced_decode_and_detection_copy(self):
+        image = np.random.default_rng(0).integers(0, 256, size=(2000, 4000, 3), dtype=np.uint8)
+        prepared = uploads.prepare_image_buffer(self.encode(image))
+        self.assertEqual(prepared.image.shape, (500, 1000, 3))  # 1/4 scale: 1/8 would be under CROP_SIZE
+        self.assertEqual(prepared.detect_image.shape, (320, 640, 3))
+        boxes = pipeline.scale_boxes(np.array([[10, 20, 30, 40]], dtype=np.float32), prepared.image, prepared.detect_image)
+        np.testing.assert_allclose(boxes, [[15.625, 31.25, 46.875, 62.5]])
+
+    def test_rejects_blank_tiny_and_undecodable_images(self):
+        with self.assertRaisesMessage(uploads.UploadRejected, 'Bud image is blank'):
+            uploads.prepare_image_buffer(self.encode(np.full((200, 200, 3), 90, dtype=np.uint8)), 'Bud image')
+        with self.assertRaisesMessage(uploads.UploadRejected, 'too small'):
+            uploads.prepare_image_buffer(self.encode(np.zeros((20, 200, 3), dtype=np.uint8)))
+        self.assertIsNone(uploads.prepare_image_buffer(b'\xff\xd8 truncated'))
+
+
+class CropStoreTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        config = {**crops.CROPS_CONFIG, 'DIR': directory.name, 'FORMAT': 'jpeg', 'MAX_SIZE': 64}
+        patcher = mock.patch.dict(crops.CROPS_CONFIG, config)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_identical_crops_stored_once_as_thumbnails(self):
+        crop = np.random.default_rng(0).integers(0, 256, size=(200, 100, 3), dtype=np.uint8)
+        identifier = crops.store_crop(crop)
+        path, content_type = crops.find_crop(identifier)
+        os.utime(path, (time.time() - 3600, time.time() - 3600))
+        mtime = os.stat(path).st_mtime_ns
+        with mock.patch.object(crops.cv2, 'imencode', side_effect=AssertionError("encoded again")):
+            self.assertEqual(crops.store_crop(crop[:, :].copy()), identifier)
+        self.assertGreater(os.stat(path).st_mtime_ns, mtime)  # Referenced again: retention starts over
+        self.assertEqual(content_type, 'image/jpeg')
+        self.assertEqual(cv2.imread(path).shape, (64, 32, 3))
+        self.assertNotEqual(crops.store_crop(crop[:, ::-1]), identifier)
+
+    def test_unknown_or_malformed_ids_not_found(self):
+        self.assertIsNone(crops.find_crop('0' * 40))
+        self.assertIsNone(crops.find_crop('../' + '0' * 37))
+
+    def test_purge_removes_expired_then_oldest_crops(self):
+        rng = np.random.default_rng(0)
+        identifiers = [crops.store_crop(rng.integers(0, 256, size=(64, 64, 3), dtype=np.uint8)) for _ in range(4)]
+        paths = [crops.find_crop(identifier)[0] for identifier in identifiers]
+        now = time.time()
+        for age, path in zip((30, 20, 10, 0), paths):
+            os.utime(path, (now - age * 3600, now - age * 3600))
+        self.assertEqual(crops.purge_crops(retention=25 * 3600)[0], 1)
+        self.assertEqual(crops.purge_crops(max_bytes=os.path.getsize(paths[3]))[0], 2)
+        self.assertEqual([crops.find_crop(identifier) is not None for identifier in identifiers], [False, False, False, True])
+        self.assertEqual(crops.purge_crops(retention=25 * 3600, max_bytes=None), (0, 0))
+
+    def test_purge_keeps_old_crops_referenced_again(self):
+        rng = np.random.default_rng(0)
+        old, recent = (rng.integers(0, 256, size=(64, 64, 3), dtype=np.uint8) for _ in range(2))
+        identifiers = [crops.store_crop(old), crops.store_crop(recent)]
+        now = time.time()
+        for age, identifier in zip((30, 10), identifiers):
+            os.utime(crops.find_crop(identifier)[0], (now - age * 3600, now - age * 3600))
+        crops.store_crop(old)  # A new response referencing the crop first written 30 hours ago
+        self.assertEqual(crops.purge_crops(retention=25 * 3600)[0], 0)
+        self.assertEqual(crops.purge_crops(max_bytes=os.path.getsize(crops.find_crop(identifiers[0])[0]))[0], 1)
+        self.assertEqual([crops.find_crop(identifier) is not None for identifier in identifiers], [True, False])
+
+
+class FeatureStoreTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store = feature_store.FeatureStore(directory.name, chunk_rows=3, flush_interval=3600)
+
+    def test_rescore_uses_latest_recording_weighted_by_confidence(self):
+        class FirstFeature:
+            def predict_proba(self, X):
+                return np.column_stack((X[:, 0], 1 - X[:, 0]))
+
+        a, b = feature_store.image_key(b'a'), feature_store.image_key(b'b')
+        # An image recorded twice is scored from its latest recording only
+        self.store.record('bud', [[0.0]], [a], [b], [[[0, 0, 1, 1]]], [[1.0]])
+        self.store.record('bud', [[1.0], [0.0]], [a], [b], [[[0, 0, 1, 1], [1, 1, 2, 2]]], [[0.75, 0.25]])
+        self.store.record('bud', [[0.5]], [b], [a], [[[0, 0, 1, 1]]], [[0.9]])
+        self.store.flush()
+        self.assertEqual([len(index) for index, _ in self.store.iter_chunks('bud')], [3, 1])
+
+        images, pairs, probabilities = feature_store.rescore(self.store, 'bud', FirstFeature(), chunk_rows=1)
+        a_hex, b_hex = feature_store.key_hex([a, b])
+        self.assertEqual(dict(zip(feature_store.key_hex(images), feature_store.key_hex(pairs))), {a_hex: b_hex, b_hex: a_hex})
+        scores = dict(zip(feature_store.key_hex(images), probabilities.tolist()))
+        np.testing.assert_allclose(scores[a_hex], [0.75, 0.25])
+        np.testing.assert_allclose(scores[b_hex], [0.5, 0.5])
+
+    def test_rows_written_after_flush_interval_without_further_records(self):
+        store = feature_store.FeatureStore(self.store.directory, chunk_rows=100, flush_interval=0.05)
+        store.record('stem', [[1.0, 2.0]], [feature_store.image_key(b'a')], [feature_store.image_key(b'b')],
+                     [[[0, 0, 1, 1]]], [[0.8]])
+        deadline = time.monotonic() + 5
+        while not store.chunk_names('stem') and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(store.index('stem')), 1)
+
+
+class OfflineClassificationTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+
+    def touch(self, relative_path, data=b''):
+        path = os.path.join(self.root, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_directories_paired_by_relative_path(self):
+        bud = self.touch('buds/plot1/12.jpg')
+        stem = self.touch('stems/plot1/12.PNG')
+        self.touch('buds/plot1/13.jpg')
+        self.touch('stems/notes.txt')
+        pairs, unmatched = offline.pairs_from_dirs(os.path.join(self.root, 'buds'), os.path.join(self.root, 'stems'))
+        self.assertEqual(pairs, [('plot1/12', bud, stem)])
+        self.assertEqual(unmatched, ['plot1/13'])
+
+    def test_resume_skips_written_ids_and_drops_partial_line(self):
+        output = os.path.join(self.root, 'out.csv')
+        writer = offline.ResultWriter(output, 'csv')
+        writer.write([dict.fromkeys(offline.RESULT_FIELDS, None) | {'id': 'a', 'variety': 'SL 96 128', 'confidence': 70.0}])
+        writer.close()
+        with open(output, 'a') as f:
+            f.write('b,/buds/b.jpg')
+        self.assertEqual(offline.completed_ids(output, 'csv'), {'a'})
+        with open(output) as f:
+            self.assertTrue(f.read().endswith('70.0,\n'))
+
+
+class ModelServerTests(SimpleTestCase):
+    def test_remote_models_answer_like_local_ones(self):
+        class ShapeDetector:
+            def detect(self, images):
+                return [(np.array([[0, 0, image.shape[1], image.shape[0]]], dtype=np.float32), np.array([image.mean()]))
+                        for image in images]
+
+        class Doubler:
+            def predict_proba(self, X):
+                return X * 2
+
+        server_registry = ModelRegistry()
+        server_registry.register('bud_detector', __file__, lambda path: ShapeDetector())
+        server_registry.register('bud_classifier', __file__, lambda path: Doubler())
+        socket_path = os.path.join(tempfile.mkdtemp(), 'models.sock')
+        server = model_server.ModelServer(server_registry, ['bud_detector', 'bud_classifier'])
+        # Client and server share this process, and with it the shared memory tracker
+        with mock.patch.object(model_server.resource_tracker, 'unregister'), \
+                mock.patch.dict(model_server.MODEL_SERVER_CONFIG, {'SOCKET': socket_path}):
+            threading.Thread(target=server.serve_forever, args=(socket_path,), daemon=True).start()
+            for _ in range(100):
+                if os.path.exists(socket_path):
+                    break
+                time.sleep(0.01)
+
+            image = np.full((40, 30, 3), 7, dtype=np.uint8)
+            detections = model_server.RemoteModel('bud_detector').detect([image, image[:10]])
+            self.assertEqual([boxes.tolist() for boxes, _ in detections], [[[0, 0, 30, 40]], [[0, 0, 30, 10]]])
+            self.assertEqual([confidences[0] for _, confidences in detections], [7.0, 7.0])
+            np.testing.assert_array_equal(model_server.RemoteModel('bud_classifier').predict_proba(np.eye(2)), np.eye(2) * 2)
+            with self.assertRaisesMessage(model_server.ModelServerError, "Unknown model call"):
+                model_server.RemoteModel('stem_classifier').predict_proba(np.eye(2))
+
+
+class FusionTests(SimpleTestCase):
+    bud = np.array([[0.7, 0.1, 0.1, 0.1], [0.2, 0.3, 0.4, 0.1]])
+    stem = np.array([[0.1, 0.6, 0.2, 0.1], [0.25, 0.25, 0.25, 0.25]])
+
+    def engine(self, **overrides):
+        return fusion.FusionEngine.from_config(fusion._merge(fusion.DEFAULT_FUSION_CONFIG, overrides), MODEL_PATHS)
+
+    def test_defaults_match_original_average(self):
+        engine = self.engine()
+        self.assertEqual(engine.signature, '')
+        np.testing.assert_array_equal(engine.fuse(self.bud, self.stem), (0.5 * self.bud + 0.5 * self.stem) / (0.5 + 0.5))
+        np.testing.assert_array_equal(engine.fuse(self.bud[0], None), self.bud[0])
+
+    def test_strategies_calibration_and_version_overrides(self):
+        version = f"{os.path.basename(MODEL_PATHS['bud_classifier'])}:{os.path.basename(MODEL_PATHS['stem_classifier'])}"
+        engine = self.engine(VERSIONS={version: {'STRATEGY': 'max_confidence', 'TEMPERATURES': {'stem': 2.0}}})
+        self.assertEqual((engine.strategy, engine.temperatures), ('max_confidence', {'bud': 1.0, 'stem': 2.0}))
+        self.assertNotEqual(engine.signature, '')
+        fused = engine.fuse(self.bud, self.stem)
+        np.testing.assert_array_equal(fused[0], self.bud[0])  # Softened stem is less confident than the bud
+        np.testing.assert_allclose(fused.sum(axis=1), 1.0)
+        pooled = self.engine(STRATEGY='geometric_mean').fuse(self.bud[1], self.stem[1])
+        np.testing.assert_allclose(pooled, self.bud[1] ** 0.5 / (self.bud[1] ** 0.5).sum())
+
+    def test_early_exit_skips_second_organ_when_first_is_decisive(self):
+        engine = self.engine(EARLY_EXIT={'ENABLED': True, 'FIRST': 'stem', 'THRESHOLD': 0.6})
+        calls = []
+
+        def detect_and_classify(organ, image, record_keys=None):
+            calls.append(organ)
+            return [image], [[0, 0, 1, 1]], [0.9], image
+
+        with mock.patch.object(pipeline, 'fusion_engine', engine), \
+                mock.patch.object(pipeline, 'detect_and_classify', detect_and_classify):
+            results, missing = pipeline.classify_organs({'bud': self.bud[0], 'stem': self.stem[0]})
+            self.assertEqual((calls, list(results), missing), (['stem'], ['stem'], None))
+            response = pipeline.fusion_response(None, self.stem[0])
+            self.assertEqual((response['path'], response['organs']), ('early_exit', ['stem']))
+
+            calls.clear()
+            results, missing = pipeline.classify_organs({'bud': self.bud[1], 'stem': self.stem[1]})
+            self.assertEqual((calls, missing), (['stem', 'bud'], None))
+            self.assertEqual(pipeline.fusion_response(self.bud[1], self.stem[1])['path'], 'full')
+
+
+class SweepSamplingTests(SimpleTestCase):
+    def frame(self, seed):
+        return np.random.default_rng(seed).integers(0, 256, size=(48, 64, 3), dtype=np.uint8)
+
+    def test_near_duplicates_skipped(self):
+        sampler = sweeps.FrameSampler(max_frames=8, min_distance=6, max_side=1280)
+        first = self.frame(0)
+        self.assertTrue(sampler.offer(0, first))
+        self.assertFalse(sampler.offer(1, np.clip(first.astype(int) + 1, 0, 255).astype(np.uint8)))
+        self.assertTrue(sampler.offer(2, self.frame(1)))
+        self.assertEqual(sampler.summary(3), {'read': 3, 'candidates': 3, 'duplicates': 1, 'sampled': 2})
+
+    def test_budget_keeps_frames_spread_over_the_stream(self):
+        sampler = sweeps.FrameSampler(max_frames=4, min_distance=0, max_side=32)
+        for index in range(40):
+            if sampler.wants(index):
+                sampler.offer(index, self.frame(index))
+        indices = [index for index, _, _ in sampler.kept]
+        self.assertLessEqual(len(indices), 4)
+        self.assertGreaterEqual(indices[-1], 20)
+        self.assertEqual(max(sampler.frames[0].shape[:2]), 32)
+
+    def test_video_read_within_frame_budget(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'sweep.avi')
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 10, (64, 48))
+        if not writer.isOpened():
+            self.skipTest("No MJPG video encoder available")
+        for index in range(30):
+            writer.write(self.frame(index // 2))  # Every frame shown twice
+        writer.release()
+
+        config = {**sweeps.SWEEP_CONFIG, 'MAX_FRAMES': 32, 'CANDIDATES': 30, 'MIN_HASH_DISTANCE': 6}
+        with open(path, 'rb') as f:
+            frames, summary = sweeps.sample_video(SimpleUploadedFile('sweep.avi', f.read()), config)
+        self.assertEqual(summary['read'], 30)
+        self.assertEqual(summary['sampled'], len(frames))
+        self.assertLessEqual(len(frames), 15)
+        self.assertGreater(summary['duplicates'], 0)
+
+
+class StartupProfileTests(SimpleTestCase):
+    def test_forecast_profile_skips_vision_stack(self):
+        run = startup.measure_profile('forecast', repeat=1, cwd=settings.BASE_DIR)
+        self.assertEqual(run['profile'], 'forecast')
+        self.assertFalse({'cv2', 'skimage', 'torch', 'ultralytics'} & set(run['heavy_modules']))
+        self.assertGreater(run['rss_mb'], 0)
+
+
+class TiledDetectionTests(SimpleTestCase):
+    config = {**tiling.DEFAULT_TILED_DETECTION_CONFIG, 'ENABLED': True, 'MIN_SIDE': 1000, 'TILE_SIZE': 400}
+
+    class TileDetector:
+        """
+        Returns the bounding box of the painted pixels of each tile.
+        """
+
+        def __init__(self):
+            self.calls = []
+
+        def detect(self, tiles):
+            self.calls.append(len(tiles))
+            results = []
+            for tile in tiles:
+                ys, xs = np.nonzero(tile[:, :, 0])
+                if len(xs) == 0:
+                    results.append(tiling.empty_detections())
+                    continue
+                box = np.array([[xs.min(), ys.min(), xs.max() + 1, ys.max() + 1]], dtype=np.float32)
+                results.append((box, np.array([0.8], dtype=np.float32)))
+            return results
+
+    OBJECT = [900, 500, 1100, 540]
+
+    def image(self, box=OBJECT):
+        image = np.zeros((1200, 2000, 3), dtype=np.uint8)
+        x1, y1, x2, y2 = box
+        image[y1:y2, x1:x2] = 255
+        return image
+
+    def test_grid_covers_image_with_overlap(self):
+        self.assertEqual(tiling.tile_starts(1000, 400, 0.25), [0, 300, 600])
+        self.assertEqual(tiling.tile_starts(300, 400, 0.25), [0])
+        grid = tiling.tile_grid(1200, 2000, self.config)
+        self.assertEqual(len(grid), 7 * 4)
+        self.assertEqual(max(x2 for _, _, x2, _ in grid), 2000)
+
+    def test_fragments_cut_by_tile_borders_are_merged(self):
+        boxes = np.array([[900, 500, 1000, 540], [920, 500, 1100, 540], [0, 0, 50, 50]], dtype=np.float32)
+        merged, confidences = tiling.merge_tile_detections(boxes, np.array([0.6, 0.9, 0.5], dtype=np.float32), 0.5)
+        np.testing.assert_array_equal(merged, [[900, 500, 1100, 540], [0, 0, 50, 50]])
+        np.testing.assert_allclose(confidences, [0.9, 0.5])
+
+    def test_only_tiles_around_coarse_detections_run_in_one_batch(self):
+        detector = self.TileDetector()
+        coarse = (np.array([[880, 480, 1120, 560]], dtype=np.float32), np.array([0.4], dtype=np.float32))
+        (boxes, confidences), = tiling.refine_detections(detector, [self.image()], [coarse], 'stem', self.config)
+        self.assertEqual(len(detector.calls), 1)
+        self.assertLess(detector.calls[0], len(tiling.tile_grid(1200, 2000, self.config)))
+        np.testing.assert_array_equal(boxes, [self.OBJECT])
+        np.testing.assert_allclose(confidences, [0.8])
+
+    def test_long_object_fits_tile_budget_and_is_merged_whole(self):
+        detector = self.TileDetector()
+        stem = [100, 600, 1900, 630]
+        coarse = (np.array([stem], dtype=np.float32), np.array([0.4], dtype=np.float32))
+        config = {**self.config, 'MAX_TILES': 6}
+        (boxes, _), = tiling.refine_detections(detector, [self.image(stem)], [coarse], 'stem', config)
+        self.assertLessEqual(detector.calls[0], 6)
+        np.testing.assert_array_equal(boxes, [stem])
+
+    def test_small_images_and_other_organs_are_not_tiled(self):
+        detector = self.TileDetector()
+        coarse = (np.array([[10, 10, 50, 50]], dtype=np.float32), np.array([0.4], dtype=np.float32))
+        small = np.zeros((600, 800, 3), dtype=np.uint8)
+        self.assertIs(tiling.refine_detections(detector, [small], [coarse], 'stem', self.config)[0], coarse)
+        self.assertIs(tiling.refine_detections(detector, [self.image()], [coarse], 'bud', self.config)[0], coarse)
+        self.assertEqual(detector.calls, [])
+
+    def test_tiled_organs_decoded_at_full_resolution_by_upload_preprocessing(self):
+        image = np.random.default_rng(0).integers(0, 256, size=(2000, 4000, 3), dtype=np.uint8)
+        buffer = cv2.imencode('.jpg', image)[1].tobytes()
+        with mock.patch.dict(tiling.TILED_DETECTION_CONFIG, self.config):
+            stem = uploads.prepare_image_buffer(buffer, 'Stem image', 'stem')
+            bud = uploads.prepare_image_buffer(buffer, 'Bud image', 'bud')
+            self.assertEqual((stem.image.shape, stem.detect_image.shape), ((2000, 4000, 3), (320, 640, 3)))
+            self.assertEqual(bud.image.shape, (500, 1000, 3))
+            self.assertTrue(tiling.tiles_enabled('stem', stem.image))
+
+
+class ShadowInferenceTests(SimpleTestCase):
+    def test_candidate_registry_shares_models_it_does_not_replace(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'stem_v2.pkl')
+        open(path, 'wb').close()
+        primary = ModelRegistry()
+        primary.register('bud_classifier', path, lambda path: 'primary bud')
+        primary.register('stem_classifier', path, lambda path: 'primary stem')
+        candidate = shadow.CandidateRegistry(primary, {'stem_classifier': path})
+        candidate._entries['stem_classifier'].loader = lambda path: 'candidate stem'
+        with use_registry(candidate):
+            self.assertEqual(active_registry().get('stem_classifier'), 'candidate stem')
+            self.assertEqual(active_registry().get('bud_classifier'), 'primary bud')
+        self.assertIs(active_registry(), registry)
+        self.assertEqual(candidate.fusion_engine.version, 'sugarcane_rf_model.pkl:stem_v2.pkl')
+        # The fingerprint is computed again only after a candidate model is reloaded
+        fingerprint = candidate.fingerprint()
+        with mock.patch.object(ModelRegistry, 'fingerprint', autospec=True, side_effect=ModelRegistry.fingerprint) as files:
+            self.assertEqual(candidate.fingerprint(), fingerprint)
+            self.assertEqual(files.call_count, 0)
+            candidate.reload('stem_classifier')
+            candidate.fingerprint()
+            self.assertEqual(files.call_count, 1)
+
+    def test_records_summarize_agreement_delta_and_latency(self):
+        records = np.concatenate([
+            shadow.comparison_record(
+                'primary', {'primary': [0.7, 0.1, 0.1, 0.1], 'candidate': [0.6, 0.2, 0.1, 0.1]},
+                {'primary': {'stem_detector': 0.020}, 'candidate': {'stem_detector': 0.030}}),
+            shadow.comparison_record(
+                'candidate', {'primary': [0.1, 0.8, 0.05, 0.05], 'candidate': [0.1, 0.1, 0.7, 0.1]}, {}),
+            shadow.comparison_record('primary', {'primary': [0.25] * 4, 'candidate': None}, {}),
+        ])
+        summary = shadow.summarize(records)
+        self.assertEqual((summary['records'], summary['served_by_candidate'], summary['compared']), (3, 1, 2))
+        self.assertAlmostEqual(summary['agreement'], 0.5)
+        self.assertAlmostEqual(summary['confidence_delta_mean'], -0.1, places=5)
+        self.assertEqual(summary['undetected'], {'primary': 0, 'candidate': 1})
+        self.assertAlmostEqual(summary['latency']['candidate:stem_detector']['median_ms'], 30, places=3)
+        self.assertEqual(summary['latency']['primary:bud_detector']['runs'], 0)
+
+    def test_runs_are_dropped_when_the_queue_is_full(self):
+        runner = shadow.ShadowRunner(store=None, workers=1, max_queue=0, nice=0)
+        dropped = shadow.SHADOW_RUNS.value('dropped')
+        self.assertIsNone(runner.submit('primary', {}, None, None, None))
+        self.assertEqual(shadow.SHADOW_RUNS.value('dropped'), dropped + 1)
+        self.assertIsNone(runner._executor)
+
+
+class PredictionJobTests(TestCase):
+    def create_job(self, **fields):
+        return PredictionJob.objects.create(
+            bud_image=b'bud', bud_image_name='bud.jpg', stem_image=b'stem', stem_image_name='stem.jpg', **fields,
+        )
+
+    def test_undecodable_upload_fails_job(self):
+        job = self.create_job()
+        self.assertTrue(jobs.claim_job(job.id))
+        self.assertFalse(jobs.claim_job(job.id))
+        jobs.run_job(job.id)
+        job.refresh_from_db()
+        self.assertEqual(job.to_dict()['error'], 'Bud image could not be decoded')
+        self.assertEqual((job.status, job.attempts, bytes(job.bud_image)), (PredictionJob.FAILED, 1, b''))
+
+    def test_interrupted_jobs_requeued_then_failed(self):
+        dead_worker = f"{jobs.socket.gethostname()}:{jobs.os.getpid()}:0"  # This pid, an earlier process
+        retry = self.create_job(status=PredictionJob.RUNNING, worker=dead_worker, attempts=1)
+        give_up = self.create_job(status=PredictionJob.RUNNING, worker=dead_worker, attempts=jobs.JOBS_CONFIG['MAX_ATTEMPTS'])
+        own = self.create_job(status=PredictionJob.RUNNING, worker=jobs.current_worker_id(), attempts=1)
+        self.assertEqual(jobs.recover_interrupted_jobs(), 2)
+        statuses = {job.id: job.status for job in PredictionJob.objects.all()}
+        self.assertEqual(statuses[retry.id], PredictionJob.QUEUED)
+        self.assertEqual(statuses[give_up.id], PredictionJob.FAILED)
+        self.assertEqual(statuses[own.id], PredictionJob.RUNNING)
+
+    def test_result_not_stored_for_a_job_taken_over_by_another_worker(self):
+        job = self.create_job()
+        self.assertTrue(jobs.claim_job(job.id))
+        PredictionJob.objects.filter(pk=job.id).update(status=PredictionJob.QUEUED, worker='')  # Recovered elsewhere
+        self.assertIsNone(jobs.run_job(job.id))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error, bytes(job.bud_image)), (PredictionJob.QUEUED, '', b'bud'))
+
+    def test_webhooks_only_to_public_or_allowed_hosts(self):
+        for url in ('http://127.0.0.1:8000/hook', 'http://10.0.0.5/hook', 'http://169.254.169.254/latest/meta-data',
+                    'http://[::1]/hook', 'http://[::ffff:192.168.1.1]/hook', 'http:///hook'):
+            self.assertFalse(jobs.webhook_url_allowed(url), url)
+        self.assertTrue(jobs.webhook_url_allowed('https://93.184.216.34/hook'))
+        with mock.patch.dict(jobs.JOBS_CONFIG, {'WEBHOOK_ALLOWED_HOSTS': ['hooks.internal']}):
+            self.assertTrue(jobs.webhook_url_allowed('http://HOOKS.internal:9000/done'))
+            self.assertFalse(jobs.webhook_url_allowed('https://93.184.216.34/hook'))
+        image = SimpleUploadedFile('a.jpg', b'jpeg')
+        response = self.client.post('/api/jobs/', {
+            'bud_image': image, 'stem_image': image, 'webhook_url': 'http://169.254.169.254/latest/meta-data',
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(PredictionJob.objects.exists())
+
+    def test_webhook_connects_only_to_the_addresses_it_checked(self):
+        import http.server
+        hosts = []
+
+        class Hook(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                hosts.append(self.headers['Host'])
+                self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.HTTPServer(('127.0.0.1', 0), Hook)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        port = server.server_address[1]
+        job = self.create_job(webhook_url=f'http://rebind.example:{port}/hook')
+        answers = [[(2, 1, 6, '', ('93.184.216.34', port))]]  # Public for the check, then the server's loopback
+
+        def getaddrinfo(host, port, *args):
+            return answers.pop(0) if answers else [(2, 1, 6, '', ('127.0.0.1', port))]
+
+        with mock.patch.dict(jobs.JOBS_CONFIG, {'WEBHOOK_RETRIES': 1}), \
+                mock.patch.object(jobs.socket, 'getaddrinfo', getaddrinfo), self.assertLogs(jobs.logger, 'WARNING'):
+            self.assertFalse(jobs.deliver_webhook(job))
+            self.assertEqual(hosts, [])
+            # Where the address is public, the request goes to it under the original Host header
+            with mock.patch.object(jobs, '_public_address', return_value=True):
+                self.assertTrue(jobs.deliver_webhook(job))
+        self.assertEqual(hosts, [f'rebind.example:{port}'])
+
+    def test_finished_jobs_purged_after_retention(self):
+        expired = timezone.now() - timedelta(seconds=jobs.JOBS_CONFIG['RETENTION'] + 60)
+        old = self.create_job(status=PredictionJob.SUCCEEDED, finished_at=expired)
+        recent = self.create_job(status=PredictionJob.FAILED, finished_at=timezone.now())
+        queued = self.create_job()
+        self.assertEqual(jobs.purge_finished_jobs(), 1)
+        self.assertEqual(set(PredictionJob.objects.values_list('id', flat=True)), {recent.id, queued.id})
+        self.assertFalse(PredictionJob.objects.filter(pk=old.id).exists())
@@ -0,0 +1,265 @@
+"""
+Tiled detection for high-resolution images (mainly long stems).
+
+The detector sees every image downscaled to its input size, so a thin stem
+in a 4000 px photo is a few pixels wide by the time YOLO looks at it, and
+raising the input size makes every request pay for every pixel. With
+ML_TILED_DETECTION enabled, images of the configured organs whose long side
+is at least MIN_SIDE get a second look:
+
+1. The usual low-resolution detection is the coarse pass.
+2. The image is covered by a grid of TILE_SIZE x TILE_SIZE tiles
+   overlapping by OVERLAP; only tiles that intersect a coarse box (grown by
+   MARGIN) are kept. When that is more than MAX_TILES tiles, the tile size
+   doubles until it is not, so a long stem is seen at a lower (but still
+   higher than coarse) resolution rather than only in part.
+3. The kept tiles of every image in the call are cut from the full-resolution
+   image and go through the detector as one batch.
+4. Tile boxes are mapped back to image coordinates and merged across tiles:
+   greedy NMS on intersection over the smaller box, where a suppressed box
+   widens the kept one. Boxes touching an inner tile border also merge with
+   other such boxes they intersect and line up with, so the pieces of a
+   stem cut by tile borders become one box again. Coarse boxes that no tile
+   box covers are kept as they were.
+
+Cost therefore grows with the number (and size) of objects found in the
+coarse pass, not with the image's pixel count; images without coarse
+detections are not tiled at all.
+"""
+import logging
+
+import numpy as np
+from django.conf import settings
+
+from .detectors import MAX_DETECTIONS, empty_detections
+from .metrics import DETECTION_TILES
+from .timing import stage
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TILED_DETECTION_CONFIG = {
+    'ENABLED': False,
+    'ORGANS': ['stem'],        # Organs (detector labels) detected with tiles
+    'MIN_SIDE': 1600,          # Images with a shorter long side are detected in one pass
+    'TILE_SIZE': 640,          # Tile side in full-resolution pixels (the detector input size)
+    'OVERLAP': 0.25,           # Fraction of a tile shared with its neighbours
+    'MARGIN': 0.1,             # Coarse boxes grow by this fraction of their size when selecting tiles
+    'MAX_TILES': 12,           # Tiles run per image at most
+    'MERGE_IOS': 0.5,          # Intersection over the smaller box above which tile boxes are merged
+}
+
+TILED_DETECTION_CONFIG = {**DEFAULT_TILED_DETECTION_CONFIG, **getattr(settings, 'ML_TILED_DETECTION', {})}
+
+
+def tiled_organ(label, config=TILED_DETECTION_CONFIG):
+    """
+    Whether the given organ (detector label) is detected with tiles in large enough images.
+    Upload preprocessing then decodes its images at full resolution.
+    """
+    return config['ENABLED'] and label in config['ORGANS']
+
+
+def tiles_enabled(label, img, config=TILED_DETECTION_CONFIG):
+    """
+    Whether the given organ's detections in img are refined with tiles.
+    """
+    return tiled_organ(label, config) and max(img.shape[:2]) >= config['MIN_SIDE']
+
+
+def tile_starts(length, tile_size, overlap):
+    """
+    Returns the offsets of overlapping tiles covering [0, length); the last tile ends at length.
+    """
+    if length <= tile_size:
+        return [0]
+    step = max(1, int(tile_size * (1 - overlap)))
+    starts = list(range(0, length - tile_size, step))
+    return starts + [length - tile_size]
+
+
+def tile_grid(height, width, config=TILED_DETECTION_CONFIG, size=None):
+    """
+    Returns the (x1, y1, x2, y2) tiles of the given size (TILE_SIZE by default) covering
+    an image, row by row.
+    """
+    size = size or config['TILE_SIZE']
+    return [
+        (x, y, min(x + size, width), min(y + size, height))
+        for y in tile_starts(height, size, config['OVERLAP'])
+        for x in tile_starts(width, size, config['OVERLAP'])
+    ]
+
+
+def select_tiles(grid, boxes, confidences, config=TILED_DETECTION_CONFIG):
+    """
+    Returns the tiles of the grid intersecting a coarse box grown by MARGIN, ranked by
+    the best confidence of the boxes they intersect and cut to MAX_TILES.
+    """
+    if len(boxes) == 0:
+        return []
+    boxes = np.asarray(boxes, dtype=np.float32)
+    grow = np.stack((boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1]), axis=1) * config['MARGIN']
+    x1, y1 = boxes[:, 0] - grow[:, 0], boxes[:, 1] - grow[:, 1]
+    x2, y2 = boxes[:, 2] + grow[:, 0], boxes[:, 3] + grow[:, 1]
+    confidences = np.asarray(confidences, dtype=np.float32)
+    ranked = []
+    for tile in grid:
+        tx1, ty1, tx2, ty2 = tile
+        hits = (x1 < tx2) & (x2 > tx1) & (y1 < ty2) & (y2 > ty1)
+        if hits.any():
+            ranked.append((-float(confidences[hits].max()), len(ranked), tile))
+    ranked.sort()
+    return [tile for _, _, tile in ranked[:config['MAX_TILES']]]
+
+
+def plan_tiles(height, width, boxes, confidences, config=TILED_DETECTION_CONFIG):
+    """
+    Returns (grid, selected tiles) for one image. When the coarse boxes need more than
+    MAX_TILES tiles (a stem across the whole photo), the tile size doubles until they
+    fit, trading some resolution for a bounded number of tiles.
+    """
+    size = config['TILE_SIZE']
+    while True:
+        grid = tile_grid(height, width, config, size)
+        selected = select_tiles(grid, boxes, confidences, {**config, 'MAX_TILES': len(grid)})
+        if len(selected) <= config['MAX_TILES'] or size >= max(height, width):
+            return grid, selected[:config['MAX_TILES']]
+        size *= 2
+
+
+def _ios(box, boxes):
+    """
+    Returns the intersection of box with each of boxes over the smaller of the two areas.
+    """
+    inter = (
+        np.clip(np.minimum(box[2], boxes[:, 2]) - np.maximum(box[0], boxes[:, 0]), 0, None)
+        * np.clip(np.minimum(box[3], boxes[:, 3]) - np.maximum(box[1], boxes[:, 1]), 0, None)
+    )
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return inter / (np.minimum(areas, (box[2] - box[0]) * (box[3] - box[1])) + 1e-7)
+
+
+def _aligned(box, boxes, threshold):
+    """
+    Whether each of boxes intersects box and overlaps it along one axis by more than
+    threshold of the shorter extent, as the pieces of one object cut by a tile border do.
+    """
+    overlap_x = np.minimum(box[2], boxes[:, 2]) - np.maximum(box[0], boxes[:, 0])
+    overlap_y = np.minimum(box[3], boxes[:, 3]) - np.maximum(box[1], boxes[:, 1])
+    share_x = overlap_x / (np.minimum(box[2] - box[0], boxes[:, 2] - boxes[:, 0]) + 1e-7)
+    share_y = overlap_y / (np.minimum(box[3] - box[1], boxes[:, 3] - boxes[:, 1]) + 1e-7)
+    return (overlap_x > 0) & (overlap_y > 0) & ((share_x > threshold) | (share_y > threshold))
+
+
+def cut_by_tile(boxes, tile, height, width, tolerance=2):
+    """
+    Returns whether each box (in image coordinates) touches an edge of the tile that is
+    not an edge of the image, i.e. the object may continue in a neighbouring tile.
+    """
+    x1, y1, x2, y2 = tile
+    return (
+        ((x1 > 0) & (boxes[:, 0] <= x1 + tolerance)) | ((y1 > 0) & (boxes[:, 1] <= y1 + tolerance))
+        | ((x2 < width) & (boxes[:, 2] >= x2 - tolerance)) | ((y2 < height) & (boxes[:, 3] >= y2 - tolerance))
+    )
+
+
+def merge_tile_detections(boxes, confidences, merge_ios, cut=None):
+    """
+    Cross-tile NMS: visits boxes by descending confidence and absorbs every remaining box
+    whose intersection over the smaller of the two exceeds merge_ios, widening the kept
+    box to cover it. Boxes cut by a tile border (the cut mask) also absorb cut boxes they
+    line up with (see _aligned). Returns (boxes, confidences) sorted by descending confidence.
+    """
+    if len(boxes) == 0:
+        return empty_detections()
+    boxes = np.asarray(boxes, dtype=np.float32)
+    confidences = np.asarray(confidences, dtype=np.float32)
+    cut = np.zeros(len(boxes), dtype=bool) if cut is None else np.asarray(cut, dtype=bool)
+    order = np.argsort(-confidences, kind='stable')
+    kept_boxes, kept_confidences = [], []
+    while order.size:
+        box, box_cut = boxes[order[0]].copy(), cut[order[0]]
+        rest = order[1:]
+        # Absorbing a box can make the kept box reach further ones, so repeat until stable
+        while rest.size:
+            absorbed = _ios(box, boxes[rest]) > merge_ios
+            if box_cut:
+                absorbed |= cut[rest] & _aligned(box, boxes[rest], merge_ios)
+            if not absorbed.any():
+                break
+            merged = np.vstack((box[None], boxes[rest[absorbed]]))
+            box = np.concatenate((merged[:, :2].min(axis=0), merged[:, 2:].max(axis=0)))
+            box_cut = box_cut or bool(cut[rest[absorbed]].any())
+            rest = rest[~absorbed]
+        kept_boxes.append(box)
+        kept_confidences.append(confidences[order[0]])
+        order = rest
+    return (
+        np.asarray(kept_boxes, dtype=np.float32)[:MAX_DETECTIONS],
+        np.asarray(kept_confidences, dtype=np.float32)[:MAX_DETECTIONS],
+    )
+
+
+def _uncovered(coarse_boxes, boxes, merge_ios):
+    """
+    Returns a mask of the coarse boxes that no tile box overlaps by more than merge_ios.
+    """
+    return np.array([not (_ios(coarse, boxes) > merge_ios).any() for coarse in coarse_boxes], dtype=bool)
+
+
+def refine_detections(detector, images, coarse, label, config=TILED_DETECTION_CONFIG):
+    """
+    Re-detects objects found by the coarse pass on full-resolution tiles. images are the
+    full-resolution BGR images and coarse their (boxes, confidences) in those images'
+    coordinates. The selected tiles of all images go through the detector in one call.
+    Returns (boxes, confidences) per image; images not eligible for tiling keep their
+    coarse detections.
+    """
+    refined = list(coarse)
+    tiles, owners = [], []
+    grid_sizes = {}
+    for i, (img, (boxes, confidences)) in enumerate(zip(images, coarse)):
+        if not tiles_enabled(label, img, config):
+            continue
+        height, width = img.shape[:2]
+        grid, selected = plan_tiles(height, width, boxes, confidences, config)
+        grid_sizes[i] = len(grid)
+        DETECTION_TILES.inc(label, 'run', amount=len(selected))
+        DETECTION_TILES.inc(label, 'skipped', amount=len(grid) - len(selected))
+        for tile in selected:
+            x1, y1, x2, y2 = tile
+            tiles.append(img[y1:y2, x1:x2])
+            owners.append((i, tile))
+
+    if not tiles:
+        return refined
+
+    logger.debug("Detecting %s in %d tiles of %d images...", label, len(tiles), len(grid_sizes))
+    with stage('detect_tiles'):
+        detections = detector.detect(tiles)  # One YOLO forward over the tiles of every image
+
+    found = {i: ([], [], []) for i in grid_sizes}
+    for (i, tile), (boxes, confidences) in zip(owners, detections):
+        if len(boxes):
+            x1, y1 = tile[:2]
+            boxes = boxes + np.array([x1, y1, x1, y1], dtype=np.float32)
+            found[i][0].append(boxes)
+            found[i][1].append(confidences)
+            found[i][2].append(cut_by_tile(boxes, tile, *images[i].shape[:2]))
+    for i, (tile_boxes, tile_confidences, tile_cuts) in found.items():
+        if not tile_boxes:
+            continue  # Nothing confirmed at full resolution; the coarse boxes stand
+        boxes, confidences = merge_tile_detections(
+            np.concatenate(tile_boxes), np.concatenate(tile_confidences), config['MERGE_IOS'], np.concatenate(tile_cuts))
+        coarse_boxes, coarse_confidences = coarse[i]
+        keep = _uncovered(np.asarray(coarse_boxes, dtype=np.float32), boxes, config['MERGE_IOS'])
+        if keep.any():
+            boxes = np.concatenate((boxes, np.asarray(coarse_boxes, dtype=np.float32)[keep]))
+            confidences = np.concatenate((confidences, np.asarray(coarse_confidences, dtype=np.float32)[keep]))
+            order = np.argsort(-confidences, kind='stable')
+            boxes, confidences = boxes[order], confidences[order]
+        height, width = images[i].shape[:2]
+        boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, width)
+        boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, height)
+        refined[i] = (boxes, confidences)
+    return refined
@@ -0,0 +1,66 @@
+"""
+Per-request stage timings for the prediction pipeline.
+
+Pipeline code wraps each stage in `with stage('detect'):`. Every stage is
+observed in the ml_stage_duration_seconds histogram served at /api/metrics.
+Inside a collect_stages() block the elapsed time is also added to that
+stage's total for the current request. The collector follows the request
+through asyncio tasks and the thread inference pool, so stages that run
+concurrently (bud and stem) are both counted and the totals can exceed the
+request's wall time. Stages that call a model can name it, and the time
+is then also added to that model's total (StageTimings.models), which is
+how shadow.py compares the latency of two model versions.
+"""
+import contextlib
+import contextvars
+import threading
+import time
+
+from .metrics import STAGE_DURATION
+
+STAGES = ('decode', 'detect', 'crop', 'features', 'classify', 'encode', 'save', 'regress')
+
+_collector = contextvars.ContextVar('stage_timings', default=None)
+
+
+class StageTimings:
+    def __init__(self):
+        self.seconds = {}
+        self.models = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, elapsed, model=None):
+        with self._lock:
+            self.seconds[name] = self.seconds.get(name, 0.0) + elapsed
+            if model is not None:
+                self.models[model] = self.models.get(model, 0.0) + elapsed
+
+
+@contextlib.contextmanager
+def collect_stages():
+    """
+    Collects the stage timings of everything run inside the block into a StageTimings.
+    """
+    timings = StageTimings()
+    token = _collector.set(timings)
+    try:
+        yield timings
+    finally:
+        _collector.reset(token)
+
+
+@contextlib.contextmanager
+def stage(name, model=None):
+    """
+    Times the block as one occurrence of the named pipeline stage, run by the named
+    model if given.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_DURATION.observe(elapsed, name)
+        timings = _collector.get()
+        if timings is not None:
+            timings.add(name, elapsed, model)
@@ -0,0 +1,302 @@
+"""
+Helpers for turning uploaded images into ndarrays without touching the disk,
+plus an optional background step that archives the raw uploads.
+
+With ML_UPLOAD_PREPROCESSING enabled, uploads are decoded by
+prepare_image_buffer() instead: tiny images are rejected from the header
+alone, JPEGs are decoded at 1/2, 1/4 or 1/8 scale (IMREAD_REDUCED_*, i.e.
+DCT scaling inside the decoder) down to the smallest copy still at least
+CROP_SIZE on its long side, blank images are rejected, and a DETECT_SIZE
+copy is made for the detector. The pipeline detects on that copy and maps
+the boxes back to the larger one for cropping. Images of an organ detected
+with tiles (ML_TILED_DETECTION) are decoded at full resolution instead,
+since the tiles are cut from that copy; otherwise a reduced decode would
+keep them under the tiling MIN_SIDE.
+
+MAX_UPLOAD_BYTES is enforced for every image upload while the body streams
+in (see limit_upload_size), independent of the preprocessing switch.
+"""
+import asyncio
+import atexit
+import functools
+import logging
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+from django.http import JsonResponse
+
+from .tiling import tiled_organ
+from .timing import stage
+
+ARCHIVE_UPLOADS = getattr(settings, 'ML_ARCHIVE_UPLOADS', False)
+ARCHIVE_DIR = getattr(settings, 'ML_ARCHIVE_DIR', 'tmp/')
+
+_archive_executor = None
+
+DEFAULT_PREPROCESSING_CONFIG = {
+    'ENABLED': False,
+    'DETECT_SIZE': 640,     # Long side of the copy the detector sees (its input size)
+    'CROP_SIZE': 960,       # Minimum long side of the copy crops are cut from
+    'MIN_SIDE': 64,         # Images with a shorter side are rejected
+    'MIN_STDDEV': 2.0,      # Images whose pixel standard deviation is lower are rejected as blank
+}
+
+PREPROCESSING_CONFIG = {**DEFAULT_PREPROCESSING_CONFIG, **getattr(settings, 'ML_UPLOAD_PREPROCESSING', {})}
+
+MAX_UPLOAD_BYTES = getattr(settings, 'ML_MAX_UPLOAD_BYTES', 25 * 1024 * 1024)
+
+REDUCED_DECODE_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+logger = logging.getLogger(__name__)
+
+
+def upload_buffer(uploaded_file):
+    """
+    Returns a buffer over the raw bytes of an uploaded file.
+    In-memory uploads are exposed as a memoryview without copying.
+    """
+    file_obj = getattr(uploaded_file, 'file', None)
+    if hasattr(file_obj, 'getbuffer'):
+        return file_obj.getbuffer()
+    uploaded_file.seek(0)
+    return uploaded_file.read()
+
+
+def decode_image_buffer(buffer):
+    """
+    Decodes an encoded image (JPEG, PNG, ...) from a bytes-like object into a BGR ndarray.
+    Returns None when the buffer is not a decodable image.
+    """
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    if data.size == 0:
+        return None
+    with stage('decode'):
+        return cv2.imdecode(data, cv2.IMREAD_COLOR)
+
+
+class UploadRejected(ValueError):
+    """
+    Raised when an upload is rejected before any model runs (blank or too small).
+    """
+
+
+class PreparedImage:
+    """
+    A decoded upload: image is the (possibly reduced) copy crops are cut from,
+    detect_image the smaller copy the detector runs on.
+    """
+
+    def __init__(self, image, detect_image):
+        self.image = image
+        self.detect_image = detect_image
+
+    @property
+    def shape(self):
+        return self.image.shape
+
+
+# ============================
+# Preprocessing
+# ============================
+
+def image_size(buffer):
+    """
+    Returns (width, height) read from a JPEG or PNG header, or None for other or malformed data.
+    """
+    data = memoryview(buffer)
+    if data[:8] == b'\x89PNG\r\n\x1a\n' and len(data) >= 24:
+        return struct.unpack('>II', data[16:24])
+    if data[:2] != b'\xff\xd8':
+        return None
+    offset = 2
+    while offset + 9 < len(data):
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+        if marker == 0xFF:
+            offset += 1  # Fill byte
+            continue
+        length = struct.unpack('>H', data[offset + 2:offset + 4])[0]
+        # SOFn frame headers carry the size; C4 (DHT), C8 (JPG) and CC (DAC) share the range
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack('>HH', data[offset + 5:offset + 9])
+            return width, height
+        offset += 2 + length
+    return None
+
+
+def _is_jpeg(buffer):
+    return bytes(memoryview(buffer)[:2]) == b'\xff\xd8'
+
+
+def prepare_image_buffer(buffer, label='Image', organ=None):
+    """
+    Decodes an upload for the detection pipeline and returns a PreparedImage, or None
+    when it is not a decodable image. Raises UploadRejected for blank or tiny images.
+    organ ('bud' or 'stem', if known) decides whether the image is decoded at full resolution.
+    """
+    config = PREPROCESSING_CONFIG
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    if data.size == 0:
+        return None
+
+    size = image_size(buffer)
+    if size is not None and min(size) < config['MIN_SIDE']:
+        raise UploadRejected(f"{label} is too small (minimum {config['MIN_SIDE']} px per side)")
+
+    flag = cv2.IMREAD_COLOR
+    if size is not None and _is_jpeg(buffer) and not tiled_organ(organ):
+        for factor, reduced_flag in REDUCED_DECODE_FLAGS:
+            if max(size) // factor >= config['CROP_SIZE']:
+                flag = reduced_flag
+                break
+    with stage('decode'):
+        image = cv2.imdecode(data, flag)
+    if image is None:
+        return None
+    if min(image.shape[:2]) < config['MIN_SIDE'] and flag == cv2.IMREAD_COLOR:
+        raise UploadRejected(f"{label} is too small (minimum {config['MIN_SIDE']} px per side)")
+
+    with stage('decode'):
+        height, width = image.shape[:2]
+        scale = config['DETECT_SIZE'] / max(height, width)
+        detect_image = image
+        if scale < 1:
+            size = (max(1, round(width * scale)), max(1, round(height * scale)))
+            detect_image = cv2.resize(image, size, interpolation=cv2.INTER_LINEAR)
+        _, stddev = cv2.meanStdDev(detect_image)
+    if float(stddev.max()) < config['MIN_STDDEV']:
+        raise UploadRejected(f"{label} is blank")
+    return PreparedImage(image, detect_image)
+
+
+def decode_for_detection(buffer, label='Image', organ=None):
+    """
+    Decodes an upload for the detection pipeline: a PreparedImage when preprocessing is
+    enabled, otherwise a full-size ndarray. Returns None when the buffer is not a decodable image.
+    """
+    if PREPROCESSING_CONFIG['ENABLED']:
+        return prepare_image_buffer(buffer, label, organ)
+    return decode_image_buffer(buffer)
+
+
+def decode_upload(uploaded_file, label='Image', organ=None):
+    """
+    Decodes an uploaded image straight from the upload buffer.
+    Uploads that Django spooled to a temporary file are read by OpenCV from that path.
+    With preprocessing enabled, returns a PreparedImage and may raise UploadRejected.
+    """
+    if PREPROCESSING_CONFIG['ENABLED']:
+        return prepare_image_buffer(upload_buffer(uploaded_file), label, organ)
+    if hasattr(uploaded_file, 'temporary_file_path'):
+        with stage('decode'):
+            return cv2.imread(uploaded_file.temporary_file_path(), cv2.IMREAD_COLOR)
+    return decode_image_buffer(upload_buffer(uploaded_file))
+
+
+def _get_archive_executor():
+    global _archive_executor
+    if _archive_executor is None:
+        _archive_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='upload-archive')
+        atexit.register(_archive_executor.shutdown, wait=True)
+    return _archive_executor
+
+
+def _save_archive(name, data):
+    try:
+        default_storage.save(ARCHIVE_DIR + name, ContentFile(data))
+    except Exception as e:
+        logger.warning("Failed to archive upload %s: %s", name, e)
+
+
+def archive_upload(uploaded_file):
+    """
+    Schedules the raw upload to be written to ARCHIVE_DIR in the background.
+    Does nothing unless ML_ARCHIVE_UPLOADS is enabled. The bytes are copied first
+    because the upload buffer is released when the request finishes.
+    """
+    if not ARCHIVE_UPLOADS:
+        return None
+    data = bytes(upload_buffer(uploaded_file))
+    return _get_archive_executor().submit(_save_archive, uploaded_file.name, data)
+
+
+# ============================
+# Upload Size Limit
+# ============================
+
+class MaxUploadSizeHandler(FileUploadHandler):
+    """
+    Stops parsing the request body as soon as one uploaded file exceeds max_bytes (default MAX_UPLOAD_BYTES).
+    The rest of the body is read and discarded rather than the connection reset, so the
+    client, which is usually still sending, receives the 413.
+    """
+
+    def __init__(self, request=None, max_bytes=None):
+        super().__init__(request)
+        self.received = 0
+        self.max_bytes = max_bytes or MAX_UPLOAD_BYTES
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.received = 0
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if self.received > self.max_bytes:
+            self.request.upload_too_large = True
+            raise StopUpload(connection_reset=False)
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
+
+
+def _too_large_response(max_bytes, noun):
+    logger.info("Upload too large")
+    return JsonResponse({'error': f'Each {noun} must be at most {max_bytes // (1024 * 1024)} MB'}, status=413)
+
+
+def limit_upload_size(max_files=2, max_bytes=None, noun='image'):
+    """
+    View decorator rejecting image uploads over MAX_UPLOAD_BYTES (or max_bytes) with 413 before
+    the view runs: immediately from Content-Length when the body cannot fit max_files files,
+    otherwise as soon as the streamed body of one file passes the limit.
+    Under ASGI the body has already been received, so only parsing and decoding are saved.
+    """
+    def decorator(view_func):
+        def check(request):
+            if MAX_UPLOAD_BYTES is None or request.method != 'POST':
+                return None
+            limit = max_bytes or MAX_UPLOAD_BYTES
+            try:
+                content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                content_length = 0
+            # Allow a little room for multipart headers and the other form fields
+            if content_length > max_files * limit + 64 * 1024:
+                return _too_large_response(limit, noun)
+            request.upload_handlers.insert(0, MaxUploadSizeHandler(request, limit))
+            request.FILES  # Parse the body now, so the view never sees a truncated upload
+            if getattr(request, 'upload_too_large', False):
+                return _too_large_response(limit, noun)
+            return None
+
+        if asyncio.iscoroutinefunction(view_func):
+            @functools.wraps(view_func)
+            async def async_wrapper(request, *args, **kwargs):
+                # Parsing a multipart body of up to max_files files must not block the event loop
+                return await asyncio.to_thread(check, request) or await view_func(request, *args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            return check(request) or view_func(request, *args, **kwargs)
+        return wrapper
+    return decorator
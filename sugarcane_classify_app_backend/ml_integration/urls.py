@@ -1,7 +1,25 @@
 from django.urls import path
-from . import views
+from . import forecast_views
+from .profiles import PROFILE
 
+# Served by every profile; forecast_views does not import the vision stack
 urlpatterns = [
-    path('predict/', views.predict_variety, name='predict_variety'),
-    path('predict-sugar-production/', views.predict_sugar_production, name='predict_sugar_production'),
-]
\ No newline at end of file
+    path('predict-sugar-production/', forecast_views.predict_sugar_production, name='predict_sugar_production'),
+    path('predict-sugar-production/bulk/', forecast_views.predict_sugar_production_bulk, name='predict_sugar_production_bulk'),
+    path('models/', forecast_views.model_status, name='model_status'),
+    path('metrics', forecast_views.metrics_view, name='metrics'),
+    path('async/predict-sugar-production/', forecast_views.predict_sugar_production_async, name='predict_sugar_production_async'),
+]
+
+if PROFILE == 'full':
+    from . import views
+
+    urlpatterns += [
+        path('predict/', views.predict_variety, name='predict_variety'),
+        path('predict-batch/', views.predict_variety_batch, name='predict_variety_batch'),
+        path('predict-sweep/', views.predict_variety_sweep, name='predict_variety_sweep'),
+        path('jobs/', views.submit_job, name='submit_job'),
+        path('jobs/<uuid:job_id>/', views.job_status, name='job_status'),
+        path('crops/<str:crop_id>', views.crop_image, name='crop'),
+        path('async/predict/', views.predict_variety_async, name='predict_variety_async'),
+    ]
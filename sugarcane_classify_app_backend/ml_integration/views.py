@@ -1,394 +1,576 @@
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
-from django.core.files.storage import default_storage
-from django.core.files.base import ContentFile
+import asyncio
+import functools
+import logging
 import os
-import cv2
-import numpy as np
-import joblib
-import base64
-import pickle  # Import pickle to load the sugar production model
-from ultralytics import YOLO
-from skimage.feature import hog
-from skimage.feature.texture import graycomatrix, graycoprops
 from django.conf import settings
-import xgboost as xgb  # Import XGBoost
+from django.core.exceptions import ValidationError
+from django.core.validators import URLValidator
+from django.db import transaction
+from django.urls import reverse
+from .cache import prediction_cache, variety_cache_key
+from .crops import CROPS_CONFIG, find_crop
+from .executor import Overloaded, inference_pool
+from .forecast_views import (  # noqa: F401 - the forecasting, status and metrics views are served from here too
+    async_csrf_exempt, metrics_view, model_status, overloaded_response,
+    predict_sugar_production, predict_sugar_production_async, predict_sugar_production_bulk,
+)
+from .feature_store import organ_record, pair_keys
+from .jobs import job_worker, webhook_url_allowed
+from .metrics import PREDICTION_CACHE, track_requests
+from .models import PredictionJob
+from .fusion import fusion_engine
+from .pipeline import (
+    MULTI_DETECTION_CONFIG, ORGAN_CLASSIFY, ORGAN_DETECTORS, SKIPPED_ORGAN, detect_and_crop_all_batch,
+    classify_detections, classify_organs, count_fusion_path, current_fusion_engine, defer_organ, detect_and_classify,
+    detections_summary, variety_response, lean_variety_response,
+)
+from .registry import registry
+from .shadow import AB_ENABLED, candidate_registry, choose_arm, compare, in_arm, served_timings, use_arm
+from .sweeps import SWEEP_CONFIG, SweepRejected, classify_frames, sample_burst, sample_video
+from .tiling import TILED_DETECTION_CONFIG
+from .uploads import (
+    UploadRejected, decode_upload, decode_for_detection, upload_buffer, archive_upload, limit_upload_size,
+)
+
+logger = logging.getLogger(__name__)
+
+# 'full' embeds base64 JPEG crops in variety responses; 'lean' returns crop ids and boxes (see crops.py)
+RESPONSE_MODES = ('full', 'lean')
+DEFAULT_RESPONSE_MODE = getattr(settings, 'ML_DEFAULT_RESPONSE_MODE', 'full')
+
+def response_mode(request):
+    """
+    Returns the variety response mode requested with ?response= (or a 'response' form field), or None if invalid.
+    """
+    mode = request.GET.get('response') or request.POST.get('response') or DEFAULT_RESPONSE_MODE
+    return mode if mode in RESPONSE_MODES else None
 
-# Load models for bud detection and classification
-bud_detection_model = YOLO("ml_models/best.pt")
-rf_model_bud = joblib.load("ml_models/sugarcane_rf_model.pkl")
+def cache_variant(mode, arm='primary'):
+    """
+    Returns the prediction cache variant for a response mode, the detection modes, the fusion
+    settings and the model set answering (see shadow.py).
+    """
+    parts = [] if mode == 'full' else [mode]
+    if arm == 'candidate':
+        parts.append('candidate:' + candidate_registry.fingerprint())
+    if MULTI_DETECTION_CONFIG['ENABLED']:
+        parts.append('multi')
+    if TILED_DETECTION_CONFIG['ENABLED']:
+        parts.append('tiled')
+    if fusion_engine.signature:
+        parts.append('fusion-' + fusion_engine.signature)
+    return '+'.join(parts)
+
+def detections_response(bud_boxes, bud_confidences, stem_boxes, stem_confidences):
+    return {
+        'bud': detections_summary(bud_boxes, bud_confidences),
+        'stem': detections_summary(stem_boxes, stem_confidences),
+    }
+
+def invalid_response_mode():
+    logger.info("Invalid response mode")
+    return JsonResponse({'error': f"Invalid response mode; use one of: {', '.join(RESPONSE_MODES)}"}, status=400)
 
-# Load models for stem detection and classification
-stem_detection_model = YOLO("ml_models/StemDetection_v1.pt")
-rf_model_stem = joblib.load("ml_models/modelsbest_xgboost.pkl")
+# ============================
+# Existing View for Variety Prediction
+# ============================
 
-# Load the sugar production prediction model
-sugar_production_model = pickle.load(open("ml_models/sugar_production_model.pkl", "rb"))
+@csrf_exempt
+@track_requests('predict_variety')
+@limit_upload_size()
+def predict_variety(request):
+    logger.debug("Received request method: %s", request.method)
+    if request.method == 'POST':
+        logger.debug("Request contains files: %s", request.FILES)
 
-VARIETY_NAMES = {
-    1: "SL 96 128",
-    2: "SL 03 336",
-    3: "SL 03 1077",
-    4: "SL 03 1188"
-}
+        # Check for both bud and stem images
+        if 'bud_image' not in request.FILES or 'stem_image' not in request.FILES:
+            logger.info("Both bud and stem images are required")
+            return JsonResponse({'error': 'Both bud and stem images are required'}, status=400)
+
+        try:
+            bud_image_file = request.FILES['bud_image']
+            stem_image_file = request.FILES['stem_image']
+            logger.debug("Bud image file received: %s", bud_image_file.name)
+            logger.debug("Stem image file received: %s", stem_image_file.name)
+            mode = response_mode(request)
+            if mode is None:
+                return invalid_response_mode()
+
+            # The candidate model set answers a share of requests in A/B mode (ML_SHADOW)
+            arm = choose_arm()
+
+            # Answer repeated uploads of the same photos from the prediction cache
+            cache_key = variety_cache_key(bud_image_file, stem_image_file, variant=cache_variant(mode, arm))
+            if cache_key is not None:
+                cached = prediction_cache.get(cache_key)
+                PREDICTION_CACHE.inc('hit' if cached is not None else 'miss')
+                if cached is not None:
+                    logger.debug("Prediction cache hit: %s", cache_key)
+                    return JsonResponse({**cached['response'], 'cache': 'hit'})
+
+            # Decode bud image straight from the upload buffer
+            bud_image = decode_upload(bud_image_file, 'Bud image', 'bud')
+            if bud_image is None:
+                logger.info("Bud image could not be decoded")
+                return JsonResponse({'error': 'Bud image could not be decoded'}, status=400)
+            archive_upload(bud_image_file)
+
+            # Decode stem image straight from the upload buffer
+            stem_image = decode_upload(stem_image_file, 'Stem image', 'stem')
+            if stem_image is None:
+                logger.info("Stem image could not be decoded")
+                return JsonResponse({'error': 'Stem image could not be decoded'}, status=400)
+            archive_upload(stem_image_file)
+
+            with use_arm(arm):
+                # Detect and classify each organ in fusion order (every selected detection in
+                # multi-detection mode, averaged by detection confidence; the best one is returned).
+                # The second organ is skipped when the first is decisive (ML_FUSION['EARLY_EXIT']).
+                with served_timings() as timings:
+                    results, missing = classify_organs(
+                        {'bud': bud_image, 'stem': stem_image}, pair_keys([bud_image_file], [stem_image_file]))
+                if missing is not None:
+                    logger.info("No %s detected in the image", missing)
+                    return JsonResponse({'error': f'No {missing} detected in the image'}, status=400)
+                bud_crops, bud_boxes, bud_confidences, bud_class_probabilities = results.get('bud', SKIPPED_ORGAN)
+                stem_crops, stem_boxes, stem_confidences, stem_class_probabilities = results.get('stem', SKIPPED_ORGAN)
+                cropped_bud, bud_box = (bud_crops[0], bud_boxes[0]) if bud_crops else (None, None)
+                cropped_stem, stem_box = (stem_crops[0], stem_boxes[0]) if stem_crops else (None, None)
+                logger.debug("Bud class probabilities: %s", bud_class_probabilities)
+                logger.debug("Stem class probabilities: %s", stem_class_probabilities)
+
+                if mode == 'lean':
+                    # Reference the crops by id instead of embedding them; the crop store encodes each crop once
+                    response_data = lean_variety_response(
+                        cropped_bud, bud_box, cropped_stem, stem_box, bud_class_probabilities, stem_class_probabilities)
+                else:
+                    # Save the cropped images and return them base64-encoded with the combined result
+                    response_data = variety_response(
+                        cropped_bud, bud_image_file.name, cropped_stem, stem_image_file.name,
+                        bud_class_probabilities, stem_class_probabilities,
+                    )
+                logger.debug("Final predicted variety: %s (%s)", response_data['variety'], response_data['fusion']['path'])
+            if MULTI_DETECTION_CONFIG['ENABLED']:
+                response_data['detections'] = detections_response(bud_boxes, bud_confidences, stem_boxes, stem_confidences)
+            if AB_ENABLED:
+                response_data['model_set'] = arm
+            # Runs the other model set on these images off the request path (ML_SHADOW)
+            compare(arm, {'bud': bud_image, 'stem': stem_image}, bud_class_probabilities, stem_class_probabilities, timings)
+
+            if cache_key is not None:
+                prediction_cache.set(cache_key, {
+                    'bud_box': bud_box,
+                    'stem_box': stem_box,
+                    'bud_probabilities': bud_class_probabilities,
+                    'stem_probabilities': stem_class_probabilities,
+                    'response': response_data,
+                })
+            return JsonResponse({**response_data, 'cache': 'miss'})
+
+        except UploadRejected as e:
+            logger.info("Upload rejected: %s", e)
+            return JsonResponse({'error': str(e)}, status=400)
+        except Exception as e:
+            logger.exception("Exception occurred")
+            return JsonResponse({'error': str(e)}, status=500)
+    else:
+        logger.info("Invalid request method")
+        return JsonResponse({'error': 'Invalid request method'}, status=400)
 
 # ============================
-# Existing Functions for Bud and Stem Classification
+# Batched View for Variety Prediction
 # ============================
 
-def detect_and_crop_bud(image_path):
+MAX_BATCH_PAIRS = getattr(settings, 'ML_MAX_BATCH_PAIRS', 64)
+
+def _decode_or_reject(uploaded_file, label, organ, index, rejected):
+    try:
+        return decode_upload(uploaded_file, label, organ)
+    except UploadRejected as e:
+        rejected.setdefault(index, str(e))
+        return None
+
+@csrf_exempt
+@track_requests('predict_variety_batch')
+@limit_upload_size(max_files=2 * MAX_BATCH_PAIRS)
+def predict_variety_batch(request):
     """
-    Detects the bud in the image using YOLO and crops it.
+    Predicts the variety for N bud/stem image pairs uploaded in one multipart request.
+    Expects repeated 'bud_image' and 'stem_image' fields; the i-th bud is paired with
+    the i-th stem. Each detector and classifier runs once over the whole batch.
     """
-    img = cv2.imread(image_path)
-    if img is None:
-        print("❌ Failed to load bud image!")
-        return None
+    logger.debug("Received request method: %s", request.method)
+    if request.method == 'POST':
+        bud_image_files = request.FILES.getlist('bud_image')
+        stem_image_files = request.FILES.getlist('stem_image')
 
-    print("Detecting bud...")
-    try:
-        results = bud_detection_model(img)  # Run YOLO inference
-        if isinstance(results, list) and len(results) > 0 and hasattr(results[0], 'boxes') and hasattr(results[0].boxes, 'xyxy'):
-            boxes = results[0].boxes.xyxy  # Extract bounding boxes
-        else:
-            print("❌ No bud detected or invalid results structure!")
-            return None
+        if not bud_image_files or not stem_image_files:
+            logger.info("Both bud and stem images are required")
+            return JsonResponse({'error': 'Both bud and stem images are required'}, status=400)
+        if len(bud_image_files) != len(stem_image_files):
+            logger.info("Bud and stem image counts differ")
+            return JsonResponse({'error': 'The number of bud and stem images must match'}, status=400)
+        if len(bud_image_files) > MAX_BATCH_PAIRS:
+            logger.info("Too many image pairs")
+            return JsonResponse({'error': f'At most {MAX_BATCH_PAIRS} image pairs are allowed per request'}, status=400)
+        mode = response_mode(request)
+        if mode is None:
+            return invalid_response_mode()
 
-        if len(boxes) == 0:
-            print("❌ No bud detected!")
-            return None
+        try:
+            # Decode all uploaded images in memory; rejected (blank or tiny) images fail only their pair
+            rejected = {}
+            bud_images = [_decode_or_reject(f, 'Bud image', 'bud', i, rejected) for i, f in enumerate(bud_image_files)]
+            stem_images = [_decode_or_reject(f, 'Stem image', 'stem', i, rejected) for i, f in enumerate(stem_image_files)]
+            for image_file in bud_image_files + stem_image_files:
+                archive_upload(image_file)
+            logger.debug("Decoded %d bud/stem image pairs", len(bud_images))
+
+            # Detect and classify the organs in fusion order with one detector and one classifier
+            # call per organ over the whole stack; pairs whose first organ is decisive skip the second
+            images = {'bud': bud_images, 'stem': stem_images}
+            keys = pair_keys(bud_image_files, stem_image_files)
+            detections = {organ: [([], [], [])] * len(bud_images) for organ in images}
+            class_probabilities = {organ: [None] * len(bud_images) for organ in images}
+            results = [{'error': rejected[i]} if i in rejected else None for i in range(len(bud_images))]
+            pending = [i for i in range(len(bud_images)) if i not in rejected]
+            for organ in fusion_engine.order:
+                found = detect_and_crop_all_batch(
+                    registry.get(ORGAN_DETECTORS[organ]), [images[organ][i] for i in pending], organ)
+                detected = []
+                for i, organ_detections in zip(pending, found):
+                    detections[organ][i] = organ_detections
+                    if organ_detections[0]:
+                        detected.append(i)
+                    else:
+                        results[i] = {'error': f'No {organ} detected in the image'}
+                if detected:
+                    # Stack features and classify every crop of every pair with one call per model
+                    rows = classify_detections(
+                        ORGAN_CLASSIFY[organ], [detections[organ][i][0] for i in detected],
+                        [detections[organ][i][2] for i in detected],
+                        record=organ_record(
+                            keys and keys[organ], [detections[organ][i][1] for i in detected],
+                            [detections[organ][i][2] for i in detected], rows=detected),
+                    )
+                    for i, row in zip(detected, rows):
+                        class_probabilities[organ][i] = [float(prob) for prob in row]
+                pending = detected
+                if organ == fusion_engine.first:
+                    decisive = {i for i in detected if fusion_engine.decisive(organ, class_probabilities[organ][i])}
+                    if decisive and fusion_engine.defer:
+                        skipped = fusion_engine.order[1]
+                        for i in sorted(decisive):
+                            pair = pair_keys([bud_image_files[i]], [stem_image_files[i]])
+                            defer_organ(skipped, images[skipped][i], pair and pair[skipped],
+                                        {organ: class_probabilities[organ][i]})
+                    pending = [i for i in detected if i not in decisive]
+
+            for i, result in enumerate(results):
+                if result is not None:
+                    continue
+                bud_crops, bud_boxes, bud_confidences = detections['bud'][i]
+                stem_crops, stem_boxes, stem_confidences = detections['stem'][i]
+                cropped_bud = bud_crops[0] if bud_crops else None
+                cropped_stem = stem_crops[0] if stem_crops else None
+                if mode == 'lean':
+                    results[i] = lean_variety_response(
+                        cropped_bud, bud_boxes[0] if bud_boxes else None, cropped_stem, stem_boxes[0] if stem_boxes else None,
+                        class_probabilities['bud'][i], class_probabilities['stem'][i],
+                    )
+                else:
+                    results[i] = variety_response(
+                        cropped_bud, bud_image_files[i].name, cropped_stem, stem_image_files[i].name,
+                        class_probabilities['bud'][i], class_probabilities['stem'][i],
+                    )
+                count_fusion_path(results[i]['fusion']['organs'])
+                if MULTI_DETECTION_CONFIG['ENABLED']:
+                    results[i]['detections'] = detections_response(bud_boxes, bud_confidences, stem_boxes, stem_confidences)
+
+            return JsonResponse({'count': len(results), 'results': results})
 
-        # Extract bounding box coordinates (first detected bud)
-        x1, y1, x2, y2 = map(int, boxes[0])
-        cropped_bud = img[y1:y2, x1:x2]  # Crop the detected bud
-        return cropped_bud
+        except Exception as e:
+            logger.exception("Exception occurred")
+            return JsonResponse({'error': str(e)}, status=500)
+    else:
+        logger.info("Invalid request method")
+        return JsonResponse({'error': 'Invalid request method'}, status=400)
 
-    except Exception as e:
-        print(f"Error processing bud YOLO results: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return None
+# ============================
+# Sweep View for Variety Prediction
+# ============================
 
-def extract_bud_features(img):
-    """
-    Extracts features from a bud image (color histograms + HOG).
-    """
-    IMG_SIZE = (128, 128)
-    print("Resizing bud image to:", IMG_SIZE)
-
-    # Resize and convert to RGB
-    img = cv2.resize(img, IMG_SIZE)
-    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-
-    # Histogram Features (Color Distribution)
-    print("Calculating bud color histograms...")
-    hist_r = cv2.calcHist([img], [0], None, [256], [0, 256])
-    hist_g = cv2.calcHist([img], [1], None, [256], [0, 256])
-    hist_b = cv2.calcHist([img], [2], None, [256], [0, 256])
-    hist_features = np.concatenate((hist_r.flatten(), hist_g.flatten(), hist_b.flatten()))
-    print("Bud histogram features shape:", hist_features.shape)
-
-    # HOG Feature Extraction
-    print("Calculating bud HOG features...")
-    gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
-    hog_features = hog(
-        gray,
-        orientations=9,
-        pixels_per_cell=(8, 8),
-        cells_per_block=(2, 2),
-        block_norm='L2-Hys',
-        feature_vector=True
-    )
-    print("Bud HOG features shape:", hog_features.shape)
-
-    # Combine HOG + Histogram features
-    combined_features = np.concatenate((hist_features, hog_features))
-    print("Bud combined features shape:", combined_features.shape)
-
-    return combined_features, img
-
-def detect_and_crop_stem(image_path):
+@csrf_exempt
+@track_requests('predict_variety_sweep')
+@limit_upload_size(max_files=SWEEP_CONFIG['MAX_BURST_FRAMES'], max_bytes=SWEEP_CONFIG['MAX_VIDEO_BYTES'], noun='file')
+def predict_variety_sweep(request):
     """
-    Detects the stem in the image using YOLO and crops it.
+    Predicts the variety from a sweep along a cane: a short clip uploaded as 'video', or
+    a burst of photos as repeated 'frame' fields. A bounded number of distinct frames is
+    sampled and the per-frame bud and stem probabilities are aggregated (see sweeps.py).
     """
-    img = cv2.imread(image_path)
-    if img is None:
-        print("❌ Failed to load stem image!")
-        return None
+    logger.debug("Received request method: %s", request.method)
+    if request.method != 'POST':
+        logger.info("Invalid request method")
+        return JsonResponse({'error': 'Invalid request method'}, status=400)
+
+    video_file = request.FILES.get('video')
+    frame_files = request.FILES.getlist('frame')
+    if (video_file is None) == (not frame_files):
+        logger.info("Either a video or burst frames are required")
+        return JsonResponse({'error': "Upload either a 'video' or one or more 'frame' images"}, status=400)
+    if len(frame_files) > SWEEP_CONFIG['MAX_BURST_FRAMES']:
+        logger.info("Too many burst frames")
+        return JsonResponse({'error': f"At most {SWEEP_CONFIG['MAX_BURST_FRAMES']} frames are allowed per request"}, status=400)
+    mode = response_mode(request)
+    if mode is None:
+        return invalid_response_mode()
 
-    print("Detecting stem...")
     try:
-        results = stem_detection_model(img)  # Run YOLO inference for stem
-        if isinstance(results, list) and len(results) > 0 and hasattr(results[0], 'boxes') and hasattr(results[0].boxes, 'xyxy'):
-            boxes = results[0].boxes.xyxy  # Extract bounding boxes
+        if video_file is not None:
+            frames, frame_summary = sample_video(video_file)
+            source, name = 'video', video_file.name
         else:
-            print("❌ No stem detected or invalid results structure!")
-            return None
-
-        if len(boxes) == 0:
-            print("❌ No stem detected!")
-            return None
-
-        # Extract bounding box coordinates (first detected stem)
-        x1, y1, x2, y2 = map(int, boxes[0])
-        cropped_stem = img[y1:y2, x1:x2]  # Crop the detected stem
-        return cropped_stem
-
+            frames, frame_summary = sample_burst(frame_files)
+            source, name = 'frames', frame_files[0].name
+        logger.debug("Sampled %d of %d frames", len(frames), frame_summary['read'])
+
+        results = {}
+        for organ in fusion_engine.order:
+            results[organ] = classify_frames(organ, frames)
+            if results[organ] is None:
+                logger.info("No %s detected in the %s", organ, source)
+                return JsonResponse({'error': f'No {organ} detected in the {source}'}, status=400)
+        bud_class_probabilities, bud_frames, cropped_bud, bud_box = results['bud']
+        stem_class_probabilities, stem_frames, cropped_stem, stem_box = results['stem']
+        frame_summary.update(bud=bud_frames, stem=stem_frames)
+
+        if mode == 'lean':
+            response_data = lean_variety_response(
+                cropped_bud, bud_box, cropped_stem, stem_box, bud_class_probabilities, stem_class_probabilities)
+        else:
+            # Crops are saved as JPEGs named after the clip or the first frame
+            crop_name = os.path.splitext(name)[0] + '.jpg'
+            response_data = variety_response(
+                cropped_bud, crop_name, cropped_stem, crop_name, bud_class_probabilities, stem_class_probabilities)
+        count_fusion_path(response_data['fusion']['organs'])
+        response_data['frames'] = frame_summary
+        return JsonResponse(response_data)
+
+    except SweepRejected as e:
+        logger.info("Sweep rejected: %s", e)
+        return JsonResponse({'error': str(e)}, status=400)
     except Exception as e:
-        print(f"Error processing stem YOLO results: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return None
+        logger.exception("Exception occurred")
+        return JsonResponse({'error': str(e)}, status=500)
 
-def extract_stem_features(image):
+def crop_image(request, crop_id):
     """
-    Extracts features from a stem image (color histograms, color stats, texture).
+    Serves a stored crop thumbnail referenced by a lean variety response.
+    Crops are content-addressed and never change, so the id is a strong ETag.
     """
-    IMG_SIZE = (128, 128)
-    print("Resizing stem image to:", IMG_SIZE)
-    image = cv2.resize(image, IMG_SIZE)
-
-    # Extract color histogram (RGB & HSV)
-    print("Calculating stem color histograms...")
-    color_hist = extract_color_histogram(image)
-    print("Stem color histogram features shape:", color_hist.shape)
-
-    # Extract color statistics (mean and std for RGB & HSV)
-    print("Calculating stem color stats...")
-    color_stats = extract_color_stats(image)
-    print("Stem color stats shape:", color_stats.shape)
-
-    # Extract texture features (GLCM)
-    print("Calculating stem texture features...")
-    texture_features = extract_texture_features(image)
-    print("Stem texture features shape:", texture_features.shape)
-
-    # Combine all features
-    combined_features = np.concatenate((color_hist, color_stats, texture_features))
-    print("Stem combined features shape:", combined_features.shape)
-
-    return combined_features, image
-
-def extract_color_histogram(image, bins=32):
-    hist_features = []
-    # RGB Histogram
-    for i in range(3):
-        hist = cv2.calcHist([image], [i], None, [bins], [0, 256]).flatten()
-        hist_features.extend(hist)
-
-    # Convert to HSV and compute HSV Histogram
-    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-    for i in range(3):
-        hist = cv2.calcHist([hsv], [i], None, [bins], [0, 256]).flatten()
-        hist_features.extend(hist)
-
-    return np.array(hist_features)
-
-def extract_color_stats(image):
-    stats = []
-    for i in range(3):
-        stats.append(np.mean(image[:, :, i]))
-        stats.append(np.std(image[:, :, i]))
-
-    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-    for i in range(3):
-        stats.append(np.mean(hsv[:, :, i]))
-        stats.append(np.std(hsv[:, :, i]))
-
-    return np.array(stats)
-
-def extract_texture_features(image):
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    glcm = graycomatrix(gray, distances=[1], angles=[0], levels=256, symmetric=True, normed=True)
-    contrast = graycoprops(glcm, 'contrast')[0, 0]
-    dissimilarity = graycoprops(glcm, 'dissimilarity')[0, 0]
-    homogeneity = graycoprops(glcm, 'homogeneity')[0, 0]
-    energy = graycoprops(glcm, 'energy')[0, 0]
-    correlation = graycoprops(glcm, 'correlation')[0, 0]
-    return np.array([contrast, dissimilarity, homogeneity, energy, correlation])
+    found = find_crop(crop_id)
+    if found is None:
+        return JsonResponse({'error': 'Crop not found'}, status=404)
+    path, content_type = found
+
+    etag = f'"{crop_id}"'
+    if etag in [tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')]:
+        response = HttpResponse(status=304)
+    else:
+        with open(path, 'rb') as f:
+            response = HttpResponse(f.read(), content_type=content_type)
+    response['ETag'] = etag
+    response['Cache-Control'] = f"public, max-age={CROPS_CONFIG['MAX_AGE']}, immutable"
+    return response
 
 # ============================
-# Existing View for Variety Prediction
+# Prediction Jobs (submit / poll)
 # ============================
 
 @csrf_exempt
-def predict_variety(request):
-    print("Received request method:", request.method)
-    if request.method == 'POST':
-        print("Request contains files:", request.FILES)
-
-        # Check for both bud and stem images
-        if 'bud_image' not in request.FILES or 'stem_image' not in request.FILES:
-            print("Error: Both bud and stem images are required")
-            return JsonResponse({'error': 'Both bud and stem images are required'}, status=400)
+@track_requests('submit_job')
+@limit_upload_size()
+def submit_job(request):
+    """
+    Queues a variety prediction and returns its job id without waiting for it.
+    Takes the same 'bud_image' / 'stem_image' uploads as predict_variety, plus an
+    optional 'webhook_url' that receives the finished job as JSON.
+    """
+    if request.method != 'POST':
+        logger.info("Invalid request method")
+        return JsonResponse({'error': 'Invalid request method'}, status=400)
+    if 'bud_image' not in request.FILES or 'stem_image' not in request.FILES:
+        logger.info("Both bud and stem images are required")
+        return JsonResponse({'error': 'Both bud and stem images are required'}, status=400)
 
+    webhook_url = request.POST.get('webhook_url', '')
+    if webhook_url:
         try:
-            # Save bud image
-            bud_image_file = request.FILES['bud_image']
-            print("Bud image file received:", bud_image_file.name)
-            bud_path = default_storage.save('tmp/' + bud_image_file.name, ContentFile(bud_image_file.read()))
-            bud_image_path = os.path.join(settings.MEDIA_ROOT, bud_path)
-            print("Bud image saved at:", bud_image_path)
+            URLValidator(schemes=['http', 'https'])(webhook_url)
+        except ValidationError:
+            logger.info("Invalid webhook URL")
+            return JsonResponse({'error': 'webhook_url must be an http(s) URL'}, status=400)
+        if not webhook_url_allowed(webhook_url):
+            logger.info("Webhook URL not allowed: %s", webhook_url)
+            return JsonResponse({'error': 'webhook_url must point to an allowed public host'}, status=400)
 
-            # Save stem image
-            stem_image_file = request.FILES['stem_image']
-            print("Stem image file received:", stem_image_file.name)
-            stem_path = default_storage.save('tmp/' + stem_image_file.name, ContentFile(stem_image_file.read()))
-            stem_image_path = os.path.join(settings.MEDIA_ROOT, stem_path)
-            print("Stem image saved at:", stem_image_path)
-
-            # Process bud image
-            print("Detecting and cropping bud...")
-            cropped_bud = detect_and_crop_bud(bud_image_path)
-            if cropped_bud is None:
-                print("Error: No bud detected in the image")
-                return JsonResponse({'error': 'No bud detected in the image'}, status=400)
-
-            # Process stem image
-            print("Detecting and cropping stem...")
-            cropped_stem = detect_and_crop_stem(stem_image_path)
-            if cropped_stem is None:
-                print("Error: No stem detected in the image")
-                return JsonResponse({'error': 'No stem detected in the image'}, status=400)
-
-            # Extract features and predict for bud
-            print("Extracting features from the cropped bud...")
-            bud_features, resized_bud = extract_bud_features(cropped_bud)
-            bud_features = bud_features.reshape(1, -1)
-            print("Bud features extracted:", bud_features.shape)
-
-            print("Predicting sugarcane variety from bud...")
-            bud_predicted_class = rf_model_bud.predict(bud_features)[0] + 1
-            bud_variety_name = VARIETY_NAMES.get(bud_predicted_class, "Unknown Variety")
-            bud_class_probabilities = rf_model_bud.predict_proba(bud_features)[0]
-            bud_class_probabilities = [float(prob) for prob in bud_class_probabilities]
-            bud_predicted_class_index = np.argmax(bud_class_probabilities)
-            bud_confidence = float(bud_class_probabilities[bud_predicted_class_index])*100
-            print("Bud predicted variety:", bud_variety_name)
-            print("Bud class probabilities:", bud_class_probabilities)
-
-            # Extract features and predict for stem
-            print("Extracting features from the cropped stem...")
-            stem_features, resized_stem = extract_stem_features(cropped_stem)
-            stem_features = stem_features.reshape(1, -1)
-            print("Stem features extracted:", stem_features.shape)
-
-            print("Predicting sugarcane variety from stem using XGBoost...")
-            stem_class_probabilities = rf_model_stem.predict_proba(stem_features)[0]
-            stem_class_probabilities = [float(prob) for prob in stem_class_probabilities]
-            stem_predicted_class_index = np.argmax(stem_class_probabilities)
-            stem_predicted_class = stem_predicted_class_index + 1
-            stem_variety_name = VARIETY_NAMES.get(stem_predicted_class, "Unknown Variety")
-            stem_confidence = float(stem_class_probabilities[stem_predicted_class_index])
-            print("Stem predicted variety:", stem_variety_name)
-            print("Stem class probabilities:", stem_class_probabilities)
-
-            # Combine probabilities from bud and stem
-            bud_weight = 0.5
-            stem_weight = 0.5
-            bud_class_probabilities = np.array(bud_class_probabilities)
-            stem_class_probabilities = np.array(stem_class_probabilities)
-            combined_probabilities = (bud_weight * bud_class_probabilities + stem_weight * stem_class_probabilities) / (bud_weight + stem_weight)
-            combined_probabilities = [float(prob) for prob in combined_probabilities]
-            print("Combined probabilities:", combined_probabilities)
-
-            # Determine final variety and confidence from combined probabilities
-            final_predicted_class_index = np.argmax(combined_probabilities)
-            final_predicted_class = final_predicted_class_index + 1
-            final_variety = VARIETY_NAMES.get(final_predicted_class, "Unknown Variety")
-            final_confidence = float(combined_probabilities[final_predicted_class_index]) * 100
-            print("Final predicted variety:", final_variety)
-            print("Final confidence:", final_confidence)
-
-            # Save the cropped bud image
-            cropped_bud_path = os.path.join(settings.MEDIA_ROOT, 'cropped_buds', f"cropped_{bud_image_file.name}")
-            os.makedirs(os.path.dirname(cropped_bud_path), exist_ok=True)
-            cv2.imwrite(cropped_bud_path, cropped_bud)
-
-            # Save the cropped stem image
-            cropped_stem_path = os.path.join(settings.MEDIA_ROOT, 'cropped_stems', f"cropped_{stem_image_file.name}")
-            os.makedirs(os.path.dirname(cropped_stem_path), exist_ok=True)
-            cv2.imwrite(cropped_stem_path, cropped_stem)
-
-            # Convert cropped bud image to base64
-            _, bud_buffer = cv2.imencode('.jpg', cropped_bud)
-            cropped_bud_base64 = base64.b64encode(bud_buffer).decode('utf-8')
-
-            # Convert cropped stem image to base64
-            _, stem_buffer = cv2.imencode('.jpg', cropped_stem)
-            cropped_stem_base64 = base64.b64encode(stem_buffer).decode('utf-8')
-
-            # Return the final combined result along with individual predictions for reference
-            return JsonResponse({
-                'variety': final_variety,
-                'confidence':final_confidence 
-,
-                # 'bud_variety': bud_variety_name,
-                # 'bud_confidence': bud_confidence * 100,
-                # 'stem_variety': stem_variety_name,
-                # 'stem_confidence': stem_confidence * 100,
-                'cropped_bud_image': cropped_bud_base64,
-                'cropped_stem_image': cropped_stem_base64
-            })
+    try:
+        bud_image_file = request.FILES['bud_image']
+        stem_image_file = request.FILES['stem_image']
+        job = PredictionJob.objects.create(
+            bud_image=bytes(upload_buffer(bud_image_file)),
+            bud_image_name=bud_image_file.name,
+            stem_image=bytes(upload_buffer(stem_image_file)),
+            stem_image_name=stem_image_file.name,
+            webhook_url=webhook_url,
+        )
+        job_worker.start()
+        transaction.on_commit(job_worker.notify)
+    except Exception as e:
+        logger.exception("Exception occurred")
+        return JsonResponse({'error': str(e)}, status=500)
 
-        except Exception as e:
-            print("Exception occurred:", str(e))
-            import traceback
-            traceback.print_exc()
-            return JsonResponse({'error': str(e)}, status=500)
-    else:
-        print("Error: Invalid request method")
-        return JsonResponse({'error': 'Invalid request method'}, status=400)
+    logger.debug("Queued prediction job %s", job.id)
+    status_url = reverse('job_status', args=[job.id])
+    response = JsonResponse({'id': str(job.id), 'status': job.status, 'status_url': status_url}, status=202)
+    response['Location'] = status_url
+    return response
 
-@csrf_exempt
-def predict_sugar_production(request):
+@track_requests('job_status')
+def job_status(request, job_id):
     """
-    Predicts sugar production based on average yearly sunshine hours, soil temperature, and max temperature.
-    Expects a POST request with JSON data containing 'sunshine', 'soil_temp', and 'temp_max'.
+    Returns a job's status, and its prediction or error once it has finished.
     """
-    print("Received request method:", request.method)
-    if request.method == 'POST':
-        try:
-            # Parse the request body (expecting JSON data)
-            import json
-            data = json.loads(request.body)
-            print("Request data:", data)
-
-            # Extract the input values
-            sunshine = float(data.get('sunshine'))
-            soil_temp = float(data.get('soil_temp'))
-            temp_max = float(data.get('temp_max'))
-
-            # Validate inputs
-            if sunshine is None or soil_temp is None or temp_max is None:
-                print("Error: Missing required fields")
-                return JsonResponse({'error': 'Missing required fields: sunshine, soil_temp, and temp_max are required'}, status=400)
-
-            # Prepare input data for prediction
-            input_data = np.array([[sunshine, soil_temp, temp_max]])
-            print("Input data for prediction:", input_data)
-
-            # Make prediction using the loaded model
-            prediction = sugar_production_model.predict(input_data)[0]
-            print("Predicted sugar production:", prediction)
-
-            # Convert prediction to a native Python float to ensure JSON serialization
-            prediction = float(prediction)
-
-            # Return the prediction in a JSON response
-            return JsonResponse({
-                'predicted_sugar_production': round(prediction, 2),  # Round to 2 decimal places for readability
-                'unit': 'tons'
-            })
-
-        except ValueError as ve:
-            print("ValueError occurred:", str(ve))
-            return JsonResponse({'error': 'Invalid input values: sunshine, soil_temp, and temp_max must be numeric'}, status=400)
-        except Exception as e:
-            print("Exception occurred:", str(e))
-            import traceback
-            traceback.print_exc()
-            return JsonResponse({'error': str(e)}, status=500)
-    else:
-        print("Error: Invalid request method")
-        return JsonResponse({'error': 'Invalid request method'}, status=400)
\ No newline at end of file
+    job_worker.start()
+    try:
+        job = PredictionJob.objects.defer('bud_image', 'stem_image').get(pk=job_id)
+    except PredictionJob.DoesNotExist:
+        return JsonResponse({'error': 'Job not found'}, status=404)
+    return JsonResponse(job.to_dict())
+
+# ============================
+# Async Views (ASGI)
+# ============================
+
+def _upload_payload(uploaded_file):
+    # Worker processes need a picklable copy; worker threads can share the upload buffer
+    if inference_pool.is_process_pool:
+        return bytes(upload_buffer(uploaded_file))
+    return upload_buffer(uploaded_file)
+
+def _cached_variety_response(bud_image_file, stem_image_file, mode, arm):
+    cache_key = variety_cache_key(bud_image_file, stem_image_file, variant=cache_variant(mode, arm))
+    if cache_key is None:
+        return None, None
+    cached = prediction_cache.get(cache_key)
+    PREDICTION_CACHE.inc('hit' if cached is not None else 'miss')
+    return cache_key, (cached['response'] if cached is not None else None)
+
+@async_csrf_exempt
+@track_requests('predict_variety_async')
+@limit_upload_size()
+async def predict_variety_async(request):
+    """
+    Async version of predict_variety. Decoding, detection, feature extraction and
+    classification run in the bounded inference pool, with the bud and stem
+    stages running concurrently. Answers 503 with Retry-After when the pool is full.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request method'}, status=400)
+    if 'bud_image' not in request.FILES or 'stem_image' not in request.FILES:
+        return JsonResponse({'error': 'Both bud and stem images are required'}, status=400)
+    mode = response_mode(request)
+    if mode is None:
+        return invalid_response_mode()
+
+    try:
+        with inference_pool.admit():
+            bud_image_file = request.FILES['bud_image']
+            stem_image_file = request.FILES['stem_image']
+
+            arm = choose_arm()
+            # Pool calls that use the models run on the answering model set (ML_SHADOW)
+            run = functools.partial(inference_pool.run, in_arm, arm)
+            engine = in_arm(arm, current_fusion_engine)
+
+            cache_key, cached_response = await asyncio.to_thread(
+                _cached_variety_response, bud_image_file, stem_image_file, mode, arm)
+            if cached_response is not None:
+                return JsonResponse({**cached_response, 'cache': 'hit'})
+
+            bud_image, stem_image = await asyncio.gather(
+                inference_pool.run(decode_for_detection, _upload_payload(bud_image_file), 'Bud image', 'bud'),
+                inference_pool.run(decode_for_detection, _upload_payload(stem_image_file), 'Stem image', 'stem'),
+            )
+            if bud_image is None:
+                return JsonResponse({'error': 'Bud image could not be decoded'}, status=400)
+            if stem_image is None:
+                return JsonResponse({'error': 'Stem image could not be decoded'}, status=400)
+            archive_upload(bud_image_file)
+            archive_upload(stem_image_file)
+
+            images = {'bud': bud_image, 'stem': stem_image}
+            keys = await asyncio.to_thread(pair_keys, [bud_image_file], [stem_image_file])
+            with served_timings() as timings:
+                if engine.early_exit:
+                    # The second organ waits for the first, which may make it unnecessary
+                    first, second = engine.order
+                    results = {first: await run(detect_and_classify, first, images[first], keys and keys[first])}
+                    if results[first] is not None:
+                        if not engine.decisive(first, results[first][3]):
+                            results[second] = await run(detect_and_classify, second, images[second], keys and keys[second])
+                        elif engine.defer:
+                            in_arm(arm, defer_organ, second, images[second], keys and keys[second], {first: results[first][3]})
+                else:
+                    bud_result, stem_result = await asyncio.gather(
+                        run(detect_and_classify, 'bud', bud_image, keys and keys['bud']),
+                        run(detect_and_classify, 'stem', stem_image, keys and keys['stem']),
+                    )
+                    results = {'bud': bud_result, 'stem': stem_result}
+            for organ in engine.order:
+                if organ in results and results[organ] is None:
+                    return JsonResponse({'error': f'No {organ} detected in the image'}, status=400)
+            in_arm(arm, count_fusion_path, [organ for organ in engine.order if organ in results])
+            bud_crops, bud_boxes, bud_confidences, bud_class_probabilities = results.get('bud', SKIPPED_ORGAN)
+            stem_crops, stem_boxes, stem_confidences, stem_class_probabilities = results.get('stem', SKIPPED_ORGAN)
+            cropped_bud, bud_box = (bud_crops[0], bud_boxes[0]) if bud_crops else (None, None)
+            cropped_stem, stem_box = (stem_crops[0], stem_boxes[0]) if stem_crops else (None, None)
+
+            if mode == 'lean':
+                response_data = await run(
+                    lean_variety_response,
+                    cropped_bud, bud_box, cropped_stem, stem_box,
+                    bud_class_probabilities, stem_class_probabilities,
+                )
+            else:
+                response_data = await run(
+                    variety_response,
+                    cropped_bud, bud_image_file.name, cropped_stem, stem_image_file.name,
+                    bud_class_probabilities, stem_class_probabilities,
+                )
+            if MULTI_DETECTION_CONFIG['ENABLED']:
+                response_data['detections'] = detections_response(bud_boxes, bud_confidences, stem_boxes, stem_confidences)
+            if AB_ENABLED:
+                response_data['model_set'] = arm
+            compare(arm, images, bud_class_probabilities, stem_class_probabilities, timings)
+            if cache_key is not None:
+                await asyncio.to_thread(prediction_cache.set, cache_key, {
+                    'bud_box': bud_box,
+                    'stem_box': stem_box,
+                    'bud_probabilities': bud_class_probabilities,
+                    'stem_probabilities': stem_class_probabilities,
+                    'response': response_data,
+                })
+            return JsonResponse({**response_data, 'cache': 'miss'})
+
+    except UploadRejected as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except Overloaded as e:
+        return overloaded_response(e)
+    except Exception as e:
+        logger.exception("Exception occurred")
+        return JsonResponse({'error': str(e)}, status=500)
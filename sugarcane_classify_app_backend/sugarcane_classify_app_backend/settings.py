@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -45,6 +46,7 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'corsheaders',
+    'ml_integration',
 ]
 
 MIDDLEWARE = [
@@ -130,3 +132,296 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# ML model loading
+# Models are loaded lazily on first use. Set ML_WARMUP_ON_STARTUP to load and
+# warm them up in AppConfig.ready() instead, and ML_MODEL_AUTO_RELOAD to pick
+# up replaced model files without restarting the process.
+
+ML_WARMUP_ON_STARTUP = False
+
+ML_MODEL_AUTO_RELOAD = False
+
+# Prediction cache
+# Repeated uploads of the same bud/stem photos are answered from this cache.
+# BACKEND is 'locmem' (in-process LRU) or 'django' (the cache named by ALIAS);
+# locally that is the file-based 'predictions' cache below.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'predictions': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache' / 'predictions',
+        'OPTIONS': {'MAX_ENTRIES': 1000},
+    },
+}
+
+ML_PREDICTION_CACHE = {
+    'ENABLED': True,
+    'BACKEND': 'django',
+    'ALIAS': 'predictions',
+    'MAX_ENTRIES': 256,
+    'TTL': 3600,
+}
+
+# Async inference pool
+# The async endpoints (/api/async/...) run CPU-bound stages in this pool.
+# KIND is 'thread' or 'process'; requests beyond MAX_PENDING in flight are
+# answered with 503 and a Retry-After of RETRY_AFTER seconds.
+
+ML_INFERENCE_POOL = {
+    'KIND': 'thread',
+    'WORKERS': 4,
+    'MAX_PENDING': 32,
+    'RETRY_AFTER': 2,
+}
+
+# Detection micro-batching
+# When enabled, concurrent detection jobs are collected for up to WINDOW_MS
+# (or MAX_BATCH jobs) and run as one batched YOLO call per detector.
+
+ML_DETECTION_BATCHING = {
+    'ENABLED': False,
+    'MAX_BATCH': 16,
+    'WINDOW_MS': 10,
+}
+
+# Detector backend
+# 'torch' runs the .pt weights through ultralytics; 'onnx' and 'openvino' run
+# the exports written by `manage.py export_detectors` (use ML_DETECTOR_INT8
+# for the quantized ONNX / OpenVINO export). The ONNX backend letterboxes like
+# ultralytics does for .pt weights; the fixed-shape OpenVINO export is padded
+# to a full square, so its boxes can differ slightly (see detectors.py).
+
+ML_DETECTOR_BACKEND = 'torch'
+
+ML_DETECTOR_INT8 = False
+
+# Compiled classifiers
+# When enabled, the bud and stem classifiers are served from the flattened
+# ensembles written by `manage.py compile_classifiers` (<pickle>.compiled.npz)
+# instead of unpickling sklearn / xgboost. Stale compiled files are ignored.
+
+ML_USE_COMPILED_CLASSIFIERS = False
+
+# Logging
+# ml_integration logs model loads and errors at INFO and above. Per-request
+# details are logged at DEBUG and stay off on the hot path unless
+# ML_LOG_LEVEL=DEBUG is set in the environment.
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'standard': {
+            'format': '%(asctime)s %(levelname)s %(name)s: %(message)s',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'standard',
+        },
+    },
+    'loggers': {
+        'ml_integration': {
+            'handlers': ['console'],
+            'level': os.environ.get('ML_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
+}
+
+# Bulk sugar production forecasting
+# /api/predict-sugar-production/bulk/ scores and streams this many rows per chunk.
+
+ML_SUGAR_BULK_CHUNK_ROWS = 65536
+
+# Precomputed sugar production grid
+# When enabled, sugar production requests inside AXES ((start, stop, step) per input)
+# are answered from a grid of model outputs built by `manage.py build_sugar_grid`
+# (or on first load with BUILD_IF_STALE), trilinearly interpolated between grid
+# points if INTERPOLATE is on; inputs outside the grid go to the model. The grid's
+# maximum interpolation error is recorded in its .json metadata file.
+
+ML_SUGAR_GRID = {
+    'ENABLED': False,
+    'INTERPOLATE': True,
+    'BUILD_IF_STALE': False,
+}
+
+# Prediction jobs (/api/jobs/)
+# Submitted jobs are stored in the database and run by a worker pool of
+# CONCURRENCY threads in each server process. Jobs interrupted by a crash or
+# restart are queued again (up to MAX_ATTEMPTS runs); finished jobs are
+# deleted after RETENTION seconds. The worker starts with the server process
+# (AUTOSTART). Webhook bodies are signed with WEBHOOK_SECRET (HMAC-SHA256) when
+# it is set; webhooks only go to WEBHOOK_ALLOWED_HOSTS when that is set, and
+# otherwise to hosts resolving to public addresses, connected to directly
+# (HTTP(S)_PROXY is not used for those); list the host here to send through a proxy.
+
+ML_JOBS = {
+    'CONCURRENCY': 2,
+    'RETENTION': 24 * 3600,
+    'STALE_AFTER': 15 * 60,
+    'MAX_ATTEMPTS': 3,
+    'WEBHOOK_SECRET': os.environ.get('ML_JOBS_WEBHOOK_SECRET', ''),
+}
+
+# Lean variety responses
+# With ?response=lean (or ML_DEFAULT_RESPONSE_MODE = 'lean') the variety
+# endpoints return crop ids and boxes instead of base64 crops; the crops are
+# stored once as MAX_SIZE thumbnails in DIR and served from /api/crops/<id>.
+# Run `manage.py purge_crops` periodically to delete crops last referenced
+# more than RETENTION seconds ago, then the least recently referenced ones
+# until DIR holds at most MAX_BYTES.
+
+ML_DEFAULT_RESPONSE_MODE = 'full'
+
+ML_CROPS = {
+    'FORMAT': 'webp',
+    'QUALITY': 80,
+    'MAX_SIZE': 320,
+    'RETENTION': 7 * 24 * 3600,
+    'MAX_BYTES': 1024 ** 3,
+}
+
+# Multi-detection mode
+# When enabled, every bud/stem detection with confidence >= MIN_CONFIDENCE (up
+# to MAX_DETECTIONS per photo, and always at least the best one) is cropped and
+# classified, and the per-crop probabilities are averaged weighted by detection
+# confidence. When disabled only the most confident detection is used.
+
+ML_MULTI_DETECTION = {
+    'ENABLED': False,
+    'MIN_CONFIDENCE': 0.5,
+    'MAX_DETECTIONS': 8,
+}
+
+# Upload preprocessing
+# When enabled, uploads are checked and decoded before any model runs: images
+# smaller than MIN_SIDE or blank (pixel stddev below MIN_STDDEV) are rejected
+# with 400, JPEGs are decoded at reduced resolution (no smaller than CROP_SIZE
+# on the long side) and the detector runs on a DETECT_SIZE copy.
+# ML_MAX_UPLOAD_BYTES caps every image upload (413) and applies regardless.
+
+ML_UPLOAD_PREPROCESSING = {
+    'ENABLED': False,
+    'DETECT_SIZE': 640,
+    'CROP_SIZE': 960,
+    'MIN_SIDE': 64,
+    'MIN_STDDEV': 2.0,
+}
+
+ML_MAX_UPLOAD_BYTES = 25 * 1024 * 1024
+
+# Upload archiving
+# Uploads are decoded in memory and not written anywhere. When enabled, the raw
+# bud/stem uploads are also saved to ML_ARCHIVE_DIR in the default storage
+# (MEDIA_ROOT), from one background thread. The whole upload is still copied on
+# the request thread first, since its buffer is released with the request.
+
+ML_ARCHIVE_UPLOADS = False
+ML_ARCHIVE_DIR = 'tmp/'
+
+# Feature store
+# When enabled, the feature vector, box and confidence of every classified
+# bud/stem crop are stored under DIR, keyed by a hash of the uploaded image, in
+# chunks of CHUNK_ROWS rows. `manage.py rescore_features` re-scores the whole
+# corpus from the store with new classifier pickles.
+
+ML_FEATURE_STORE = {
+    'ENABLED': False,
+    'CHUNK_ROWS': 4096,
+    'FLUSH_INTERVAL': 60.0,
+}
+
+# Model server
+# When enabled, the Django workers do not load the models in MODELS
+# themselves: `manage.py run_model_server` loads them once and the workers
+# call it over the SOCKET Unix socket, passing images through shared memory.
+# Start the model server before the workers.
+
+ML_MODEL_SERVER = {
+    'ENABLED': False,
+    'MODELS': ['bud_detector', 'bud_classifier', 'stem_detector', 'stem_classifier', 'sugar_production'],
+    'TIMEOUT': 60.0,
+}
+
+# Variety fusion
+# How the bud and stem class probabilities are combined: STRATEGY is
+# 'weighted_mean', 'geometric_mean' or 'max_confidence', with per-organ
+# WEIGHTS and calibration TEMPERATURES. VERSIONS overrides these for a pair
+# of classifier files ('<bud file>:<stem file>'). With EARLY_EXIT enabled, the
+# FIRST organ decides alone when its top probability reaches THRESHOLD, and
+# the other organ is skipped (or classified after responding, with DEFER).
+
+ML_FUSION = {
+    'STRATEGY': 'weighted_mean',
+    'WEIGHTS': {'bud': 0.5, 'stem': 0.5},
+    'EARLY_EXIT': {
+        'ENABLED': False,
+        'FIRST': 'bud',
+        'THRESHOLD': 0.9,
+    },
+    'VERSIONS': {},
+}
+
+# Sweep uploads
+# /api/predict-sweep/ accepts a short clip ('video') or a burst of photos
+# ('frame'). At most MAX_FRAMES distinct frames per request are sampled and
+# sent to the detectors, so a clip costs a predictable amount of CPU.
+
+ML_SWEEP = {
+    'MAX_FRAMES': 16,
+    'MAX_DECODED_FRAMES': 600,
+    'MIN_HASH_DISTANCE': 6,
+    'MAX_VIDEO_BYTES': 100 * 1024 * 1024,
+}
+
+# Deployment profile
+# 'full' serves every endpoint. 'forecast' serves only sugar production
+# forecasting, /api/models/ and /api/metrics without importing OpenCV,
+# scikit-image or the detectors, for cheap forecasting-only workers. Set per
+# process with the ML_PROFILE environment variable.
+
+ML_PROFILE = os.environ.get('ML_PROFILE', 'full')
+
+# Tiled detection
+# When enabled, detections of the listed organs in images at least MIN_SIDE
+# px on their long side are refined on full-resolution TILE_SIZE tiles. Only
+# the tiles around objects found by the normal low-resolution pass are run
+# (at most MAX_TILES per image, in one detector batch), so the extra cost
+# follows the number of objects rather than the image size. With upload
+# preprocessing enabled, images of these organs are decoded at full
+# resolution (no reduced JPEG decode), so they can still reach MIN_SIDE.
+
+ML_TILED_DETECTION = {
+    'ENABLED': False,
+    'ORGANS': ['stem'],
+    'MIN_SIDE': 1600,
+    'TILE_SIZE': 640,
+    'OVERLAP': 0.25,
+    'MAX_TILES': 12,
+}
+
+# Shadow and A/B inference
+# CANDIDATE_PATHS names new files for any of bud_detector, bud_classifier,
+# stem_detector and stem_classifier. In 'shadow' mode the current models
+# answer and the candidate set runs afterwards on the same decoded images;
+# in 'ab' mode the candidate set answers AB_PERCENT percent of requests and
+# the current models run afterwards. Comparison runs use a low-priority pool
+# and are dropped when MAX_QUEUE are pending. Their records (both answers,
+# confidences and per-model latency) go to DIR; see `manage.py shadow_report`.
+
+ML_SHADOW = {
+    'MODE': 'off',
+    'CANDIDATE_PATHS': {
+        # 'stem_detector': os.path.join(BASE_DIR, 'ml_models', 'StemDetection_v2.pt'),
+    },
+    'AB_PERCENT': 0.0,
+    'SAMPLE_RATE': 1.0,
+    'MAX_QUEUE': 8,
+}